@@ -0,0 +1,363 @@
+# ------------------------------------------------------------------------
+# PoET: Pose Estimation Transformer for Single-View, Multi-Object 6D Pose Estimation
+# Copyright (c) 2022 Thomas Jantos (thomas.jantos@aau.at), University of Klagenfurt - Control of Networked Systems (CNS). All Rights Reserved.
+# Licensed under the BSD-2-Clause-License with no commercial use [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+CPU inference benchmark of the YOLO + PoET pipeline with synthetic inputs.
+
+PoET is built from the inference configs of poet_run_configs.yml with random weights, such that neither weights nor
+datasets are needed. For every combination of resolution, batch size and number of detections, random images are
+passed through the model with that many random query boxes per image, and the latency of the stages is collected with
+a LatencyMonitor (backbone, nms, position_encoding, queries, transformer with encoder and decoder, heads). As in the
+live inference, the backbone runs with its detection heads, hence the backbone stage includes the YOLO layers. The
+detections of a randomly initialized YOLO are meaningless, so its candidates are replaced before NMS by synthetic
+candidates of the same shape, in which every detection is a cluster of overlapping boxes above the confidence
+threshold. The resulting detections are discarded in favor of the query boxes. The resolutions have to be multiples
+of the largest YOLO stride (32).
+
+The results, together with the peak RSS, the throughput and the environment, are written as JSON, such that runs can
+be compared across commits:
+    python benchmark.py --resolutions 480x640 224x320 --batch_sizes 1 4 --detections 1 4 8 --output bench.json
+With --nms_comparison, batched_non_max_suppression is compared with the per-image loop of non_max_suppression on the
+synthetic candidates instead, for batch sizes 1 to 32 by default:
+    python benchmark.py --nms_comparison --resolutions 480x640 --detections 1 8 --output nms.json
+--nms_clutter additionally places many scattered boxes above the confidence threshold, e.g. 0.1 of the candidates.
+Further model flags of poet_inference.py, e.g. --optimize_backbone or --sparse_encoder, are passed through. No compiled
+extension is needed: without mish_cuda and deformable_attention, the plain PyTorch implementations are used, which
+are recorded in the environment of the results.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import torch
+import yaml
+
+import models.yolov4.cns_yolo as cns_yolo
+from models import build_model
+from models.deformable_transformer import MSDEFORM_ATTN_MODULES
+from models.yolov4.yolo.yolo_utils.layers import Mish
+from models.yolov4.yolo.yolo_utils.general import batched_non_max_suppression, non_max_suppression
+from poet_inference import get_args_parser
+from util.latency import LatencyMonitor, attach
+from util.misc import nested_tensor_from_tensor_list
+
+ROOT = Path(__file__).resolve().parent
+
+
+def get_benchmark_parser():
+    parser = argparse.ArgumentParser('PoET CPU inference benchmark', add_help=False)
+    parser.add_argument('--run_config', default=str(ROOT / 'configs' / 'poet_run_configs.yml'), type=str,
+                        help="Run config file whose inference configs PoET is built from.")
+    parser.add_argument('--resolutions', default=['480x640'], type=str, nargs='+',
+                        help="Image resolutions as HxW.")
+    parser.add_argument('--batch_sizes', default=[1], type=int, nargs='+')
+    parser.add_argument('--detections', default=[1, 4, 8], type=int, nargs='+',
+                        help="Numbers of detections per image, at most num_queries.")
+    parser.add_argument('--warmup', default=2, type=int, help="Iterations per setting that are not measured.")
+    parser.add_argument('--iterations', default=10, type=int, help="Measured iterations per setting.")
+    parser.add_argument('--threads', default=0, type=int, help="Number of torch threads. 0 uses the default.")
+    parser.add_argument('--benchmark_seed', default=0, type=int)
+    parser.add_argument('--output', default='benchmark.json', type=str, help="Path of the JSON results.")
+    parser.add_argument('--nms_comparison', action='store_true',
+                        help="Instead of the model, compare batched_non_max_suppression with the per-image loop of "
+                             "non_max_suppression on the synthetic candidates for every resolution, "
+                             "--nms_batch_sizes and --detections.")
+    parser.add_argument('--nms_batch_sizes', default=[1, 2, 4, 8, 16, 32], type=int, nargs='+',
+                        help="Batch sizes of the NMS comparison.")
+    parser.add_argument('--nms_clutter', default=0.0, type=float,
+                        help="Fraction of the synthetic candidates that are scattered boxes above the confidence "
+                             "threshold in addition to the detections.")
+    return parser
+
+
+def load_run_config(path):
+    """
+    Returns the inference configs of the run config file. The backbone config falls back to the one in configs/ if the
+    configured path does not exist, e.g. outside of the container.
+    """
+    with open(path, 'r') as f:
+        configs = yaml.safe_load(f)['inference_configs']
+    if 'backbone_cfg' in configs and not os.path.exists(configs['backbone_cfg']):
+        configs['backbone_cfg'] = str(ROOT / 'configs' / os.path.basename(configs['backbone_cfg']))
+    return configs
+
+
+def synthetic_query_boxes(batch_size, n_detections, n_classes):
+    """
+    Random normalized query boxes (cx, cy, w, h) with random classes.
+    """
+    queries = []
+    for _ in range(batch_size):
+        centers = torch.rand(n_detections, 2) * 0.6 + 0.2
+        sizes = torch.rand(n_detections, 2) * 0.25 + 0.05
+        queries.append({'boxes': torch.cat([centers, sizes], dim=1),
+                        'labels': torch.randint(1, n_classes + 1, (n_detections,))})
+    return queries
+
+
+def synthetic_candidates(shape, n_detections, image_size, cluster_size=3, clutter=0.0):
+    """
+    Output of the YOLO layers of size shape [batch_size, n_candidates, 5 + n_classes] (cx, cy, w, h in pixels,
+    objectness, class scores) for images of image_size, in which n_detections objects per image are each covered by
+    cluster_size overlapping candidates above any sensible confidence threshold, the remaining candidates are below it.
+    A fraction clutter of the remaining candidates gets a random objectness in [0.5, 1] instead, such that many
+    scattered boxes pass the confidence threshold as in cluttered scenes.
+    """
+    batch_size, n_candidates, n_outputs = shape
+    height, width = image_size
+    candidates = torch.rand(shape)
+    candidates[..., 0] *= width
+    candidates[..., 1] *= height
+    candidates[..., 2:4] *= 64
+    candidates[..., 4] *= 0.01
+    cluttered = torch.rand(batch_size, n_candidates) < clutter
+    candidates[..., 4][cluttered] = 0.5 + 0.5 * torch.rand(int(cluttered.sum()))
+    n_objects = min(n_detections * cluster_size, n_candidates)
+    for b in range(batch_size):
+        idx = torch.randperm(n_candidates)[:n_objects]
+        objects = torch.rand(n_detections, 4) * torch.tensor([width * 0.6, height * 0.6, 80., 80.]) + \
+            torch.tensor([width * 0.2, height * 0.2, 20., 20.])
+        boxes = objects.repeat_interleave(cluster_size, dim=0)[:n_objects]
+        candidates[b, idx, :4] = boxes + torch.randn_like(boxes) * 2
+        # Distinct confidences, ties would make the order of the kept detections arbitrary
+        candidates[b, idx, 4] = 0.9 + 0.1 * torch.rand(n_objects)
+        classes = torch.randint(0, n_outputs - 5, (n_detections,)).repeat_interleave(cluster_size)[:n_objects]
+        candidates[b, idx, 5:] = 0.
+        candidates[b, idx, 5 + classes] = 0.95
+    return candidates
+
+
+def peak_rss_mb():
+    # ru_maxrss is given in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def implementations(model):
+    """
+    Returns the modules providing the Mish activation and the multi-scale deformable attention of the model, i.e.
+    whether the compiled CUDA extensions or the plain PyTorch implementations are benchmarked.
+    """
+    msda = next((type(m).__module__ for m in model.modules() if isinstance(m, MSDEFORM_ATTN_MODULES)), None)
+    return {'mish': Mish.__module__, 'msda': msda}
+
+
+@contextmanager
+def detection_enabled(model, candidates):
+    """
+    Runs the backbone of the model with its detection heads and NMS as in the live inference, although query boxes are
+    passed to the model, which otherwise skips them. NMS is applied to the synthetic candidates instead of the output of
+    the YOLO layers, the detections are discarded.
+    """
+    joiner = model.backbone
+    forward = joiner.forward
+    nms = cns_yolo.batched_non_max_suppression
+    joiner.forward = lambda tensor_list, detect=True: forward(tensor_list, detect=True)
+    cns_yolo.batched_non_max_suppression = lambda prediction, *args, **kwargs: nms(candidates, *args, **kwargs)
+    try:
+        yield
+    finally:
+        del joiner.forward
+        cns_yolo.batched_non_max_suppression = nms
+
+
+@torch.no_grad()
+def benchmark_setting(model, args, image_size, batch_size, n_detections):
+    """
+    Benchmarks the model for one setting and returns the per-stage latencies in ms, the end-to-end latency per batch
+    and the throughput in images per second. The backbone stage includes the detection heads.
+    """
+    height, width = image_size
+    backbone = model.backbone[0]
+    samples = nested_tensor_from_tensor_list([torch.rand(3, height, width) for _ in range(batch_size)])
+    query_boxes = synthetic_query_boxes(batch_size, n_detections, args.n_classes)
+    candidates_shape = backbone.forward_layers(samples.tensors[:1])[0].shape
+    candidates = synthetic_candidates((batch_size,) + candidates_shape[1:], n_detections, image_size)
+
+    with detection_enabled(model, candidates):
+        for _ in range(args.warmup):
+            model(samples, None, query_boxes=query_boxes)
+
+        monitor = LatencyMonitor(window=args.iterations)
+        attach(model, monitor)
+        for _ in range(args.iterations):
+            start = time.perf_counter()
+            model(samples, None, query_boxes=query_boxes)
+            monitor.frame_done(start)
+        attach(model, None)
+
+    summary = monitor.summary()
+    total = summary.pop('total')
+    stages = {stage: {'mean_ms': s['sum'] / s['count'] * 1000, 'p50_ms': s['p50'] * 1000, 'p95_ms': s['p95'] * 1000}
+              for stage, s in summary.items()}
+    return {
+        'resolution': [height, width],
+        'batch_size': batch_size,
+        'detections': n_detections,
+        'stages': stages,
+        'latency_ms': {'mean': total['sum'] / total['count'] * 1000, 'p50': total['p50'] * 1000,
+                       'p95': total['p95'] * 1000},
+        'throughput_fps': batch_size * total['count'] / total['sum'],
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def time_ms(fn, warmup, iterations):
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        durations.append((time.perf_counter() - start) * 1000)
+    return {'mean_ms': float(np.mean(durations)), 'p50_ms': float(np.percentile(durations, 50)),
+            'p95_ms': float(np.percentile(durations, 95))}
+
+
+@torch.no_grad()
+def compare_nms(model, args, image_size, batch_size, n_detections):
+    """
+    Times the per-image loop of non_max_suppression and batched_non_max_suppression on the same synthetic candidates
+    and checks that both return the same detections for every image. Images the loop skipped because of its time
+    limit are counted separately.
+    """
+    backbone = model.backbone[0]
+    candidates_shape = backbone.forward_layers(torch.rand(1, 3, *image_size))[0].shape
+    candidates = synthetic_candidates((batch_size,) + candidates_shape[1:], n_detections, image_size,
+                                      clutter=args.nms_clutter)
+    nms_args = (backbone.conf_thres, backbone.iou_thres)
+    nms_kwargs = {'agnostic': backbone.agnostic_nms}
+
+    loop = non_max_suppression(candidates.clone(), *nms_args, **nms_kwargs)
+    batched = batched_non_max_suppression(candidates.clone(), *nms_args, **nms_kwargs)
+    # non_max_suppression stops after its time limit, the remaining images are left without detections
+    n_processed = len(loop)
+    while n_processed > 0 and loop[n_processed - 1] is None and batched[n_processed - 1] is not None:
+        n_processed -= 1
+    identical = all((a is None and b is None) or (a is not None and b is not None and a.shape == b.shape and
+                                                  torch.allclose(a, b)) for a, b in zip(loop[:n_processed], batched))
+
+    loop_ms = time_ms(lambda: non_max_suppression(candidates, *nms_args, **nms_kwargs), args.warmup, args.iterations)
+    batched_ms = time_ms(lambda: batched_non_max_suppression(candidates, *nms_args, **nms_kwargs), args.warmup,
+                         args.iterations)
+    return {
+        'resolution': list(image_size),
+        'batch_size': batch_size,
+        'detections': n_detections,
+        'candidates': candidates_shape[1],
+        'clutter': args.nms_clutter,
+        'loop': loop_ms,
+        'batched': batched_ms,
+        'speedup': loop_ms['mean_ms'] / batched_ms['mean_ms'],
+        'identical': identical,
+        'loop_dropped_images': batch_size - n_processed,
+    }
+
+
+def run_nms_comparison(model, args, image_sizes):
+    results = []
+    for image_size in image_sizes:
+        for batch_size in args.nms_batch_sizes:
+            for n_detections in args.detections:
+                result = compare_nms(model, args, image_size, batch_size, n_detections)
+                results.append(result)
+                print("{}x{} bs {} det {}: NMS loop {:.2f} ms, batched {:.2f} ms ({:.1f}x), identical: {}, images "
+                      "dropped by the time limit of the loop: {}".format(
+                          image_size[0], image_size[1], batch_size, n_detections, result['loop']['mean_ms'],
+                          result['batched']['mean_ms'], result['speedup'], result['identical'],
+                          result['loop_dropped_images']))
+    return results
+
+
+def run_model_benchmark(model, args, image_sizes):
+    print("Stages: backbone = YOLO layers including the detection heads, nms = NMS of the synthetic candidates, "
+          "followed by the stages of PoET")
+    results = []
+    for image_size in image_sizes:
+        for batch_size in args.batch_sizes:
+            for n_detections in args.detections:
+                if n_detections > args.num_queries:
+                    print("Skipping {} detections, PoET is configured for {} queries".format(n_detections,
+                                                                                            args.num_queries))
+                    continue
+                result = benchmark_setting(model, args, image_size, batch_size, n_detections)
+                results.append(result)
+                stages = ", ".join("{} {:.1f}".format(stage, s['mean_ms']) for stage, s in result['stages'].items())
+                print("{}x{} bs {} det {}: {:.1f} ms/batch, {:.2f} img/s, peak RSS {:.0f} MB | mean [ms]: {}".format(
+                    image_size[0], image_size[1], batch_size, n_detections, result['latency_ms']['mean'],
+                    result['throughput_fps'], result['peak_rss_mb'], stages))
+    return results
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.benchmark_seed)
+    np.random.seed(args.benchmark_seed)
+
+    model, _, _ = build_model(args)
+    model.eval()
+    image_sizes = [tuple(int(v) for v in resolution.split('x')) for resolution in args.resolutions]
+    max_stride = max(model.backbone[0].module_list[i].stride for i in model.backbone[0].yolo_layers)
+    for height, width in image_sizes:
+        if height % max_stride or width % max_stride:
+            raise ValueError("Resolution {}x{} is not divisible by the YOLO stride {}".format(height, width, max_stride))
+    if args.optimize_backbone:
+        model.backbone[0].prepare_inference(image_sizes[0], torch.device('cpu'), jit=args.backbone_jit)
+    n_parameters = sum(p.numel() for p in model.parameters())
+    print("PoET with {} parameters, peak RSS after build {:.0f} MB".format(n_parameters, peak_rss_mb()))
+
+    if args.nms_comparison:
+        results = run_nms_comparison(model, args, image_sizes)
+    else:
+        results = run_model_benchmark(model, args, image_sizes)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {'python': platform.python_version(), 'torch': torch.__version__,
+                        'machine': platform.machine(), 'processor': platform.processor(),
+                        'cpu_count': os.cpu_count(), 'torch_threads': torch.get_num_threads(),
+                        'implementations': implementations(model)},
+        'settings': {'mode': 'nms_comparison' if args.nms_comparison else 'model', 'run_config': args.run_config,
+                     'warmup': args.warmup, 'iterations': args.iterations,
+                     'backbone_cfg': args.backbone_cfg, 'num_queries': args.num_queries,
+                     'n_classes': args.n_classes, 'enc_layers': args.enc_layers, 'dec_layers': args.dec_layers,
+                     'msda_backend': args.msda_backend, 'optimize_backbone': args.optimize_backbone,
+                     'sparse_encoder': args.sparse_encoder, 'early_exit': args.early_exit,
+                     'backbone_includes_detection_heads': True},
+        'n_parameters': n_parameters,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to {}".format(args.output))
+
+
+if __name__ == '__main__':
+    benchmark_parser = get_benchmark_parser()
+    config_args, _ = benchmark_parser.parse_known_args()
+    parser = argparse.ArgumentParser('PoET CPU inference benchmark', parents=[get_args_parser(), benchmark_parser])
+    # The run config provides the defaults, flags given on the command line take precedence
+    run_config = load_run_config(config_args.run_config)
+    known = vars(parser.parse_args([]))
+    parser.set_defaults(**{k: v for k, v in run_config.items() if k in known})
+    parser.set_defaults(device='cpu', backbone_weights=None, resume='')
+    args = parser.parse_args()
+    main(args)
@@ -184,7 +184,8 @@ def pose_evaluate(model, matcher, pose_evaluator, data_loader, image_set, bbox_m
     total_time = time.time() - start_time
     total_time_str = str(datetime.timedelta(seconds=int(total_time)))
     print("Evaluation time: {}".format(total_time_str))
-    return
+    return {"add": add_results, "adi": adi_results, "adds": adds_results,
+            "translation_error": avg_translation_errors, "rotation_error": avg_rotation_errors}
 
 
 @torch.no_grad()
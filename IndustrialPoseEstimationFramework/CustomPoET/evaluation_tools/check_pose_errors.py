@@ -0,0 +1,72 @@
+# ------------------------------------------------------------------------
+# PoET: Pose Estimation Transformer for Single-View, Multi-Object 6D Pose Estimation
+# Copyright (c) 2022 Thomas Jantos (thomas.jantos@aau.at), University of Klagenfurt - Control of Networked Systems (CNS). All Rights Reserved.
+# Licensed under the BSD-2-Clause-License with no commercial use [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Cross-check of the closed-form rotation errors of pose_errors.rotation_errors against the matrix logarithm that the
+pose evaluator used before (||logm(R_pred^T R_gt)||_F / sqrt(2) per pose), on random rotation pairs. Additionally
+checks the errors of relative rotations with a known angle close to 0 and π, where logm is ambiguous, and that rotation
+matrices that are not orthonormal yield a finite error instead of aborting the evaluation.
+
+    python -m evaluation_tools.check_pose_errors --n_pairs 200
+
+Exits with a non-zero status if a deviation exceeds the tolerance.
+"""
+import argparse
+import sys
+
+import numpy as np
+from numpy import linalg as LA
+from scipy.linalg import logm
+from scipy.spatial.transform import Rotation
+
+from evaluation_tools.pose_errors import rotation_errors
+
+
+def logm_rotation_error(rot_pred, rot_gt):
+    # Per-pose reference, as in the former PoseEvaluator.calc_rotation_error
+    temp = logm(np.dot(np.transpose(rot_pred), rot_gt))
+    return np.degrees(LA.norm(temp, 'fro') / np.sqrt(2))
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    failed = False
+
+    rot_pred = Rotation.random(args.n_pairs, random_state=args.seed).as_matrix()
+    rot_gt = Rotation.random(args.n_pairs, random_state=args.seed + 1).as_matrix()
+    errors = rotation_errors(rot_pred, rot_gt)
+    reference = np.array([logm_rotation_error(p, g) for p, g in zip(rot_pred, rot_gt)])
+    deviation = np.abs(errors - reference).max()
+    failed |= deviation > args.tolerance
+    print("Random pairs: max deviation from logm {:.3g} deg over {} pairs".format(deviation, args.n_pairs))
+
+    # Relative rotations with a known angle, logm picks an arbitrary branch at π
+    angles = np.concatenate([np.geomspace(1e-8, 1e-1, 8), np.pi - np.geomspace(1e-8, 1e-1, 8), [0.0, np.pi]])
+    axes = rng.normal(size=(len(angles), 3))
+    axes /= LA.norm(axes, axis=1, keepdims=True)
+    rot_gt = Rotation.random(len(angles), random_state=args.seed).as_matrix()
+    rot_pred = rot_gt @ Rotation.from_rotvec(axes * angles[:, None]).as_matrix().transpose(0, 2, 1)
+    deviation = np.abs(rotation_errors(rot_pred, rot_gt) - np.degrees(angles)).max()
+    failed |= deviation > args.tolerance
+    print("Angles near 0 and pi: max deviation from the true angle {:.3g} deg".format(deviation))
+
+    # Predictions that are not orthonormal must not abort the evaluation
+    scales = rng.uniform(0.5, 1.5, (args.n_pairs, 1, 1))
+    rot_pred = Rotation.random(args.n_pairs, random_state=args.seed).as_matrix() * scales
+    errors = rotation_errors(rot_pred, rot_gt[:1].repeat(args.n_pairs, axis=0))
+    finite = np.isfinite(errors).all() and ((errors >= 0) & (errors <= 180)).all()
+    failed |= not finite
+    print("Scaled rotation matrices: all errors finite and within [0, 180] deg: {}".format(finite))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Cross-check of the closed-form rotation errors')
+    parser.add_argument('--n_pairs', default=200, type=int, help="Number of random rotation pairs")
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--tolerance', default=1e-6, type=float, help="Maximum accepted deviation in degrees")
+    sys.exit(main(parser.parse_args()))
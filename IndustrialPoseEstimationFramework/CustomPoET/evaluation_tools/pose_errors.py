@@ -0,0 +1,66 @@
+# ------------------------------------------------------------------------
+# PoET: Pose Estimation Transformer for Single-View, Multi-Object 6D Pose Estimation
+# Copyright (c) 2022 Thomas Jantos (thomas.jantos@aau.at), University of Klagenfurt - Control of Networked Systems (CNS). All Rights Reserved.
+# Licensed under the BSD-2-Clause-License with no commercial use [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Vectorized rotation and translation errors of whole arrays of poses.
+
+The rotation error is the geodesic distance between the predicted and the ground truth rotation, computed in closed
+form from the trace and the skew-symmetric part of the relative rotation (see util.rotation_utils.so3_relative_angle)
+instead of a matrix logarithm per pose.
+"""
+import numpy as np
+import torch
+
+from util.rotation_utils import so3_relative_angle
+
+
+def rotation_errors(rot_pred, rot_gt):
+    """
+    Geodesic rotation errors in degrees between the predicted and ground truth rotation matrices, both of shape
+    (n, 3, 3). Returns an array of shape (n,).
+    """
+    rot_pred = torch.from_numpy(np.asarray(rot_pred, dtype=np.float64).reshape(-1, 3, 3))
+    rot_gt = torch.from_numpy(np.asarray(rot_gt, dtype=np.float64).reshape(-1, 3, 3))
+    return np.degrees(so3_relative_angle(rot_pred, rot_gt).numpy())
+
+
+def translation_errors(t_pred, t_gt):
+    """
+    Euclidean distances between the predicted and ground truth translations, both of shape (n, 3). Returns an array of
+    shape (n,) in the unit of the translations.
+    """
+    t_pred = np.asarray(t_pred, dtype=np.float64).reshape(-1, 3)
+    t_gt = np.asarray(t_gt, dtype=np.float64).reshape(-1, 3)
+    return np.linalg.norm(t_pred - t_gt, axis=1)
+
+
+def pose_errors(poses_pred, poses_gt):
+    """
+    Rotation errors in degrees and translation errors of the predicted and ground truth [R|t] poses, both of shape
+    (n, 3, 4).
+    """
+    poses_pred = np.asarray(poses_pred, dtype=np.float64).reshape(-1, 3, 4)
+    poses_gt = np.asarray(poses_gt, dtype=np.float64).reshape(-1, 3, 4)
+    return (rotation_errors(poses_pred[:, :, :3], poses_gt[:, :, :3]),
+            translation_errors(poses_pred[:, :, 3], poses_gt[:, :, 3]))
+
+
+def summarize_errors(cls_errors):
+    """
+    Per-class summary statistics of the errors given as dict class -> array of errors. Classes without errors have
+    n = 0 and NaN statistics. The entry 'all' summarizes the errors of all classes together.
+    """
+    def summary(errors):
+        errors = np.asarray(errors, dtype=np.float64)
+        if len(errors) == 0:
+            return {'n': 0, 'mean': np.nan, 'std': np.nan, 'median': np.nan, 'p95': np.nan, 'max': np.nan}
+        return {'n': len(errors), 'mean': errors.mean(), 'std': errors.std(), 'median': np.median(errors),
+                'p95': np.percentile(errors, 95), 'max': errors.max()}
+
+    summaries = {cls: summary(errors) for cls, errors in cls_errors.items()}
+    summaries['all'] = summary(np.concatenate([np.asarray(e, dtype=np.float64).reshape(-1)
+                                               for e in cls_errors.values()] + [np.zeros(0)]))
+    return summaries
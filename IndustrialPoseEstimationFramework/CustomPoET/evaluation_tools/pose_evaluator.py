@@ -15,8 +15,33 @@ import json
 
 from scipy import spatial
 import numpy as np
-from scipy.linalg import logm
-import numpy.linalg as LA
+
+from evaluation_tools.pose_errors import pose_errors, rotation_errors, summarize_errors
+
+
+def pose_chunks(n_poses, n_pts, max_pts=2 ** 22):
+    """
+    Splits n_poses poses into chunks of consecutive poses, such that at most max_pts transformed model points of n_pts
+    points each are held in memory at once. Yields (start, end) of each chunk.
+    """
+    chunk_size = max(1, max_pts // max(n_pts, 1))
+    for start in range(0, n_poses, chunk_size):
+        yield start, min(start + chunk_size, n_poses)
+
+
+def transform_pts_batch(pts, poses):
+    """
+    Applies each of the rigid transformations poses (n_poses x 3 x 4) to the 3D points pts (n_pts x 3) at once.
+    Returns the n_poses x n_pts x 3 transformed points.
+    """
+    return np.einsum('nij,pj->npi', poses[:, :, :3], pts, optimize=True) + poses[:, None, :, 3]
+
+
+def count_below(sorted_errors, thresholds):
+    """
+    Number of errors strictly below each of the thresholds, given the errors in ascending order.
+    """
+    return np.searchsorted(sorted_errors, thresholds, side='left')
 
 
 class PoseEvaluator(object):
@@ -44,6 +69,8 @@ class PoseEvaluator(object):
         self.camera_intrinsics = {}
         self.num = {}
         self.depth_scale = depth_scale
+        # KD-trees over the model points in their canonical frame, built on demand, see get_model_tree
+        self.model_trees = {}
 
         self.reset()  # Initialize
 
@@ -115,24 +142,17 @@ class PoseEvaluator(object):
             model_pts = models[cls_name]['pts']
             n_poses = len(cls_poses_gt)
             count_all[i] = n_poses
-            for j in range(n_poses):
-                pose_pred = cls_poses_pred[j]  # est pose
-                pose_gt = cls_poses_gt[j]  # gt pose
-                if symmetry_flag:
-                    eval_method = 'adi'
-                    error = self.calc_adi(model_pts, pose_pred, pose_gt)
-                else:
-                    eval_method = 'add'
-                    error = self.calc_add(model_pts, pose_pred, pose_gt)
-                if error < threshold_002[i]:
-                    count_correct['0.02'][i] += 1
-                if error < threshold_005[i]:
-                    count_correct['0.05'][i] += 1
-                if error < threshold_010[i]:
-                    count_correct['0.10'][i] += 1
-                for thresh_i in range(num_thresh):
-                    if error < threshold_mean[i, thresh_i]:
-                        count_correct['mean'][i, thresh_i] += 1
+            if symmetry_flag:
+                eval_method = 'adi'
+                errors = self.calc_adi_batch(cls_name, cls_poses_pred, cls_poses_gt)
+            else:
+                eval_method = 'add'
+                errors = self.calc_add_batch(model_pts, cls_poses_pred, cls_poses_gt)
+            sorted_errors = np.sort(errors)
+            count_correct['0.02'][i] = count_below(sorted_errors, threshold_002[i])
+            count_correct['0.05'][i] = count_below(sorted_errors, threshold_005[i])
+            count_correct['0.10'][i] = count_below(sorted_errors, threshold_010[i])
+            count_correct['mean'][i] = count_below(sorted_errors, threshold_mean[i])
             adds_results[cls_name] = {}
             adds_results[cls_name]["threshold"] = {'0.02': count_correct['0.02'][i].tolist(),
                                                    '0.05': count_correct['0.05'][i].tolist(),
@@ -266,21 +286,12 @@ class PoseEvaluator(object):
             model_pts = models[cls_name]['pts']
             n_poses = len(cls_poses_gt)
             count_all[i] = n_poses
-            for j in range(n_poses):
-                if j%20 == 0:
-                    print('{}/{} poses'.format(j, n_poses))
-                pose_pred = cls_poses_pred[j]  # est pose
-                pose_gt = cls_poses_gt[j]  # gt pose
-                error = self.calc_adi(model_pts, pose_pred, pose_gt)
-                if error < threshold_002[i]:
-                    count_correct['0.02'][i] += 1
-                if error < threshold_005[i]:
-                    count_correct['0.05'][i] += 1
-                if error < threshold_010[i]:
-                    count_correct['0.10'][i] += 1
-                for thresh_i in range(num_thresh):
-                    if error < threshold_mean[i, thresh_i]:
-                        count_correct['mean'][i, thresh_i] += 1
+            errors = self.calc_adi_batch(cls_name, cls_poses_pred, cls_poses_gt)
+            sorted_errors = np.sort(errors)
+            count_correct['0.02'][i] = count_below(sorted_errors, threshold_002[i])
+            count_correct['0.05'][i] = count_below(sorted_errors, threshold_005[i])
+            count_correct['0.10'][i] = count_below(sorted_errors, threshold_010[i])
+            count_correct['mean'][i] = count_below(sorted_errors, threshold_mean[i])
             adi_results[cls_name] = {}
             adi_results[cls_name]["threshold"] = {'0.02': count_correct['0.02'][i].tolist(),
                                                    '0.05': count_correct['0.05'][i].tolist(),
@@ -415,19 +426,12 @@ class PoseEvaluator(object):
             model_pts = models[cls_name]['pts']
             n_poses = len(cls_poses_gt)
             count_all[i] = n_poses
-            for j in range(n_poses):
-                pose_pred = cls_poses_pred[j]  # est pose
-                pose_gt = cls_poses_gt[j]  # gt pose
-                error = self.calc_add(model_pts, pose_pred, pose_gt)
-                if error < threshold_002[i]:
-                    count_correct['0.02'][i] += 1
-                if error < threshold_005[i]:
-                    count_correct['0.05'][i] += 1
-                if error < threshold_010[i]:
-                    count_correct['0.10'][i] += 1
-                for thresh_i in range(num_thresh):
-                    if error < threshold_mean[i, thresh_i]:
-                        count_correct['mean'][i, thresh_i] += 1
+            errors = self.calc_add_batch(model_pts, cls_poses_pred, cls_poses_gt)
+            sorted_errors = np.sort(errors)
+            count_correct['0.02'][i] = count_below(sorted_errors, threshold_002[i])
+            count_correct['0.05'][i] = count_below(sorted_errors, threshold_005[i])
+            count_correct['0.10'][i] = count_below(sorted_errors, threshold_010[i])
+            count_correct['mean'][i] = count_below(sorted_errors, threshold_mean[i])
             add_results[cls_name] = {}
             add_results[cls_name]["threshold"] = {'0.02': count_correct['0.02'][i].tolist(),
                                                    '0.05': count_correct['0.05'][i].tolist(),
@@ -527,29 +531,17 @@ class PoseEvaluator(object):
         log_file.write('\n* {} *\n {:^}\n* {} *'.format('-' * 100, 'Metric Average Translation Error in Meters', '-' * 100))
         log_file.write("\n")
 
-        poses_pred = self.poses_pred
-        poses_gt = self.poses_gt
-        translation_errors = []
         cls_translation_errors = {}
+        for cls in self.classes:
+            _, errors = pose_errors(self.poses_pred[cls], self.poses_gt[cls])
+            cls_translation_errors[cls] = errors.tolist()
+        summaries = summarize_errors(cls_translation_errors)
         avg_translation_errors = {}
         for cls in self.classes:
-            cls_translation_errors[cls] = []
-            cls_poses_pred = poses_pred[cls]
-            cls_poses_gt = poses_gt[cls]
-            for pose_est, pose_gt in zip(cls_poses_pred, cls_poses_gt):
-                t_est = pose_est[:, 3]
-                t_gt = pose_gt[:, 3]
-                error = np.sqrt(np.sum(np.square((t_est - t_gt))))
-                cls_translation_errors[cls].append(error)
-                translation_errors.append(error)
-            if len(cls_translation_errors[cls]) != 0:
-                avg_error = np.sum(cls_translation_errors[cls]) / len(cls_translation_errors[cls])
-                avg_translation_errors[cls] = avg_error
-            else:
-                avg_translation_errors[cls] = np.nan
+            avg_translation_errors[cls] = summaries[cls]['mean']
             log_file.write("Class: {} \t\t {}".format(cls, avg_translation_errors[cls]))
             log_file.write("\n")
-        total_avg_error = np.sum(translation_errors) / len(translation_errors)
+        total_avg_error = summaries['all']['mean']
         log_file.write("All:\t\t\t\t\t {}".format(total_avg_error))
         avg_translation_errors["mean"] = [total_avg_error]
 
@@ -576,36 +568,17 @@ class PoseEvaluator(object):
             '\n* {} *\n {:^}\n* {} *'.format('-' * 100, 'Metric Average Rotation Error in Degrees', '-' * 100))
         log_file.write("\n")
 
-        poses_pred = copy.deepcopy(self.poses_pred)
-        poses_gt = copy.deepcopy(self.poses_gt)
-        rotation_errors = []
         cls_rotation_errors = {}
+        for cls in self.classes:
+            errors, _ = pose_errors(self.poses_pred[cls], self.poses_gt[cls])
+            cls_rotation_errors[cls] = errors.tolist()
+        summaries = summarize_errors(cls_rotation_errors)
         avg_rotation_errors = {}
-
         for cls in self.classes:
-            cls_rotation_errors[cls] = []
-            cls_pose_pred = poses_pred[cls]
-            cls_pose_gt = poses_gt[cls]
-            for pose_est, pose_gt in zip(cls_pose_pred, cls_pose_gt):
-                rot_est = pose_est[:3, :3]
-                rot_gt = pose_gt[:3, :3]
-                rot = np.matmul(rot_est, rot_gt.T)
-                trace = np.trace(rot)
-                if trace < -1.0:
-                    trace = -1
-                elif trace > 3.0:
-                    trace = 3.0
-                angle_diff = np.degrees(np.arccos(0.5 * (trace - 1)))
-                cls_rotation_errors[cls].append(angle_diff)
-                rotation_errors.append(angle_diff)
-            if len(cls_rotation_errors[cls]) != 0:
-                avg_error = np.sum(cls_rotation_errors[cls]) / len(cls_rotation_errors[cls])
-                avg_rotation_errors[cls] = avg_error
-            else:
-                avg_rotation_errors[cls] = np.nan
+            avg_rotation_errors[cls] = summaries[cls]['mean']
             log_file.write("Class: {} \t\t {}".format(cls, avg_rotation_errors[cls]))
             log_file.write("\n")
-        total_avg_error = np.sum(rotation_errors) / len(rotation_errors)
+        total_avg_error = summaries['all']['mean']
         log_file.write("All:\t\t\t\t\t {}".format(total_avg_error))
         avg_rotation_errors["mean"] = [total_avg_error]
 
@@ -739,6 +712,58 @@ class PoseEvaluator(object):
         error = nn_dists.mean()
         return error
 
+    def get_model_tree(self, cls_name):
+        """
+        KD-tree over the points of the 3D model of class cls_name in the model frame. It is built only once per model.
+        """
+        if cls_name not in self.model_trees:
+            self.model_trees[cls_name] = spatial.cKDTree(self.models[cls_name]['pts'])
+        return self.model_trees[cls_name]
+
+    def calc_add_batch(self, pts, poses_pred, poses_gt):
+        """
+        Vectorized calc_add for many poses of the same model.
+
+        :param pts: nx3 ndarray with 3D model points.
+        :param poses_pred: Estimated poses, sequence of n_poses 3x4 [R|t] matrices.
+        :param poses_gt: GT poses, sequence of n_poses 3x4 [R|t] matrices.
+        :return: n_poses ndarray with the mean average error of each pose.
+        """
+        poses_pred = np.asarray(poses_pred, dtype=np.float64).reshape(-1, 3, 4)
+        poses_gt = np.asarray(poses_gt, dtype=np.float64).reshape(-1, 3, 4)
+        errors = np.zeros(len(poses_pred))
+        for start, end in pose_chunks(len(poses_pred), len(pts)):
+            pts_est = transform_pts_batch(pts, poses_pred[start:end])
+            pts_gt = transform_pts_batch(pts, poses_gt[start:end])
+            errors[start:end] = np.linalg.norm(pts_est - pts_gt, axis=2).mean(axis=1)
+        return errors
+
+    def calc_adi_batch(self, cls_name, poses_pred, poses_gt):
+        """
+        Vectorized calc_adi for many poses of the model of class cls_name.
+
+        Instead of building a KD-tree over the model points transformed by each estimated pose, the GT points are
+        mapped into the model frame of the estimated pose, R_pred^T (pts_gt - t_pred), and queried against the KD-tree
+        of the model, which yields the same nearest neighbor distances for orthonormal rotations.
+
+        :param cls_name: Class whose model points are used.
+        :param poses_pred: Estimated poses, sequence of n_poses 3x4 [R|t] matrices.
+        :param poses_gt: GT poses, sequence of n_poses 3x4 [R|t] matrices.
+        :return: n_poses ndarray with the mean average error reduced by symmetry of each pose.
+        """
+        pts = self.models[cls_name]['pts']
+        tree = self.get_model_tree(cls_name)
+        poses_pred = np.asarray(poses_pred, dtype=np.float64).reshape(-1, 3, 4)
+        poses_gt = np.asarray(poses_gt, dtype=np.float64).reshape(-1, 3, 4)
+        errors = np.zeros(len(poses_pred))
+        for start, end in pose_chunks(len(poses_pred), len(pts)):
+            pts_gt = transform_pts_batch(pts, poses_gt[start:end])
+            pts_model = np.einsum('nji,npj->npi', poses_pred[start:end, :, :3],
+                                  pts_gt - poses_pred[start:end, None, :, 3], optimize=True)
+            nn_dists, _ = tree.query(pts_model.reshape(-1, 3), k=1, workers=-1)
+            errors[start:end] = nn_dists.reshape(end - start, -1).mean(axis=1)
+        return errors
+
     def calc_rotation_error(self, rot_pred, r_gt):
         """
         Calculate the angular geodesic rotation error between a predicted rotation matrix and the ground truth matrix.
@@ -746,9 +771,7 @@ class PoseEvaluator(object):
         :param rot_gt: Ground truth rotation matrix (3x3)
         """
         assert (rot_pred.shape == r_gt.shape == (3, 3))
-        temp = logm(np.dot(np.transpose(rot_pred), r_gt))
-        rd_rad = LA.norm(temp, 'fro') / np.sqrt(2)
-        rd_deg = rd_rad / np.pi * 180
+        rd_deg = rotation_errors(rot_pred[None], r_gt[None])[0]
         return rd_deg
 
 
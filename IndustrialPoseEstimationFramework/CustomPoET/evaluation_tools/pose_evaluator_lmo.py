@@ -623,56 +623,83 @@ class PoseEvaluatorLMO(object):
         """
         Project 3D points onto the image plane and create a depth image by storing z at each pixel
         """
+        return self.calc_depth_imgs(pts, [rot], [t], K, w=w, h=h)[0]
+
+    def calc_depth_imgs(self, pts, rots, ts, K, w=640, h=480):
+        """
+        Project the 3D points in several poses onto the image plane at once and create a depth image per pose, storing
+        the minimal z at each pixel. Holes inside the projected object are filled afterwards (see fill_depth_holes).
+
+        :param pts: nx3 ndarray with 3D points.
+        :param rots: m 3x3 rotation matrices.
+        :param ts: m 3x1 translation vectors.
+        :param K: 3x3 intrinsic matrix
+        :return: mxhxw ndarray with the depth images, 0 where no point was projected.
+        """
         assert (pts.shape[1] == 3)
         if K.shape == (9,):
             K = K.reshape(3, 3)
-        pts_t = rot.dot(pts.T) + t.reshape((3, 1))  # 3xn
-        pts_c_t = K.dot(pts_t)
-        n = pts.shape[0]
-        pts_2d = np.zeros((n, 2))
-        pts_2d[:, 0] = pts_c_t[0, :] / pts_c_t[2, :]
-        pts_2d[:, 1] = pts_c_t[1, :] / pts_c_t[2, :]
-
-        pts_2d = pts_2d.astype(np.int)
-
-        depth_img = np.zeros((h, w))
+        n_poses = len(rots)
+        pixels = []
+        depths = []
+        for p, (rot, t) in enumerate(zip(rots, ts)):
+            pts_t = rot.dot(pts.T) + t.reshape((3, 1))  # 3xn
+            pts_c_t = K.dot(pts_t)
+            z = pts_c_t[2, :]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                u = pts_c_t[0, :] / z
+                v = pts_c_t[1, :] / z
+            # Pixel coordinates are truncated towards zero, i.e. a point is inside the image for -1 < u < w
+            inside = (u > -1) & (u < w) & (v > -1) & (v < h)
+            pixels.append((p * h + v[inside].astype(int)) * w + u[inside].astype(int))
+            depths.append(z[inside])
+
+        # Z-buffer: keep the closest point per pixel
+        depth_imgs = np.full(n_poses * h * w, np.inf)
+        np.minimum.at(depth_imgs, np.concatenate(pixels), np.concatenate(depths))
+        depth_imgs[np.isinf(depth_imgs)] = 0
+        depth_imgs = depth_imgs.reshape((n_poses, h, w))
+        self.fill_depth_holes(depth_imgs)
+        return depth_imgs
+
+    def fill_depth_holes(self, depth_imgs):
+        """
+        Filter the depth images in-place to fill black holes in the projected objects. Every zero pixel between the first
+        and the last object pixel of its row is set to the average of its non-zero 8-neighbours. The pixels are
+        filled in raster order, so the neighbours above and to the left may themselves be filled holes. Such a
+        neighbour has a smaller 2 * row + col, so all holes with the same 2 * row + col are independent and are filled
+        at once, going through the images in order of 2 * row + col.
 
-        for pt_2d, z in zip(pts_2d, pts_c_t[2, :]):
-            u = pt_2d[0]
-            v = pt_2d[1]
-            # Check if current object point is inside image
-            if u < 0 or u >= w or v < 0 or v >= h:
-                continue
-            # Check if the depth at current pixel is zero:
-            if depth_img[v, u] == 0:
-                depth_img[v, u] = z
-            elif depth_img[v, u] > z:
-                depth_img[v, u] = z
-            else:
-                continue
-        # Filter image to fill black holes in the projected object
-        for i, row in enumerate(depth_img):
-            obj_pixels = row.nonzero()[0]
-            if len(obj_pixels) == 0:
-                continue
-            for j in range(obj_pixels[0], obj_pixels[-1]):
-                if row[j] == 0:
-                    # Average over surrounding pixels
-                    values = []
-                    for l in [-1, 0, 1]:
-                        for k in [-1, 0, 1]:
-                            if l == 0 and k == 0:
-                                continue
-                            if (i + l) >= h or (i + l) < 0:
-                                continue
-                            if (j + k) >= w or (j + k) < 0:
-                                continue
-                            if depth_img[i+l, j+k] == 0:
-                                continue
-                            values.append(depth_img[i+l, j+k])
-                    if len(values) != 0:
-                        depth_img[i, j] = sum(values) / len(values)
-        return depth_img
+        :param depth_imgs: mxhxw ndarray with depth images.
+        """
+        n_poses, h, w = depth_imgs.shape
+        obj_pixels = depth_imgs != 0
+        first = obj_pixels.argmax(axis=2)
+        last = w - 1 - obj_pixels[:, :, ::-1].argmax(axis=2)
+        cols = np.arange(w)
+        holes = ~obj_pixels & (cols >= first[:, :, None]) & (cols < last[:, :, None])
+        holes &= obj_pixels.any(axis=2)[:, :, None]
+        p, i, j = holes.nonzero()
+        if len(p) == 0:
+            return
+
+        # Zero padding, such that neighbours outside the image count as empty
+        padded = np.pad(depth_imgs, ((0, 0), (1, 1), (1, 1)))
+        flat = padded.reshape(-1)
+        front = 2 * i + j
+        order = np.argsort(front, kind='stable')
+        pixels = np.ravel_multi_index((p[order], i[order] + 1, j[order] + 1), padded.shape)
+        offsets = np.array([l * (w + 2) + k for l in [-1, 0, 1] for k in [-1, 0, 1] if l != 0 or k != 0])
+        neighbours = pixels[:, None] + offsets
+        starts = np.unique(front[order], return_index=True)[1]
+        for start, stop in zip(starts, np.append(starts[1:], len(pixels))):
+            values = flat[neighbours[start:stop]]
+            n_values = np.count_nonzero(values, axis=1)
+            # Summed up sequentially in the order of the neighbours, empty neighbours add exactly zero
+            values_sum = values.cumsum(axis=1)[:, -1]
+            filled = n_values != 0
+            flat[pixels[start:stop][filled]] = values_sum[filled] / n_values[filled]
+        depth_imgs[:] = padded[:, 1:-1, 1:-1]
 
     def proj(self, pts, pose_pred, pose_gt, K):
         '''
@@ -0,0 +1,92 @@
+# ------------------------------------------------------------------------
+# PoET: Pose Estimation Transformer for Single-View, Multi-Object 6D Pose Estimation
+# Copyright (c) 2022 Thomas Jantos (thomas.jantos@aau.at), University of Klagenfurt - Control of Networked Systems (CNS). All Rights Reserved.
+# Licensed under the BSD-2-Clause-License with no commercial use [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Packaged inference artifact of YOLO + PoET for a fast cold start.
+
+Building the model parses the Darknet cfg, constructs CNSYOLO and PoET and loads the backbone weights and the PoET
+checkpoint separately. The artifact stores the result of all of this in one file: the resolved config, the complete
+module with the inference build of the backbone (fused Conv2d + BatchNorm2d, channels_last, precomputed YOLO grids)
+and its weights. Loading it is a single torch.load, which memory-maps the file, such that the weights are only paged
+in when they are used.
+
+The artifact pickles the modules, so it has to be loaded with the same code version it was exported with. The stored
+config replaces the config file when running from the artifact: apply_artifact_config sets every setting that was not
+given on the command line.
+"""
+import time
+
+import torch
+
+from models import build_model
+
+ARTIFACT_VERSION = 1
+
+# Settings that trigger a one-off action of poet_inference.py instead of configuring the inference, never restored
+ACTION_KEYS = ('artifact', 'export_artifact', 'export_onnx')
+
+# Artifacts read for their config, kept such that loading the model onto the CPU does not read them again
+_loaded_artifacts = {}
+
+
+def export_artifact(args):
+    """
+    Builds the model given by args (weights from args.resume), applies the inference build of the backbone for
+    args.backbone_image_size and stores the artifact at args.export_artifact.
+    """
+    start_time = time.time()
+    model, _, _ = build_model(args)
+    if args.resume:
+        checkpoint = torch.load(args.resume, map_location='cpu')
+        model.load_state_dict(checkpoint['model'], strict=False)
+    model.eval()
+    model.backbone[0].prepare_inference(args.backbone_image_size, torch.device('cpu'))
+    model.shape_cache.clear()
+
+    config = {k: v for k, v in vars(args).items() if isinstance(v, (bool, int, float, str, list, tuple, type(None)))}
+    torch.save({'version': ARTIFACT_VERSION, 'config': config, 'model': model}, args.export_artifact)
+    print("Exported the inference artifact to {} in {:.2f} s".format(args.export_artifact, time.time() - start_time))
+
+
+def read_artifact(path, device):
+    """
+    Reads the artifact at path with its tensors mapped onto device and checks its version.
+    """
+    artifact = torch.load(path, map_location=device, mmap=True, weights_only=False)
+    if artifact.get('version') != ARTIFACT_VERSION:
+        raise ValueError("Unsupported inference artifact version {} (expected {})".format(artifact.get('version'),
+                                                                                         ARTIFACT_VERSION))
+    return artifact
+
+
+def apply_artifact_config(args, given):
+    """
+    Sets every setting of args stored in the config of the artifact at args.artifact, except for the ones in given,
+    i.e. the ones passed on the command line, which take precedence.
+    """
+    artifact = read_artifact(args.artifact, 'cpu')
+    _loaded_artifacts[args.artifact] = artifact
+    restored = [key for key in artifact['config'] if hasattr(args, key) and key not in given and key not in ACTION_KEYS]
+    for key in restored:
+        setattr(args, key, artifact['config'][key])
+    print("Restored {} settings from the inference artifact {}".format(len(restored), args.artifact))
+
+
+def load_artifact(path, device):
+    """
+    Loads the model and the config of the artifact at path onto device.
+    """
+    start_time = time.time()
+    device = torch.device(device)
+    if device.type == 'cpu' and path in _loaded_artifacts:
+        artifact = _loaded_artifacts.pop(path)
+    else:
+        _loaded_artifacts.pop(path, None)
+        artifact = read_artifact(path, device)
+    model = artifact['model']
+    model.eval()
+    print("Loaded the inference artifact {} in {:.2f} s".format(path, time.time() - start_time))
+    return model, artifact['config']
@@ -0,0 +1,206 @@
+# ------------------------------------------------------------------------
+# PoET: Pose Estimation Transformer for Single-View, Multi-Object 6D Pose Estimation
+# Copyright (c) 2022 Thomas Jantos (thomas.jantos@aau.at), University of Klagenfurt - Control of Networked Systems (CNS). All Rights Reserved.
+# Licensed under the BSD-2-Clause-License with no commercial use [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Multi-client live inference server. Any number of clients can connect concurrently. Frames of all clients are collected
+into dynamic micro-batches, which are passed through a single shared PoET instance with one forward pass per batch.
+The result of each frame is routed back to the client it originates from.
+"""
+import asyncio
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+import inference_tools.frame_protocol as protocol
+from inference_tools.dataset import StreamInput
+from util.latency import measure
+
+
+class BatchInferenceServer(object):
+    """
+    asyncio based server that batches the frames of all connected clients.
+
+    A batch is closed as soon as it contains max_batch_size frames or max_delay seconds passed since its first frame
+    arrived. The model runs in a dedicated worker thread, such that the event loop keeps accepting connections and
+    receiving frames while a batch is processed.
+
+    Messages follow the frame protocol. decode_frame(header, payload) turns a received frame message into the BGR
+    frame passed to the model and encode_response(config, header, frame, outputs, n_boxes, received, inferred) returns
+    the message sent back, given the settings the client requested in its handshake. received and inferred are the
+    timestamps at which the frame was received and the forward pass of its batch finished.
+
+    If a latency monitor is given, the duration of the stages of every frame is reported to it.
+    """
+    def __init__(self, model, device, decode_frame, encode_response, max_batch_size=4, max_delay=0.01,
+                 max_frames_in_flight=2, latency=None):
+        self.model = model
+        self.device = device
+        self.decode_frame = decode_frame
+        self.encode_response = encode_response
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_frames_in_flight = max_frames_in_flight
+        self.latency = latency
+        self.stream_input = StreamInput(device)
+        self.model_executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.n_clients = 0
+
+    async def serve(self, host='0.0.0.0', port=9999):
+        self.pending = asyncio.Queue()
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print("Waiting for connections on {}:{}".format(host, port))
+        batcher = asyncio.ensure_future(self.batch_loop())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.model_executor.shutdown()
+
+    async def handle_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        self.n_clients += 1
+        print("Connected to: {} ({} clients)".format(addr, self.n_clients))
+
+        # Results are sent back in the order the frames were received. The semaphore limits the number of frames a
+        # single client can have in flight, the queue itself is unbounded such that the end of the stream can always be
+        # signaled to the sender without blocking.
+        results = asyncio.Queue()
+        in_flight = asyncio.Semaphore(self.max_frames_in_flight)
+        sender = None
+        loop = asyncio.get_running_loop()
+        try:
+            message = await self.read_message(reader)
+            if message is not None:
+                config = protocol.parse_hello(*message)
+                writer.write(protocol.hello_message(config))
+                sender = asyncio.ensure_future(self.send_loop(writer, results, in_flight, config))
+            while sender is not None:
+                message = await self.read_message(reader)
+                if message is None:
+                    break
+                header, payload = message
+                received = time.time()
+                started = time.perf_counter()
+                frame = await loop.run_in_executor(None, self.timed, 'decode', self.decode_frame, header, payload)
+                result = loop.create_future()
+                await in_flight.acquire()
+                results.put_nowait((header, frame, received, started, result))
+                await self.pending.put((frame, result))
+        except (ConnectionError, protocol.ProtocolError) as e:
+            print("Connection to {} failed: {}".format(addr, e))
+        finally:
+            if sender is not None:
+                results.put_nowait(None)
+                await sender
+            writer.close()
+            self.n_clients -= 1
+            print("Disconnected: {} ({} clients)".format(addr, self.n_clients))
+
+    async def send_loop(self, writer, results, in_flight, config):
+        # Runs until the handler signals the end of the stream. If sending fails, the connection is closed, which ends
+        # the handler as well, and the remaining results are discarded. The queue is drained in any case, such that the
+        # handler never waits for a free slot that is not released.
+        loop = asyncio.get_running_loop()
+        connected = True
+        while True:
+            item = await results.get()
+            if item is None:
+                break
+            header, frame, received, started, result = item
+            try:
+                outputs, n_boxes, inferred = await result
+                if not connected:
+                    continue
+                message = await loop.run_in_executor(None, self.encode_response, config, header, frame, outputs,
+                                                     n_boxes, received, inferred)
+                with measure(self.latency, 'send'):
+                    writer.write(message)
+                    await writer.drain()
+                if self.latency is not None:
+                    self.latency.frame_done(started)
+            except ConnectionError:
+                connected = False
+                writer.close()
+            except Exception as e:
+                print("Failed to process frame: {}".format(e))
+            finally:
+                in_flight.release()
+
+    def timed(self, stage, fn, *args):
+        with measure(self.latency, stage):
+            return fn(*args)
+
+    @staticmethod
+    async def read_message(reader):
+        """
+        Returns the next message as a tuple (header, payload) or None if the connection was closed.
+        """
+        try:
+            header = protocol.unpack_header(await reader.readexactly(protocol.HEADER.size))
+            payload = await reader.readexactly(header.payload_length)
+        except asyncio.IncompleteReadError:
+            return None
+        return header, payload
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.pending.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.pending.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            frames = [frame for frame, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.model_executor, self.forward_batch, frames)
+            except Exception as e:
+                for _, result in batch:
+                    if not result.done():
+                        result.set_exception(e)
+                continue
+            inferred = time.time()
+            for (_, result), (outputs, n_boxes) in zip(batch, results):
+                if not result.done():
+                    result.set_result((outputs, n_boxes, inferred))
+
+    def forward_batch(self, frames):
+        """
+        Run PoET once per batch and split the outputs per frame. Frames of different size can not be stacked into a
+        single tensor, hence one forward pass is performed per distinct frame size.
+        Returns a list of (outputs, n_boxes) per frame, where outputs has a leading batch dimension of 1.
+        """
+        groups = defaultdict(list)
+        for i, frame in enumerate(frames):
+            groups[frame.shape].append(i)
+
+        results = [None] * len(frames)
+        keys = ['pred_translation', 'pred_rotation', 'pred_boxes', 'pred_classes']
+        with torch.no_grad():
+            for indices in groups.values():
+                with measure(self.latency, 'preprocess'):
+                    samples = self.stream_input([frames[i] for i in indices])
+                outputs, n_boxes_per_sample = self.model(samples, None)
+                outputs = {k: outputs[k].cpu() for k in keys}
+                for b, i in enumerate(indices):
+                    results[i] = ({k: v[b:b + 1] for k, v in outputs.items()}, n_boxes_per_sample[b])
+        return results
+
+
+def serve_multi_client(model, device, decode_frame, encode_response, max_batch_size, max_delay, host='0.0.0.0',
+                       port=9999, latency=None):
+    server = BatchInferenceServer(model, device, decode_frame, encode_response, max_batch_size, max_delay,
+                                  latency=latency)
+    asyncio.run(server.serve(host, port))
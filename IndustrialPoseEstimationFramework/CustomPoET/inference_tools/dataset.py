@@ -12,6 +12,7 @@
 # ------------------------------------------------------------------------
 
 import re
+import torch
 import torchvision.transforms.functional as F
 from torchvision.datasets.vision import VisionDataset
 from pathlib import Path
@@ -19,6 +20,8 @@ from PIL import Image
 from os import listdir
 from os.path import isfile, join
 
+from util.misc import NestedTensor
+
 
 class InferenceDataset(VisionDataset):
     """
@@ -51,14 +54,58 @@ class InferenceDataset(VisionDataset):
         else:
             img_path = self.image_paths[index]
         
+        # The image is returned as uint8 tensor, which keeps the transfer from the dataloader workers and to the device
+        # small. It has to be converted to [0, 1] before it is passed to PoET.
         img = self.get_image(img_path, mode="RGB")
-        img = F.to_tensor(img)
+        img = F.pil_to_tensor(img)
         return img, None
 
     def __len__(self):
         return len(self.image_paths)
 
 
+class StreamInput:
+    """
+    Input buffer for PoET streaming inference.
+    Decoded frames are copied straight into a preallocated image tensor on the inference device, which is wrapped
+    together with a constant (all valid) padding mask into a NestedTensor. Contrary to the InferenceDataset, no file
+    is written or read and no DataLoader is involved per frame. The buffers are only reallocated if the frame size
+    changes or a larger batch than before is requested.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.tensors = None
+        self.mask = None
+
+    def allocate(self, batch_size, height, width):
+        self.tensors = torch.empty((batch_size, 3, height, width), dtype=torch.float32, device=self.device)
+        self.mask = torch.zeros((batch_size, height, width), dtype=torch.bool, device=self.device)
+
+    def __call__(self, frames):
+        """
+        Args:
+            frames (np.ndarray or list): BGR image of shape [H x W x 3] and type uint8, as decoded by OpenCV, or a list
+            of such images that all share the same size
+        Returns:
+            NestedTensor containing the RGB images normalized to [0, 1], equivalent to the converted InferenceDataset
+            output
+        """
+        if not isinstance(frames, (list, tuple)):
+            frames = [frames]
+        batch_size = len(frames)
+        height, width, _ = frames[0].shape
+        if self.tensors is None or self.tensors.shape[-2:] != (height, width) or self.tensors.shape[0] < batch_size:
+            self.allocate(batch_size, height, width)
+        tensors = self.tensors[:batch_size]
+        for i, frame in enumerate(frames):
+            # Transfer the uint8 image and convert it on the device: BGR -> RGB, HWC -> CHW
+            img = torch.from_numpy(frame).to(self.device, non_blocking=True)
+            tensors[i].copy_(img.permute(2, 0, 1).flip(0))
+        # [0, 255] -> [0, 1]
+        tensors.div_(255)
+        return NestedTensor(tensors, self.mask[:batch_size])
+
+
 def build_dataset(args):
     root = Path(args.inference_path)
     dataset = InferenceDataset(root)
@@ -0,0 +1,415 @@
+# ------------------------------------------------------------------------
+# PoET: Pose Estimation Transformer for Single-View, Multi-Object 6D Pose Estimation
+# Copyright (c) 2022 Thomas Jantos (thomas.jantos@aau.at), University of Klagenfurt - Control of Networked Systems (CNS). All Rights Reserved.
+# Licensed under the BSD-2-Clause-License with no commercial use [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Binary frame transport between the live inference servers and their clients.
+
+Every message consists of a fixed-size header followed by a payload:
+
+    magic (4s) | version (B) | message type (B) | codec (B) | pixel format (B) | frame id (I) | timestamp (d) |
+    width (H) | height (H) | payload length (I)
+
+All fields are little-endian. A connection starts with a HELLO message of the client, in which it requests the codec
+of the images sent back by the server and whether the server should respond with annotated images or with the pose
+results only. The server answers with a HELLO message containing the accepted settings. Afterwards the client sends
+FRAME messages and the server responds to each processed frame with a FRAME or POSES message carrying the same frame id
+and timestamp.
+
+The payload of a POSES message starts with the server-side timestamps of the frame (received, model forward pass done,
+response sent), followed by one fixed-layout record per detected object.
+
+This module only depends on numpy and OpenCV, such that it can be used by the clients on the host machine as well.
+"""
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+MAGIC = b'PoET'
+VERSION = 2
+
+# Message types
+MSG_HELLO = 0
+MSG_FRAME = 1
+MSG_POSES = 2
+
+# Payload codecs
+CODEC_RAW = 0
+CODEC_JPEG = 1
+CODEC_PNG = 2
+CODECS = {'raw': CODEC_RAW, 'jpeg': CODEC_JPEG, 'png': CODEC_PNG}
+
+# Pixel formats of raw payloads. Encoded payloads always decode to BGR.
+PIXEL_BGR = 0
+PIXEL_RGB = 1
+PIXEL_BGRA = 2
+PIXEL_GRAY = 3
+PIXEL_CHANNELS = {PIXEL_BGR: 3, PIXEL_RGB: 3, PIXEL_BGRA: 4, PIXEL_GRAY: 1}
+
+# Server responses
+RESPONSE_IMAGE = 0
+RESPONSE_POSES = 1
+RESPONSES = {'image': RESPONSE_IMAGE, 'poses': RESPONSE_POSES}
+
+HEADER = struct.Struct('<4sBBBBIdHHI')
+# Upper limit of the payload length accepted from the peer, which bounds the buffer allocated for a message. Large
+# enough for raw BGRA frames of 4096x4096 pixels.
+MAX_PAYLOAD = 64 * 1024 * 1024
+HELLO = struct.Struct('<BBB')
+POSES_TIMESTAMPS = struct.Struct('<ddd')
+
+FrameHeader = namedtuple('FrameHeader', ['msg_type', 'codec', 'pixel_format', 'frame_id', 'timestamp', 'width',
+                                         'height', 'payload_length'])
+
+# Settings negotiated per connection. codec and quality apply to the images sent back by the server.
+StreamConfig = namedtuple('StreamConfig', ['codec', 'response', 'quality'])
+DEFAULT_CONFIG = StreamConfig(CODEC_JPEG, RESPONSE_IMAGE, 90)
+
+# Fixed layout of a single pose record. The box is normalized (cx, cy, w, h) w.r.t. the width and height in the header.
+POSE_DTYPE = np.dtype([('cls', '<i4'), ('box', '<f4', (4,)), ('rotation', '<f4', (3, 3)), ('translation', '<f4', (3,))])
+
+# Content of a POSES message. The timestamps are taken with time.time() on the server.
+PoseResult = namedtuple('PoseResult', ['received', 'inferred', 'sent', 'poses'])
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack_header(msg_type, payload_length, frame_id=0, timestamp=0.0, width=0, height=0, pixel_format=PIXEL_BGR,
+                codec=CODEC_RAW):
+    return HEADER.pack(MAGIC, VERSION, msg_type, codec, pixel_format, frame_id, timestamp, width, height,
+                       payload_length)
+
+
+def unpack_header(data):
+    magic, version, msg_type, codec, pixel_format, frame_id, timestamp, width, height, payload_length = \
+        HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ProtocolError("Invalid message, unexpected magic {}".format(magic))
+    if version != VERSION:
+        raise ProtocolError("Unsupported protocol version {} (expected {})".format(version, VERSION))
+    if payload_length > MAX_PAYLOAD:
+        raise ProtocolError("Payload of {} bytes exceeds the limit of {} bytes".format(payload_length, MAX_PAYLOAD))
+    return FrameHeader(msg_type, codec, pixel_format, frame_id, timestamp, width, height, payload_length)
+
+
+def pack_message(msg_type, payload=b'', **kwargs):
+    """
+    Returns the header followed by the payload. Header and payload are sent with a single call, as sending a small
+    header on its own can be delayed by Nagle's algorithm.
+    """
+    return pack_header(msg_type, len(payload), **kwargs) + payload
+
+
+def recv_into(sock, view):
+    """
+    Fill the memoryview with data received from the socket. Returns False if the connection was closed before.
+    """
+    while len(view) > 0:
+        n = sock.recv_into(view)
+        if n == 0:
+            return False
+        view = view[n:]
+    return True
+
+
+def recv_exact(sock, size):
+    """
+    Receive exactly size bytes into a new buffer. Returns None if the connection was closed before.
+    """
+    data = bytearray(size)
+    if not recv_into(sock, memoryview(data)):
+        return None
+    return data
+
+
+def receive_message(sock):
+    """
+    Receive a single message. Returns a tuple (header, payload) or None if the connection was closed. Never reads beyond
+    the end of the message.
+    """
+    data = recv_exact(sock, HEADER.size)
+    if data is None:
+        return None
+    header = unpack_header(data)
+    payload = recv_exact(sock, header.payload_length)
+    if payload is None:
+        return None
+    return header, payload
+
+
+class FrameReceiver(object):
+    """
+    Receives messages directly into a ring of preallocated buffers, which avoids allocating and copying the payload of
+    every frame. This matters for high resolution frames, which are several MB each.
+
+    The payload is returned as a memoryview into one of the n_buffers buffers. A buffer is overwritten n_buffers
+    messages later, hence the payload has to be decoded before that, i.e. at most n_buffers - 1 payloads may still be
+    in use while the next message is received. Buffers grow to the largest payload received so far.
+    """
+    def __init__(self, sock, n_buffers=2):
+        self.sock = sock
+        self.header = bytearray(HEADER.size)
+        self.buffers = [bytearray() for _ in range(n_buffers)]
+        self.index = 0
+
+    def receive(self):
+        """
+        Receive the next message. Returns a tuple (header, payload) or None if the connection was closed.
+        """
+        if not recv_into(self.sock, memoryview(self.header)):
+            return None
+        header = unpack_header(self.header)
+
+        buffer = self.buffers[self.index]
+        if len(buffer) < header.payload_length:
+            buffer = self.buffers[self.index] = bytearray(header.payload_length)
+        self.index = (self.index + 1) % len(self.buffers)
+
+        payload = memoryview(buffer)[:header.payload_length]
+        if not recv_into(self.sock, payload):
+            return None
+        return header, payload
+
+
+class PooledFrameReceiver(object):
+    """
+    Receives messages into buffers taken from a free list, for consumers that hold an unbounded number of payloads at
+    once, e.g. a pipeline whose queues drop frames while a frame is decoded. A payload stays valid until its buffer is
+    handed back with release(), no matter how many messages were received in the meantime. If no buffer is free, a new
+    one is allocated, hence every payload has to be released once it was decoded or dropped.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.header = bytearray(HEADER.size)
+        self.free = []
+        self.lock = threading.Lock()
+
+    def receive(self):
+        """
+        Receive the next message. Returns a tuple (header, payload) or None if the connection was closed.
+        """
+        if not recv_into(self.sock, memoryview(self.header)):
+            return None
+        header = unpack_header(self.header)
+
+        with self.lock:
+            buffer = self.free.pop() if self.free else bytearray()
+        if len(buffer) < header.payload_length:
+            buffer = bytearray(header.payload_length)
+
+        payload = memoryview(buffer)[:header.payload_length]
+        if not recv_into(self.sock, payload):
+            return None
+        return header, payload
+
+    def release(self, payload):
+        """
+        Hand the buffer of a payload returned by receive() back for the following messages. Can be called from any
+        thread.
+        """
+        with self.lock:
+            self.free.append(payload.obj)
+
+
+class LatestFrameReader(threading.Thread):
+    """
+    Background reader for the latest-frame-wins receive mode. The socket is read continuously and only the newest
+    message is kept, older messages that have not been consumed yet are discarded and counted in dropped. If the
+    consumer is slower than the sender, it always works on the freshest frame instead of an ever growing backlog.
+
+    The messages are received into three buffers that are rotated (triple buffering): one is held by the consumer, one
+    contains the newest message and one is written by the reader. get() releases the message returned by the previous
+    call, hence the consumer has to be done with a payload before it requests the next one.
+    """
+    def __init__(self, sock):
+        super().__init__(name='latest-frame-reader', daemon=True)
+        self.sock = sock
+        self.free = [bytearray(), bytearray(), bytearray()]
+        self.latest = None
+        self.held = None
+        self.closed = False
+        self.received = 0
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+    def run(self):
+        header_buffer = bytearray(HEADER.size)
+        try:
+            while recv_into(self.sock, memoryview(header_buffer)):
+                header = unpack_header(header_buffer)
+                with self.cond:
+                    buffer = self.free.pop()
+                if len(buffer) < header.payload_length:
+                    buffer = bytearray(header.payload_length)
+                if not recv_into(self.sock, memoryview(buffer)[:header.payload_length]):
+                    break
+                with self.cond:
+                    if self.latest is not None:
+                        self.free.append(self.latest[1])
+                        self.dropped += 1
+                    self.latest = (header, buffer)
+                    self.received += 1
+                    self.cond.notify()
+        except (OSError, ProtocolError) as e:
+            print("Frame reader stopped: {}".format(e))
+        finally:
+            with self.cond:
+                self.closed = True
+                self.cond.notify_all()
+
+    def get(self):
+        """
+        Returns the newest message (header, payload) that has not been returned before. Blocks until a new message
+        arrived and returns None once the connection was closed.
+        """
+        with self.cond:
+            if self.held is not None:
+                self.free.append(self.held)
+                self.held = None
+            while self.latest is None and not self.closed:
+                self.cond.wait()
+            if self.latest is None:
+                return None
+            header, self.held = self.latest
+            self.latest = None
+            return header, memoryview(self.held)[:header.payload_length]
+
+
+def encode_image(frame, codec, quality=90):
+    """
+    Encode a BGR (or grayscale) frame. Returns the payload and the pixel format of the frame.
+    """
+    pixel_format = PIXEL_GRAY if frame.ndim == 2 else PIXEL_BGR
+    if codec == CODEC_RAW:
+        return np.ascontiguousarray(frame).tobytes(), pixel_format
+    if codec == CODEC_JPEG:
+        ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    elif codec == CODEC_PNG:
+        ok, buffer = cv2.imencode('.png', frame, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    else:
+        raise ProtocolError("Unknown codec {}".format(codec))
+    if not ok:
+        raise ProtocolError("Failed to encode the frame")
+    return buffer.tobytes(), pixel_format
+
+
+def decode_image(header, payload):
+    """
+    Decode the payload of a FRAME message into a BGR frame. The payload can be any buffer (bytes, bytearray or
+    memoryview), it is decoded in-place without copying it first. The returned frame never shares memory with the
+    payload, such that the buffer can be reused.
+    """
+    if header.codec == CODEC_RAW:
+        if header.pixel_format not in PIXEL_CHANNELS:
+            raise ProtocolError("Unknown pixel format {}".format(header.pixel_format))
+        channels = PIXEL_CHANNELS[header.pixel_format]
+        if len(payload) != header.width * header.height * channels:
+            raise ProtocolError("Raw payload of {} bytes does not match a {}x{} frame with {} channels".format(
+                len(payload), header.width, header.height, channels))
+        frame = np.frombuffer(payload, np.uint8).reshape(header.height, header.width, channels)
+        if header.pixel_format == PIXEL_RGB:
+            return cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+        if header.pixel_format == PIXEL_BGRA:
+            return cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+        if header.pixel_format == PIXEL_GRAY:
+            return cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        # The payload buffer is reused for the following messages
+        return frame.copy()
+    if header.codec in (CODEC_JPEG, CODEC_PNG):
+        frame = cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            raise ProtocolError("Failed to decode the frame")
+        return frame
+    raise ProtocolError("Unknown codec {}".format(header.codec))
+
+
+def frame_message(frame, frame_id=0, timestamp=0.0, codec=CODEC_JPEG, quality=90):
+    payload, pixel_format = encode_image(frame, codec, quality)
+    height, width = frame.shape[:2]
+    return pack_message(MSG_FRAME, payload, frame_id=frame_id, timestamp=timestamp, width=width, height=height,
+                        pixel_format=pixel_format, codec=codec)
+
+
+def send_frame(sock, frame, frame_id=0, timestamp=0.0, codec=CODEC_JPEG, quality=90):
+    sock.sendall(frame_message(frame, frame_id, timestamp, codec, quality))
+
+
+def encode_poses(classes, boxes, rotations, translations):
+    """
+    Pack the pose results of a single frame into fixed-layout records. Expects numpy arrays of shape (n,), (n, 4),
+    (n, 3, 3) and (n, 3).
+    """
+    records = np.empty(len(classes), dtype=POSE_DTYPE)
+    records['cls'] = classes
+    records['box'] = boxes
+    records['rotation'] = rotations
+    records['translation'] = translations
+    return records.tobytes()
+
+
+def decode_poses(payload):
+    """
+    Returns the content of a POSES message as PoseResult. The poses are a numpy structured array with the fields of
+    POSE_DTYPE, which is a view of the payload.
+    """
+    received, inferred, sent = POSES_TIMESTAMPS.unpack_from(payload)
+    poses = np.frombuffer(payload, dtype=POSE_DTYPE, offset=POSES_TIMESTAMPS.size)
+    return PoseResult(received, inferred, sent, poses)
+
+
+def poses_message(records, frame_id=0, timestamp=0.0, width=0, height=0, received=0.0, inferred=0.0):
+    """
+    Build a POSES message from the records returned by encode_poses. received and inferred are the server-side
+    timestamps at which the frame was received and the forward pass finished, the send timestamp is taken here.
+    """
+    payload = POSES_TIMESTAMPS.pack(received, inferred, time.time()) + records
+    return pack_message(MSG_POSES, payload, frame_id=frame_id, timestamp=timestamp, width=width, height=height)
+
+
+def hello_message(config):
+    return pack_message(MSG_HELLO, HELLO.pack(config.codec, config.response, config.quality))
+
+
+def request_stream(sock, config=DEFAULT_CONFIG):
+    """
+    Client side of the handshake. Sends the requested settings and returns the settings accepted by the server.
+    """
+    sock.sendall(hello_message(config))
+    message = receive_message(sock)
+    if message is None:
+        raise ProtocolError("Connection closed during the handshake")
+    return parse_hello(*message)
+
+
+def accept_stream(sock):
+    """
+    Server side of the handshake. Receives the settings requested by the client and confirms them. Returns None if the
+    connection was closed.
+    """
+    message = receive_message(sock)
+    if message is None:
+        return None
+    config = parse_hello(*message)
+    sock.sendall(hello_message(config))
+    return config
+
+
+def parse_hello(header, payload):
+    if header.msg_type != MSG_HELLO:
+        raise ProtocolError("Expected a HELLO message, received message type {}".format(header.msg_type))
+    if len(payload) != HELLO.size:
+        raise ProtocolError("Invalid HELLO payload of {} bytes (expected {})".format(len(payload), HELLO.size))
+    config = StreamConfig(*HELLO.unpack(payload))
+    if config.codec not in CODECS.values():
+        raise ProtocolError("Unknown codec {}".format(config.codec))
+    if config.response not in RESPONSES.values():
+        raise ProtocolError("Unknown response mode {}".format(config.response))
+    return config
@@ -17,172 +17,340 @@ import util.misc as utils
 import cv2
 import numpy as np
 import os
-import pickle
-import struct
 import socket
-from pathlib import Path
-import shutil
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from data_utils.data_prefetcher import data_prefetcher
 from models import build_model
-from inference_tools.dataset import build_dataset
+import inference_tools.frame_protocol as protocol
+from inference_tools.artifact import load_artifact
+from inference_tools.dataset import build_dataset, StreamInput
+from inference_tools.live_pipeline import LivePipeline
+from inference_tools.onnx_backend import OnnxPoET
+from inference_tools.pose_tracker import PoseTracker
+from inference_tools.rendering import draw_axes, draw_poses
+from inference_tools.batch_server import serve_multi_client
+from util.latency import attach, build_latency_monitor, measure
 from torch.utils.data import DataLoader, SequentialSampler
 
-def draw_axes(img, center, rot, scale=50):
-    # Define unit vectors for axes in 3D
-    axes = np.array([[scale, 0, 0], [0, scale, 0], [0, 0, scale]])
-    point_center = np.array([center[0], center[1], 0])  # Add a dummy zero for the 3D center
-
-    # Colors for the axes: Red for X, Green for Y, Blue for Z
-    colors = [(0, 0, 255), (0, 255, 0), (255, 0, 0)]
-
-    # Transform axes using the rotation matrix
-    transformed_axes = rot.dot(axes.T).T
-
-    for i, color in enumerate(colors):
-        # Calculate the end point of each axis in 3D, then drop the z-component to project it to 2D
-        axis_end = point_center + transformed_axes[i]
-        cv2.line(img, tuple(point_center[:2].astype(int)), tuple(axis_end[:2].astype(int)), color, 2)
-
 
+def write_annotated_image(path, image, boxes, rotations, height, width):
+    """
+    Draw the predictions onto the image and store the image. image is the RGB uint8 [3 x H x W] tensor as passed to
+    PoET, possibly padded to the size of the batch. The boxes are normalized w.r.t. the padded size, hence they are drawn
+    onto the padded image, which is cropped to the original size (height, width) afterwards.
+    """
+    img = np.ascontiguousarray(image.permute(1, 2, 0).numpy()[:, :, ::-1])
+    draw_poses(img, boxes, rotations)
+    cv2.imwrite(path, img[:height, :width])
 
 
+@torch.no_grad()
 def inference(args):
     """
-    Script for Inference with PoET. The datalaoder loads all the images and then iterates over them. PoET processes each
-    image and stores the detected objects and their poses in a JSON file. Currently, this script allows only batch sizes
-    of 1.
+    Script for Inference with PoET. The dataloader workers load and decode the images, which are processed by PoET in
+    batches of args.inference_batch_size. The detected objects and their poses are streamed into a JSON file, while the
+    annotated images are drawn and stored by a pool of background writer threads.
     """
     if not os.path.exists(args.inference_output):
         os.makedirs(args.inference_output)
 
     device = torch.device(args.device)
-    model, criterion, matcher = build_model(args)
-    model.to(device)
-    model.eval()
-
-    # Load model weights
-    checkpoint = torch.load(args.resume, map_location='cpu')
-    model.load_state_dict(checkpoint['model'], strict=False)
+    model = load_model(args, device)
 
     # Construct dataloader that loads the images for inference
     dataset_inference = build_dataset(args)
     sampler_inference = SequentialSampler(dataset_inference)
-    data_loader_inference = DataLoader(dataset_inference, 1, sampler=sampler_inference,
-                                       drop_last=False, collate_fn=utils.collate_fn, num_workers=0,
-                                       pin_memory=True)
-
-    prefetcher = data_prefetcher(data_loader_inference, device, prefetch=False)
+    data_loader_inference = DataLoader(dataset_inference, args.inference_batch_size, sampler=sampler_inference,
+                                       drop_last=False, collate_fn=utils.collate_fn, num_workers=args.num_workers,
+                                       pin_memory=device.type == 'cuda')
+
+    # On the GPU, the next batch is transferred asynchronously while the current one is processed
+    prefetcher = data_prefetcher(data_loader_inference, device, prefetch=device.type == 'cuda')
+    writer_pool = ThreadPoolExecutor(max_workers=args.inference_writers)
+    pending_writes = deque()
+
+    out_file = open(os.path.join(args.inference_output, "results.json"), 'w')
+    out_file.write('{')
+    n_images = len(dataset_inference)
+    i = 0
     samples, targets = prefetcher.next()
-    results = {}
-    # Iterate over all images, perform pose estimation and store results.
-    for i, idx in enumerate(range(len(data_loader_inference))):
-        print("Processing {}/{}".format(i, len(data_loader_inference) - 1))
+    # Iterate over all batches, perform pose estimation and store results.
+    while samples is not None:
+        print("Processing {}/{}".format(i, n_images - 1))
+        # The images are loaded and transferred as uint8, the conversion to [0, 1] happens on the device
+        images = samples.tensors
+        samples = utils.NestedTensor(images.float().div_(255), samples.mask)
         outputs, n_boxes_per_sample = model(samples, targets)
-
-        # Iterate over all the detected predictions
-        img_file = data_loader_inference.dataset.image_paths[i]
-        img_id = img_file[img_file.find("_")+1:img_file.rfind(".")]
-        img = cv2.imread(f'/data/0000/{img_file}')
-        height, width, _ = img.shape
-
-        results[img_id] = {}
-        for d in range(n_boxes_per_sample[0]):
-            pred_t = outputs['pred_translation'][0][d].detach().cpu().tolist()
-            pred_rot = outputs['pred_rotation'][0][d].detach().cpu().tolist()
-            pred_rot_numpy = outputs['pred_rotation'][0][d].detach().cpu().numpy()
-            pred_box = outputs['pred_boxes'][0][d].detach().cpu().tolist()
-            pred_class = outputs['pred_classes'][0][d].detach().cpu().tolist()
-            results[img_id][d] = {
-                "t": pred_t,
-                "rot": pred_rot,
-                "box": pred_box,
-                "class": pred_class
-            }
-
-    
-            x_c, y_c, w, h = pred_box
-            x1 = int((x_c - w/2) * width)
-            y1 = int((y_c - h/2) * height)
-            x2 = int((x_c + w/2) * width)
-            y2 = int((y_c + h/2) * height)
-
-            cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 2)  # Draw Rectangle
-            center = np.array([(x1 + x2) // 2, (y1 + y2) // 2])
-            draw_axes(img, center, pred_rot_numpy)
-            cv2.imwrite(os.path.join(args.inference_output, f"{img_file[:-4]}_predicted.png"), img)
-
+        if 'exit_layer' in outputs:
+            print("Decoder exit layers: {}".format(outputs['exit_layer'].tolist()))
+
+        # Transfer the predictions of the whole batch at once
+        pred_t = outputs['pred_translation'].cpu()
+        pred_rot = outputs['pred_rotation'].cpu()
+        pred_boxes = outputs['pred_boxes'].cpu()
+        pred_classes = outputs['pred_classes'].cpu()
+        images = images.cpu()
+        valid = ~samples.mask.cpu()
+
+        for b, n_boxes in enumerate(n_boxes_per_sample):
+            img_file = dataset_inference.image_paths[i]
+            img_id = img_file[img_file.find("_")+1:img_file.rfind(".")]
+
+            img_results = {}
+            for d in range(n_boxes):
+                img_results[d] = {
+                    "t": pred_t[b][d].tolist(),
+                    "rot": pred_rot[b][d].tolist(),
+                    "box": pred_boxes[b][d].tolist(),
+                    "class": pred_classes[b][d].tolist()
+                }
+            out_file.write("{}{}: {}".format(", " if i > 0 else "", json.dumps(img_id), json.dumps(img_results)))
+
+            if n_boxes > 0:
+                height = int(valid[b, :, 0].sum())
+                width = int(valid[b, 0, :].sum())
+                path = os.path.join(args.inference_output, f"{img_file[:-4]}_predicted.png")
+                pending_writes.append(writer_pool.submit(write_annotated_image, path, images[b],
+                                                         pred_boxes[b][:n_boxes].numpy(),
+                                                         pred_rot[b][:n_boxes].numpy(), height, width))
+            i += 1
+
+        # Bound the number of images waiting to be written
+        while len(pending_writes) > 2 * args.inference_writers:
+            pending_writes.popleft().result()
 
         samples, targets = prefetcher.next()
 
-    # Store the json-file
-    out_file_name = "results.json"
-    with open(args.inference_output + '/' + out_file_name, 'w') as out_file:
-        json.dump(results, out_file)
+    for write in pending_writes:
+        write.result()
+    writer_pool.shutdown()
+
+    # Close the json-file
+    out_file.write('}')
+    out_file.close()
     return
 
 
+def load_model(args, device):
+    """
+    Build PoET, load the weights from args.resume and prepare it for inference on the given device. If
+    args.optimize_backbone is set, the inference build of the backbone is used. If args.artifact is set, the packaged
+    model is loaded from it instead. If args.onnx is set, the exported graphs are run with ONNX Runtime on the CPU.
+    """
+    if args.onnx:
+        return OnnxPoET(args.onnx, args.onnx_intra_op_threads, args.onnx_inter_op_threads)
+    if args.artifact:
+        model, _ = load_artifact(args.artifact, device)
+        if args.backbone_jit:
+            model.backbone[0].prepare_inference(args.backbone_image_size, device, jit=True)
+        return model
+    model, criterion, matcher = build_model(args)
+    model.to(device)
+    model.eval()
 
-def send_image(sock, img):
-    print('Sending frame to client')
-    data = pickle.dumps(img)
-    message_size = struct.pack("Q", len(data))
-    sock.sendall(message_size + data)
+    # Load model weights
+    checkpoint = torch.load(args.resume, map_location='cpu')
+    model.load_state_dict(checkpoint['model'], strict=False)
+    if args.optimize_backbone:
+        model.backbone[0].prepare_inference(args.backbone_image_size, device, jit=args.backbone_jit)
+    return model
 
-def receive_and_save_image(client_socket, save_path):
-    data = b""
-    payload_size = struct.calcsize("Q")
 
-    while len(data) < payload_size:
-        packet = client_socket.recv(4096)
-        if not packet:
-            return False  # No more data received
-        data += packet
+def draw_predictions(img, outputs, n_boxes, idx=0):
+    """
+    Draw the bounding box and the rotation axes of every object PoET detected in image idx of the batch onto img.
+    """
+    pred_boxes = outputs['pred_boxes'][idx][:n_boxes].detach().cpu().numpy()
+    pred_rotations = outputs['pred_rotation'][idx][:n_boxes].detach().cpu().numpy()
+    return draw_poses(img, pred_boxes, pred_rotations)
 
-    if len(data) >= payload_size:
-        packed_msg_size = data[:payload_size]
-        data = data[payload_size:]
-        msg_size = struct.unpack("Q", packed_msg_size)[0]
 
-        while len(data) < msg_size:
-            data += client_socket.recv(4096)
+def crop_frame(frame, width=640, height=480):
+    """
+    Center crop the frame to accommodate the model input size. The crop is returned as a contiguous array, such that
+    it can be drawn on in-place.
+    """
+    frame_height, frame_width, _ = frame.shape
+    if frame_height != height or frame_width != width:
+        # Calculate the starting point for cropping (center crop) and ensure it is within the frame dimensions
+        start_x = max(0, frame_width // 2 - width // 2)
+        start_y = max(0, frame_height // 2 - height // 2)
+        frame = np.ascontiguousarray(frame[start_y:start_y + height, start_x:start_x + width])
+    return frame
 
-        frame_data = data[:msg_size]
-        frame = pickle.loads(frame_data)
 
-        # Get the dimensions of the frame
-        height, width, _ = frame.shape
+def pose_records(outputs, n_boxes, idx=0):
+    """
+    Pack the pose results of image idx of the batch into the fixed-layout records of the frame protocol.
+    """
+    return protocol.encode_poses(outputs['pred_classes'][idx][:n_boxes].detach().cpu().numpy(),
+                                 outputs['pred_boxes'][idx][:n_boxes].detach().cpu().numpy(),
+                                 outputs['pred_rotation'][idx][:n_boxes].detach().cpu().numpy(),
+                                 outputs['pred_translation'][idx][:n_boxes].detach().cpu().numpy())
 
-        # Crop the frame to accomodate the model input size
-        if height != 480 or width != 640:
-            # Calculate the starting point for cropping (center crop)
-            start_x = width//2 - 320
-            start_y = height//2 - 240
 
-            # Ensure the cropping area is within the frame dimensions
-            start_x = max(0, start_x)
-            start_y = max(0, start_y)
+def encode_response(config, header, frame, outputs, n_boxes, received=0.0, inferred=0.0, latency=None):
+    """
+    Build the response to a processed frame according to the settings negotiated with the client: either the frame
+    annotated with the predictions or only the pose records. The frame id and timestamp of the received frame are
+    echoed, such that the client can match the response to its frame. Pose records additionally carry the server-side
+    timestamps received and inferred. They are neither drawn nor encoded as image, rendering is left to the client.
+    """
+    height, width, _ = frame.shape
+    if config.response == protocol.RESPONSE_POSES:
+        with measure(latency, 'encode'):
+            return protocol.poses_message(pose_records(outputs, n_boxes), header.frame_id, header.timestamp, width,
+                                          height, received, inferred)
+    with measure(latency, 'annotate'):
+        draw_predictions(frame, outputs, n_boxes)
+    with measure(latency, 'encode'):
+        return protocol.frame_message(frame, header.frame_id, header.timestamp, config.codec, config.quality)
+
+
+def decode_frame(header, payload):
+    """
+    Decode a received frame and crop it to the model input size.
+    """
+    if header.msg_type != protocol.MSG_FRAME:
+        raise protocol.ProtocolError("Expected a FRAME message, received message type {}".format(header.msg_type))
+    return crop_frame(protocol.decode_image(header, payload))
 
-            # Crop the frame to 640x480
-            frame = frame[start_y:start_y + 480, start_x:start_x + 640]
 
-        # Save the image to the specified path
-        save_path = Path(save_path)
-        save_path.parent.mkdir(parents=True, exist_ok=True)
-        cv2.imwrite(str(save_path), frame)
-        return True
+def run_live_pipeline(model, device, client_socket, config, queue_depth, latency=None, exit_layers=None):
+    """
+    Serve the client with a staged pipeline. Receiving, decoding, the model forward pass, encoding of the response and
+    sending back run in separate threads on different frames. If the model falls behind, the oldest queued frames are
+    dropped. If exit_layers is a Counter, the decoder exit layers of the early exit are counted.
+    """
+    stream_input = StreamInput(device)
+    # The payload of a frame is in use until it is decoded or dropped from the decode queue. The receiver keeps
+    # receiving while a frame is decoded, hence the buffers come from a free list instead of a ring.
+    receiver = protocol.PooledFrameReceiver(client_socket)
+
+    def receive():
+        with measure(latency, 'recv'):
+            message = receiver.receive()
+        if message is None:
+            print("Failed to receive image")
+            return None
+        header, payload = message
+        return {'header': header, 'payload': payload, 'received': time.time(), 'started': time.perf_counter()}
+
+    def decode(item):
+        payload = item.pop('payload')
+        try:
+            with measure(latency, 'decode'):
+                item['frame'] = decode_frame(item['header'], payload)
+        finally:
+            receiver.release(payload)
+        return item
+
+    def drop(item):
+        if 'payload' in item:
+            receiver.release(item['payload'])
+
+    def forward(item):
+        # Gradient mode is thread local, hence it has to be disabled within the worker thread
+        with torch.no_grad():
+            with measure(latency, 'preprocess'):
+                samples = stream_input(item['frame'])
+            outputs, n_boxes_per_sample = model(samples, None)
+        if exit_layers is not None and 'exit_layer' in outputs:
+            exit_layers[int(outputs['exit_layer'][0])] += 1
+        item['outputs'] = outputs
+        item['n_boxes'] = n_boxes_per_sample[0]
+        item['inferred'] = time.time()
+        return item
+
+    def encode(item):
+        message = encode_response(config, item['header'], item['frame'], item['outputs'], item['n_boxes'],
+                                  item['received'], item['inferred'], latency)
+        return message, item['started']
+
+    def send(item):
+        message, started = item
+        with measure(latency, 'send'):
+            client_socket.sendall(message)
+        if latency is not None:
+            latency.frame_done(started)
+
+    def stop():
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    pipeline = LivePipeline(receive,
+                            [('decode', decode), ('model', forward), ('encode', encode), ('send', send)],
+                            queue_depth=queue_depth, stop_fn=stop, on_drop=drop)
+    pipeline.run()
+    print("Dropped frames: {}".format(pipeline.dropped()))
+
+
+def run_lock_step(model, device, client_socket, config, latency=None, latest_frame=False, exit_layers=None):
+    """
+    Serve the client frame by frame: receive a frame, process it and send the response before receiving the next one.
+    If exit_layers is a Counter, the decoder exit layers of the early exit are counted.
+
+    In the latest-frame-wins mode, a background thread keeps receiving frames while a frame is processed and only the
+    newest one is kept. Frames that became stale in the meantime are dropped without being decoded.
+    """
+    stream_input = StreamInput(device)
+    if latest_frame:
+        reader = protocol.LatestFrameReader(client_socket)
+        reader.start()
+        receive = reader.get
+    else:
+        receive = protocol.FrameReceiver(client_socket, n_buffers=1).receive
+    while True:
+        with measure(latency, 'recv'):
+            message = receive()
+        if message is None:
+            print("Failed to receive image")
+            break
+        header, payload = message
+        received = time.time()
+        started = time.perf_counter()
+
+        with measure(latency, 'decode'):
+            frame = decode_frame(header, payload)
+        with measure(latency, 'preprocess'):
+            samples = stream_input(frame)
+        outputs, n_boxes_per_sample = model(samples, None)
+        if exit_layers is not None and 'exit_layer' in outputs:
+            exit_layers[int(outputs['exit_layer'][0])] += 1
+        inferred = time.time()
+
+        response = encode_response(config, header, frame, outputs, n_boxes_per_sample[0], received, inferred, latency)
+        with measure(latency, 'send'):
+            client_socket.sendall(response)
+        if latency is not None:
+            latency.frame_done(started)
 
-    return False
+    if latest_frame:
+        print("Dropped stale frames: {}/{}".format(reader.dropped, reader.received))
 
+
+@torch.no_grad()
 def webcam_inference(args):
+    """
+    Live inference with PoET. Frames are received from the client, copied into a preallocated input tensor and passed
+    through the model. Depending on the settings requested by the client, either the annotated frame or only the
+    detected poses are sent back. No frame is written to or read from the disk.
+    """
     device = torch.device(args.device)
-    model, criterion, matcher = build_model(args)
-    model.to(device)
-    model.eval()
-
-    # Load model weights
-    checkpoint = torch.load(args.resume, map_location='cpu')
-    model.load_state_dict(checkpoint['model'], strict=False)
+    model = load_model(args, device)
+    latency = build_latency_monitor(args, device)
+    attach(model, latency)
+    if args.tracking:
+        model = PoseTracker(model, detect_interval=args.tracking_interval,
+                            min_confidence=args.tracking_min_confidence, smoothing=args.tracking_smoothing,
+                            translation_tolerance=args.tracking_translation_tolerance)
+    exit_layers = Counter() if args.early_exit else None
 
     # Set up socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -192,66 +360,43 @@ def webcam_inference(args):
     client_socket, addr = server_socket.accept()
     print("Connected to:", addr)
 
-    # Path to save the received image
-    image_path = Path(args.inference_path) / '0.png'
-    # Receive and save the new image
-    if receive_and_save_image(client_socket, image_path):
-        print(f"Image saved to {image_path}")
-    else:
-        print("Failed to receive image")
-        return
-
-    print('Instanciating the dataset')
-
-    # Construct dataloader that loads the images for inference
-    dataset_inference = build_dataset(args)
-    sampler_inference = SequentialSampler(dataset_inference)
-    data_loader_inference = DataLoader(dataset_inference, 1, sampler=sampler_inference,
-                                       drop_last=False, collate_fn=utils.collate_fn, num_workers=0,
-                                       pin_memory=True)
-
-    prefetcher = data_prefetcher(data_loader_inference, device, prefetch=False)
-
-    count = 1
-
-    print('Starting inference')
-    while True:        
-        # Reset the prefetcher to ensure the new image is loaded
-        prefetcher.reset()
-
-        # Perform inference on the new image
-        samples, targets = prefetcher.next()
-        if samples is None:
-            print("No samples to process")
-            break
-
-        outputs, n_boxes_per_sample = model(samples, None)
-
-        # Load the image for drawing
-        img = cv2.imread(str(image_path))
-        height, width, _ = img.shape
-
-        for d in range(n_boxes_per_sample[0]):
-            pred_t = outputs['pred_translation'][0][d].detach().cpu().tolist()
-            pred_rot = outputs['pred_rotation'][0][d].detach().cpu().tolist()
-            pred_rot_numpy = outputs['pred_rotation'][0][d].detach().cpu().numpy()
-            pred_box = outputs['pred_boxes'][0][d].detach().cpu().tolist()
-            pred_class = outputs['pred_classes'][0][d].detach().cpu().tolist()
-    
-            x_c, y_c, w, h = pred_box
-            x1 = int((x_c - w/2) * width)
-            y1 = int((y_c - h/2) * height)
-            x2 = int((x_c + w/2) * width)
-            y2 = int((y_c + h/2) * height)
-
-            cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 2)  # Draw Rectangle
-            center = np.array([(x1 + x2) // 2, (y1 + y2) // 2])
-            draw_axes(img, center, pred_rot_numpy)
-
-        # Send the image back to the client
-        send_image(client_socket, img)
-
-        # Receive and save the new image
-        if not receive_and_save_image(client_socket, image_path):
-            print("Failed to receive image")
-            break
\ No newline at end of file
+    try:
+        config = protocol.accept_stream(client_socket)
+        if config is None:
+            print("Connection closed during the handshake")
+        else:
+            print('Starting inference')
+            if args.pipeline:
+                run_live_pipeline(model, device, client_socket, config, args.pipeline_queue_depth, latency,
+                                  exit_layers)
+            else:
+                run_lock_step(model, device, client_socket, config, latency, args.latest_frame, exit_layers)
+    except (ConnectionError, protocol.ProtocolError) as e:
+        print("Connection to {} failed: {}".format(addr, e))
+
+    if args.tracking:
+        print("Object detector ran on {}/{} frames".format(model.n_detections, model.n_frames))
+    if exit_layers is not None:
+        # Frames without any object are not decoded and reported with exit layer 0
+        print("Decoder exit layers (layer: frames): {}".format(dict(sorted(exit_layers.items()))))
+    if latency is not None:
+        print(latency.format_summary())
+    client_socket.close()
+    server_socket.close()
+
+
+def multi_client_inference(args):
+    """
+    Live inference with PoET for several concurrent clients. The frames of all clients are batched dynamically (up to
+    args.server_batch_size frames or args.server_batch_timeout milliseconds) and processed by one shared model.
+    """
+    device = torch.device(args.device)
+    model = load_model(args, device)
+    latency = build_latency_monitor(args, device)
+    attach(model, latency)
+    if args.tracking:
+        print("Tracking is not supported by the multi-client server, the objects are detected in every frame")
+
+    serve_multi_client(model, device, decode_frame, partial(encode_response, latency=latency),
+                       max_batch_size=args.server_batch_size, max_delay=args.server_batch_timeout / 1000,
+                       latency=latency)
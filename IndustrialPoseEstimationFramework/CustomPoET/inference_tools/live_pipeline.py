@@ -0,0 +1,142 @@
+# ------------------------------------------------------------------------
+# PoET: Pose Estimation Transformer for Single-View, Multi-Object 6D Pose Estimation
+# Copyright (c) 2022 Thomas Jantos (thomas.jantos@aau.at), University of Klagenfurt - Control of Networked Systems (CNS). All Rights Reserved.
+# Licensed under the BSD-2-Clause-License with no commercial use [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Staged pipeline for live inference. Every stage runs in its own worker thread and the stages are connected by bounded
+queues, such that receiving, decoding, the model forward pass, annotation and sending operate concurrently on
+different frames.
+"""
+import threading
+from collections import deque
+
+
+class DropOldestQueue(object):
+    """
+    Bounded FIFO queue that never blocks the producer. If the queue is full, the oldest item is discarded to make room
+    for the new one, which keeps the latency bounded when a downstream stage falls behind. on_drop is called with every
+    discarded item, e.g. to release the resources it holds.
+    """
+    def __init__(self, maxsize, on_drop=None):
+        assert maxsize > 0, "Queue depth has to be at least 1"
+        self.maxsize = maxsize
+        self.on_drop = on_drop
+        self.items = deque()
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, item):
+        dropped = None
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                dropped = self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+
+    def get(self):
+        """
+        Returns the oldest item in the queue. Blocks until an item is available and returns None once the queue is
+        closed and empty.
+        """
+        with self.cond:
+            while not self.items and not self.closed:
+                self.cond.wait()
+            if self.items:
+                return self.items.popleft()
+            return None
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        with self.cond:
+            return len(self.items)
+
+
+class PipelineStage(threading.Thread):
+    """
+    Worker thread that applies fn to every item of the input queue and forwards the result to the output queue.
+    Items for which fn returns None are not forwarded. Closing the input queue shuts the stage down and closes the
+    output queue, such that the shutdown propagates through the pipeline.
+    """
+    def __init__(self, name, fn, in_queue, out_queue=None, on_error=None):
+        super().__init__(name=name, daemon=True)
+        self.fn = fn
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.on_error = on_error
+        self.error = None
+
+    def run(self):
+        try:
+            while True:
+                item = self.in_queue.get()
+                if item is None:
+                    break
+                result = self.fn(item)
+                if result is not None and self.out_queue is not None:
+                    self.out_queue.put(result)
+        except Exception as e:
+            print("Pipeline stage '{}' failed: {}".format(self.name, e))
+            self.error = e
+            # Stop accepting new items and notify the owner of the pipeline
+            self.in_queue.close()
+            if self.on_error is not None:
+                self.on_error()
+        finally:
+            if self.out_queue is not None:
+                self.out_queue.close()
+
+
+class LivePipeline(object):
+    """
+    Pipeline consisting of a source and a sequence of stages.
+
+    The source is called repeatedly in the thread that runs the pipeline and returns the next item, or None once the
+    stream ended. Each stage is a tuple (name, fn) and runs in its own thread. Stages are connected by drop-oldest
+    queues of depth queue_depth, hence the throughput is limited by the slowest stage and the number of frames in
+    flight is bounded. stop_fn is called if a stage fails and should unblock the source (e.g. shut down the socket).
+    on_drop is called with every item that is dropped from one of the queues.
+    """
+    def __init__(self, source, stages, queue_depth=2, stop_fn=None, on_drop=None):
+        self.source = source
+        self.stop_fn = stop_fn
+        self.stopped = threading.Event()
+        self.queues = [DropOldestQueue(queue_depth, on_drop) for _ in stages]
+        self.stages = []
+        for i, (name, fn) in enumerate(stages):
+            out_queue = self.queues[i + 1] if i + 1 < len(stages) else None
+            self.stages.append(PipelineStage(name, fn, self.queues[i], out_queue, on_error=self.stop))
+
+    def stop(self):
+        self.stopped.set()
+        if self.stop_fn is not None:
+            self.stop_fn()
+
+    def dropped(self):
+        """
+        Returns the number of dropped items per queue, keyed by the name of the stage consuming the queue.
+        """
+        return {stage.name: queue.dropped for stage, queue in zip(self.stages, self.queues)}
+
+    def run(self):
+        for stage in self.stages:
+            stage.start()
+        try:
+            while not self.stopped.is_set():
+                item = self.source()
+                if item is None:
+                    break
+                self.queues[0].put(item)
+        finally:
+            self.queues[0].close()
+            for stage in self.stages:
+                stage.join()
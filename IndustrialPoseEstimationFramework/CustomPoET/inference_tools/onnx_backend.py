@@ -0,0 +1,252 @@
+# ------------------------------------------------------------------------
+# PoET: Pose Estimation Transformer for Single-View, Multi-Object 6D Pose Estimation
+# Copyright (c) 2022 Thomas Jantos (thomas.jantos@aau.at), University of Klagenfurt - Control of Networked Systems (CNS). All Rights Reserved.
+# Licensed under the BSD-2-Clause-License with no commercial use [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+ONNX export of the YOLO + PoET pipeline and inference with ONNX Runtime.
+
+The pipeline is exported for a fixed input size without padding as two graphs:
+    - backbone.onnx: images [batch_size, 3, H, W] -> inference output of the YOLO layers before NMS
+      [batch_size, n_candidates, 5 + n_classes] and the feature maps passed to PoET
+    - poet.onnx: query boxes [batch_size, n_queries, 4], query classes [batch_size, n_queries] and the feature maps ->
+      rotation and translation predicted by the last decoder layer
+NMS runs in between as vectorized PyTorch step (batched_non_max_suppression). The settings the graphs were exported
+with are stored in config.json next to them.
+
+The graphs always decode all queries with the dense encoder, i.e. the padding-free decoding, the sparse encoder and
+the early exit of the eager model are not part of the export.
+"""
+import json
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from models import build_model
+from models.ms_deform_attn import MSDeformAttn
+from models.pose_estimation_transformer import pad_backbone_predictions, pad_query_boxes
+from models.yolov4.yolo.yolo_utils.general import batched_non_max_suppression
+from util.latency import StageTimer
+from util.misc import NestedTensor
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class BackboneGraph(nn.Module):
+    """
+    YOLO layers of the CNSYOLO backbone without NMS.
+    """
+    def __init__(self, backbone):
+        super().__init__()
+        self.backbone = backbone
+
+    def forward(self, images):
+        candidates, features = self.backbone.forward_layers(images)
+        return (candidates,) + tuple(features.values())
+
+
+class PoETGraph(nn.Module):
+    """
+    Position encoding, transformer and pose heads of PoET for inputs of the fixed size image_size (H, W) without
+    padding. Dummy queries have a negative class.
+    """
+    def __init__(self, model, image_size):
+        super().__init__()
+        self.model = model
+        self.image_size = tuple(image_size)
+
+    def forward(self, pred_boxes, pred_classes, *features):
+        model = self.model
+        bs = pred_boxes.shape[0]
+        # The masks and position encodings are computed for a single image, such that they are constant in the graph
+        mask = torch.zeros((1,) + self.image_size, dtype=torch.bool, device=pred_boxes.device)
+        masks = [F.interpolate(mask[None].float(), size=f.shape[-2:]).to(torch.bool)[0] for f in features]
+        pos = [model.backbone[1](NestedTensor(f[:1], m)).to(f.dtype).expand(bs, -1, -1, -1)
+               for f, m in zip(features, masks)]
+        samples = NestedTensor(None, mask.expand(bs, -1, -1))
+        features = [NestedTensor(f, m.expand(bs, -1, -1)) for f, m in zip(features, masks)]
+
+        valid = pred_classes >= 0
+        query_embeds = model.bbox_embedding(pred_boxes).repeat(1, 1, 2).masked_fill(~valid[:, :, None], -10)
+        hs = model.decode(samples, features, pos, query_embeds, pred_boxes)
+        return model.predict_pose(hs.shape[0] - 1, hs[-1], pred_classes)
+
+
+def export_onnx(args):
+    """
+    Exports the model given by args (weights from args.resume) to the directory args.export_onnx for inputs of size
+    args.onnx_image_size and verifies the exported graphs against the eager model.
+    """
+    device = torch.device('cpu')
+    args.device = 'cpu'
+    model, _, _ = build_model(args)
+    if args.resume:
+        checkpoint = torch.load(args.resume, map_location='cpu')
+        model.load_state_dict(checkpoint['model'], strict=False)
+    model.eval()
+    # Data-dependent control flow cannot be traced
+    model.early_exit = None
+    model.transformer.sparse_encoder_margin = None
+    # ONNX Runtime samples the levels of the deformable attention separately faster than packed into one canvas
+    for module in model.modules():
+        if isinstance(module, MSDeformAttn):
+            module.pack_levels = False
+
+    os.makedirs(args.export_onnx, exist_ok=True)
+    height, width = args.onnx_image_size
+    images = torch.rand(1, 3, height, width)
+    backbone = BackboneGraph(model.backbone[0]).eval()
+    poet = PoETGraph(model, (height, width)).eval()
+
+    with torch.no_grad():
+        outputs = backbone(images)
+        n_features = len(outputs) - 1
+        feature_names = ['features_{}'.format(i) for i in range(n_features)]
+        torch.onnx.export(backbone, (images,), os.path.join(args.export_onnx, 'backbone.onnx'),
+                          input_names=['images'], output_names=['candidates'] + feature_names,
+                          dynamic_axes={name: {0: 'batch_size'} for name in ['images', 'candidates'] + feature_names},
+                          opset_version=args.onnx_opset, dynamo=False)
+
+        pred_boxes = torch.rand(1, model.n_queries, 4) * 0.5 + 0.25
+        pred_classes = torch.randint(1, model.n_classes, (1, model.n_queries))
+        query_axes = {0: 'batch_size', 1: 'n_queries'}
+        torch.onnx.export(poet, (pred_boxes, pred_classes) + tuple(outputs[1:]),
+                          os.path.join(args.export_onnx, 'poet.onnx'),
+                          input_names=['pred_boxes', 'pred_classes'] + feature_names,
+                          output_names=['pred_rotation', 'pred_translation'],
+                          dynamic_axes=dict({'pred_boxes': query_axes, 'pred_classes': query_axes,
+                                             'pred_rotation': query_axes, 'pred_translation': query_axes},
+                                            **{name: {0: 'batch_size'} for name in feature_names}),
+                          opset_version=args.onnx_opset, dynamo=False)
+
+    config = {'image_size': [height, width], 'n_queries': model.n_queries, 'n_features': n_features,
+              'conf_thres': model.backbone[0].conf_thres, 'iou_thres': model.backbone[0].iou_thres,
+              'agnostic_nms': model.backbone[0].agnostic_nms}
+    with open(os.path.join(args.export_onnx, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2)
+    print("Exported the model to {}".format(args.export_onnx))
+
+    backend = OnnxPoET(args.export_onnx, args.onnx_intra_op_threads, args.onnx_inter_op_threads)
+    verify_onnx_export(model, backend, args.onnx_verify_frames, device)
+
+
+@torch.no_grad()
+def verify_onnx_export(model, backend, n_frames, device, seed=0):
+    """
+    Compares the outputs of the eager model and the ONNX Runtime backend on a fixture set of n_frames random frames and
+    reports the largest differences and the latency of both. The boxes detected by the eager model are used as queries
+    for both, such that the poses are compared even if the candidates of the two end up on different sides of the
+    confidence threshold. The latency is measured for these queries, such that both decode the same boxes.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    height, width = backend.image_size
+    differences = {'candidates': 0.0, 'pred_rotation': 0.0, 'pred_translation': 0.0}
+    times = {'eager': [], 'onnx': []}
+    for _ in range(n_frames):
+        images = torch.rand(1, 3, height, width, generator=generator, device=device)
+        samples = NestedTensor(images, torch.zeros(1, height, width, dtype=torch.bool, device=device))
+
+        candidates, _ = model.backbone[0].forward_layers(images)
+        onnx_candidates = torch.from_numpy(backend.backbone.run(['candidates'], {'images': images.cpu().numpy()})[0])
+        differences['candidates'] = max(differences['candidates'],
+                                        (candidates.cpu() - onnx_candidates).abs().max().item())
+
+        outputs, n_boxes_per_sample = model(samples)
+        n_boxes = n_boxes_per_sample[0]
+        if n_boxes == 0:
+            # Without detections, compare the poses for some query boxes instead
+            n_boxes = model.n_queries
+            query_boxes = [{'boxes': torch.rand(n_boxes, 4, generator=generator).to(device) * 0.5 + 0.25,
+                            'labels': torch.randint(1, model.n_classes, (n_boxes,), generator=generator).to(device)}]
+        else:
+            query_boxes = [{'boxes': outputs['pred_boxes'][0, :n_boxes], 'labels': outputs['pred_classes'][0, :n_boxes]}]
+        start = time.perf_counter()
+        outputs, _ = model(samples, query_boxes=query_boxes)
+        times['eager'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        onnx_outputs, _ = backend(samples, query_boxes=query_boxes)
+        times['onnx'].append(time.perf_counter() - start)
+        for key in ['pred_rotation', 'pred_translation']:
+            difference = (outputs[key][0, :n_boxes].cpu() - onnx_outputs[key][0, :n_boxes]).abs().max().item()
+            differences[key] = max(differences[key], difference)
+
+    print("Maximum absolute difference to the eager model on {} frames: {}".format(
+        n_frames, ", ".join("{} {:.2e}".format(key, value) for key, value in differences.items())))
+    print("Median latency [ms]: eager {:.1f}, ONNX Runtime {:.1f}".format(
+        np.median(times['eager']) * 1000, np.median(times['onnx']) * 1000))
+    return differences
+
+
+class OnnxPoET(object):
+    """
+    Runs the exported graphs with ONNX Runtime on the CPU. Called like PoET, i.e. model(samples, targets=None,
+    query_boxes=None) returns (outputs, n_boxes_per_sample), where outputs contains the final pred_translation,
+    pred_rotation, pred_boxes and pred_classes as CPU tensors. 0 threads use the default of ONNX Runtime.
+    """
+    def __init__(self, path, intra_op_threads=0, inter_op_threads=0):
+        if onnxruntime is None:
+            raise ImportError("The ONNX Runtime backend requires the onnxruntime package.")
+        with open(os.path.join(path, 'config.json'), 'r') as f:
+            config = json.load(f)
+        self.image_size = config['image_size']
+        self.n_queries = config['n_queries']
+        self.n_features = config['n_features']
+        self.conf_thres = config['conf_thres']
+        self.iou_thres = config['iou_thres']
+        self.agnostic_nms = config['agnostic_nms']
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        providers = ['CPUExecutionProvider']
+        self.backbone = onnxruntime.InferenceSession(os.path.join(path, 'backbone.onnx'), options, providers=providers)
+        self.poet = onnxruntime.InferenceSession(os.path.join(path, 'poet.onnx'), options, providers=providers)
+        # Latency monitor timing the stages as the eager model does, see util.latency.attach
+        self.latency = None
+
+    def __call__(self, samples, targets=None, query_boxes=None):
+        images = samples.tensors if isinstance(samples, NestedTensor) else samples
+        if list(images.shape[-2:]) != self.image_size:
+            raise ValueError('The ONNX graphs were exported for images of size {}, but got {}.'.format(
+                self.image_size, list(images.shape[-2:])))
+        if isinstance(samples, NestedTensor) and samples.mask is not None and samples.mask.any():
+            raise NotImplementedError('The ONNX graphs do not support padded images.')
+
+        timer = StageTimer(self.latency)
+        timer.start('backbone')
+        outputs = self.backbone.run(None, {'images': images.cpu().float().numpy()})
+        candidates, features = torch.from_numpy(outputs[0]), outputs[1:]
+
+        if query_boxes is None:
+            timer.start('nms')
+            pred_objects = batched_non_max_suppression(candidates, self.conf_thres, self.iou_thres, classes=None,
+                                                       agnostic=self.agnostic_nms)
+            # Adjust predicted classes by 1 as class 0 is "background / dummy" in PoET
+            for p in pred_objects:
+                if p is not None:
+                    p[:, 5] += 1
+            timer.start('queries')
+            pred_boxes, pred_classes, n_boxes_per_sample = pad_backbone_predictions(
+                pred_objects, self.n_queries, self.image_size, torch.device('cpu'))
+        else:
+            timer.start('queries')
+            pred_boxes, pred_classes, n_boxes_per_sample = pad_query_boxes(
+                [{'boxes': q['boxes'].cpu(), 'labels': q['labels'].cpu()} for q in query_boxes], self.n_queries)
+
+        timer.start('transformer')
+        inputs = {'pred_boxes': pred_boxes.float().numpy(), 'pred_classes': pred_classes.numpy()}
+        inputs.update({'features_{}'.format(i): f for i, f in enumerate(features)})
+        pred_rotation, pred_translation = self.poet.run(['pred_rotation', 'pred_translation'], inputs)
+        timer.stop()
+
+        out = {'pred_translation': torch.from_numpy(pred_translation), 'pred_rotation': torch.from_numpy(pred_rotation),
+               'pred_boxes': pred_boxes, 'pred_classes': pred_classes}
+        return out, n_boxes_per_sample
@@ -0,0 +1,134 @@
+# ------------------------------------------------------------------------
+# PoET: Pose Estimation Transformer for Single-View, Multi-Object 6D Pose Estimation
+# Copyright (c) 2022 Thomas Jantos (thomas.jantos@aau.at), University of Klagenfurt - Control of Networked Systems (CNS). All Rights Reserved.
+# Licensed under the BSD-2-Clause-License with no commercial use [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Temporal pose tracking for the live inference.
+
+Consecutive frames of a live stream are nearly identical, hence the objects do not have to be detected in every frame.
+The PoseTracker keeps a track (class, box, rotation, translation, confidence) per object. The object detector only runs
+every detect_interval frames or once the confidence of a track dropped. In between, the boxes of the tracks are passed
+to PoET as query boxes, such that the detection heads and NMS of the backbone are skipped, and the predicted poses are
+smoothed with an exponential filter.
+"""
+import torch
+import torch.nn.functional as F
+
+from util import box_ops
+
+
+class PoseTracker(object):
+    """
+    Wraps a PoET model and is called like it, i.e. tracker(samples) returns (outputs, n_boxes_per_sample). Only a
+    single stream with a batch size of 1 is supported, as the tracks belong to one camera.
+
+    Parameters:
+        model: PoET model in the 'backbone' bbox mode
+        detect_interval: the object detector runs at least every detect_interval frames
+        min_confidence: the object detector runs in the next frame if the confidence of any track is below it
+        confidence_decay: factor the confidence of a track is multiplied with in every frame without detection
+        translation_tolerance: the confidence of a track additionally decays with exp(-d / translation_tolerance),
+            where d is the distance between the predicted and the tracked translation
+        smoothing: weight of the tracked pose when it is blended with a new prediction, 0 disables the smoothing
+        iou_threshold: minimum IoU of a detection and a track of the same class to continue the track
+    """
+    def __init__(self, model, detect_interval=10, min_confidence=0.5, confidence_decay=0.95,
+                 translation_tolerance=0.05, smoothing=0.5, iou_threshold=0.3):
+        self.model = model
+        self.detect_interval = detect_interval
+        self.min_confidence = min_confidence
+        self.confidence_decay = confidence_decay
+        self.translation_tolerance = translation_tolerance
+        self.smoothing = smoothing
+        self.iou_threshold = iou_threshold
+        self.reset()
+
+    def reset(self):
+        self.classes = None
+        self.boxes = None
+        self.rotations = None
+        self.translations = None
+        self.confidence = None
+        self.frames_since_detection = 0
+        self.n_detections = 0
+        self.n_frames = 0
+
+    def n_tracks(self):
+        return 0 if self.classes is None else len(self.classes)
+
+    def needs_detection(self):
+        return (self.n_tracks() == 0 or self.frames_since_detection >= self.detect_interval
+                or bool((self.confidence < self.min_confidence).any()))
+
+    def __call__(self, samples, targets=None):
+        if len(samples.tensors) != 1:
+            raise NotImplementedError('Pose tracking only supports a batch size of 1.')
+        self.n_frames += 1
+
+        if self.needs_detection():
+            outputs, n_boxes_per_sample = self.model(samples, targets)
+            n_boxes = n_boxes_per_sample[0]
+            self.update_from_detections(outputs['pred_classes'][0, :n_boxes], outputs['pred_boxes'][0, :n_boxes],
+                                        outputs['pred_rotation'][0, :n_boxes], outputs['pred_translation'][0, :n_boxes])
+            self.frames_since_detection = 0
+            self.n_detections += 1
+        else:
+            query_boxes = [{"boxes": self.boxes, "labels": self.classes}]
+            outputs, n_boxes_per_sample = self.model(samples, targets, query_boxes=query_boxes)
+            n_boxes = n_boxes_per_sample[0]
+            self.update_from_tracks(outputs['pred_rotation'][0, :n_boxes], outputs['pred_translation'][0, :n_boxes])
+            self.frames_since_detection += 1
+
+        # Report the smoothed poses of the tracks, which are in the same order as the queries
+        outputs['pred_rotation'][0, :n_boxes] = self.rotations
+        outputs['pred_translation'][0, :n_boxes] = self.translations
+        return outputs, n_boxes_per_sample
+
+    def update_from_detections(self, classes, boxes, rotations, translations):
+        """
+        Associate the detections with the tracks of the same class greedily by IoU. Matched tracks continue with the
+        new box and the smoothed pose, unmatched detections start new tracks and unmatched tracks are discarded.
+        """
+        rotations = rotations.clone()
+        translations = translations.clone()
+        if self.n_tracks() > 0 and len(classes) > 0:
+            iou, _ = box_ops.box_iou(box_ops.box_cxcywh_to_xyxy(boxes), box_ops.box_cxcywh_to_xyxy(self.boxes))
+            iou = torch.where(classes[:, None] == self.classes[None, :], iou, torch.zeros_like(iou))
+            for _ in range(min(iou.shape)):
+                best = torch.argmax(iou)
+                d, t = divmod(best.item(), iou.shape[1])
+                if iou[d, t] < self.iou_threshold:
+                    break
+                rotations[d] = self.blend_rotation(self.rotations[t], rotations[d])
+                translations[d] = self.smoothing * self.translations[t] + (1 - self.smoothing) * translations[d]
+                iou[d, :] = -1
+                iou[:, t] = -1
+
+        self.classes = classes.clone()
+        self.boxes = boxes.clone()
+        self.rotations = rotations
+        self.translations = translations
+        self.confidence = torch.ones(len(classes), device=classes.device)
+
+    def update_from_tracks(self, rotations, translations):
+        distance = torch.linalg.norm(translations - self.translations, dim=-1)
+        self.confidence = self.confidence * self.confidence_decay * torch.exp(-distance / self.translation_tolerance)
+        self.rotations = self.blend_rotation(self.rotations, rotations)
+        self.translations = self.smoothing * self.translations + (1 - self.smoothing) * translations
+
+    def blend_rotation(self, tracked, predicted):
+        """
+        Weighted average of rotations, projected back onto SO(3) for rotation matrices and normalized for quaternions.
+        """
+        if tracked.shape[-1] == 4:
+            # q and -q describe the same rotation, average with the closer one
+            sign = torch.where((tracked * predicted).sum(-1, keepdim=True) < 0, -1.0, 1.0)
+            return F.normalize(self.smoothing * tracked + (1 - self.smoothing) * sign * predicted, dim=-1)
+        blended = self.smoothing * tracked + (1 - self.smoothing) * predicted
+        u, _, vh = torch.linalg.svd(blended)
+        # Flip the last singular vector if necessary, such that the result is a rotation and not a reflection
+        det = torch.det(u @ vh)
+        u = torch.cat([u[..., :2], u[..., 2:] * det[..., None, None]], dim=-1)
+        return u @ vh
@@ -0,0 +1,47 @@
+# ------------------------------------------------------------------------
+# PoET: Pose Estimation Transformer for Single-View, Multi-Object 6D Pose Estimation
+# Copyright (c) 2022 Thomas Jantos (thomas.jantos@aau.at), University of Klagenfurt - Control of Networked Systems (CNS). All Rights Reserved.
+# Licensed under the BSD-2-Clause-License with no commercial use [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Visualization of the estimated poses. Only depends on numpy and OpenCV, such that the clients can render the pose
+results received from the live inference server themselves.
+"""
+import cv2
+import numpy as np
+
+
+def draw_axes(img, center, rot, scale=50):
+    # Define unit vectors for axes in 3D
+    axes = np.array([[scale, 0, 0], [0, scale, 0], [0, 0, scale]])
+    point_center = np.array([center[0], center[1], 0])  # Add a dummy zero for the 3D center
+
+    # Colors for the axes: Red for X, Green for Y, Blue for Z
+    colors = [(0, 0, 255), (0, 255, 0), (255, 0, 0)]
+
+    # Transform axes using the rotation matrix
+    transformed_axes = rot.dot(axes.T).T
+
+    for i, color in enumerate(colors):
+        # Calculate the end point of each axis in 3D, then drop the z-component to project it to 2D
+        axis_end = point_center + transformed_axes[i]
+        cv2.line(img, tuple(point_center[:2].astype(int)), tuple(axis_end[:2].astype(int)), color, 2)
+
+
+def draw_poses(img, boxes, rotations):
+    """
+    Draw the bounding box and the rotation axes of every object onto img. The boxes are normalized (cx, cy, w, h).
+    """
+    height, width, _ = img.shape
+    for box, rot in zip(boxes, rotations):
+        x_c, y_c, w, h = box
+        x1 = int((x_c - w/2) * width)
+        y1 = int((y_c - h/2) * height)
+        x2 = int((x_c + w/2) * width)
+        y2 = int((y_c + h/2) * height)
+
+        cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 2)  # Draw Rectangle
+        center = np.array([(x1 + x2) // 2, (y1 + y2) // 2])
+        draw_axes(img, center, rot)
+    return img
@@ -29,6 +29,7 @@ from engine import train_one_epoch, pose_evaluate, bop_evaluate
 from models import build_model
 from evaluation_tools.pose_evaluator_init import build_pose_evaluator
 from inference_tools.inference_engine import inference
+from util.quantization import quantize_model, print_comparison
 
 def get_args_parser():
 
@@ -99,6 +100,23 @@ def get_args_parser():
                         help="Number of query slots")
     parser.add_argument('--dec_n_points', default=4, type=int)
     parser.add_argument('--enc_n_points', default=4, type=int)
+    parser.add_argument('--msda_backend', default='auto', type=str, choices=['auto', 'cuda', 'pytorch'],
+                        help="Implementation of the multi-scale deformable attention: 'cuda' requires the compiled "
+                             "deformable_attention extension, 'pytorch' runs on any device. 'auto' uses the extension "
+                             "if it is installed and the model runs on the GPU.")
+    parser.add_argument('--sparse_encoder', action='store_true',
+                        help="In evaluation mode, additionally evaluate the model with an encoder that only refines "
+                             "the tokens around the query boxes and report its metrics next to the dense ones. Not "
+                             "used during training.")
+    parser.add_argument('--sparse_encoder_margin', default=0.5, type=float,
+                        help="Margin around the query boxes of the sparse encoder relative to the box size")
+    parser.add_argument('--early_exit', action='store_true',
+                        help="Stop decoding during inference once the predicted poses converged between two "
+                             "consecutive decoder layers")
+    parser.add_argument('--early_exit_rotation', default=1.0, type=float,
+                        help="Maximum change of the rotation in degrees between two decoder layers for the early exit")
+    parser.add_argument('--early_exit_translation', default=0.005, type=float,
+                        help="Maximum change of the translation between two decoder layers for the early exit")
 
     # * Matcher
     parser.add_argument('--matcher_type', default='pose', choices=['pose'], type=str)
@@ -151,6 +169,10 @@ def get_args_parser():
                         help="Path to the directory containing the files for inference.")
     parser.add_argument('--inference_output', type=str,
                         help="Path to the directory where the inference results should be stored.")
+    parser.add_argument('--inference_batch_size', default=4, type=int,
+                        help="Number of images PoET processes at once in inference mode.")
+    parser.add_argument('--inference_writers', default=4, type=int,
+                        help="Number of background threads drawing and storing the annotated images in inference mode.")
 
     # * Misc
     parser.add_argument('--sgd', action='store_true')
@@ -166,6 +188,11 @@ def get_args_parser():
                         help='start epoch')
     parser.add_argument('--eval', action='store_true', help='Run model in evaluation mode')
     parser.add_argument('--eval_bop', action='store_true', help="Run model in BOP challenge evaluation mode")
+    parser.add_argument('--quantize', action='store_true',
+                        help="In evaluation mode, additionally evaluate the model quantized to INT8 on the CPU and "
+                             "report its metrics next to the FP32 ones")
+    parser.add_argument('--quantize_calibration_images', default=16, type=int,
+                        help="Number of training images used to calibrate the quantization of the backbone")
     parser.add_argument('--num_workers', default=1, type=int)
     parser.add_argument('--cache_mode', default=False, action='store_true', help='whether to cache images on memory')
 
@@ -201,6 +228,9 @@ def main(args):
     # Build the model and evaluator
     model, criterion, matcher = build_model(args)
     model.to(device)
+    # The sparse encoder is only enabled for the dense vs. sparse comparison in evaluation mode. All other metrics
+    # (validation during and after training, FP32 vs. INT8 comparison, BOP challenge) are those of the dense encoder.
+    model.transformer.sparse_encoder_margin = None
 
 
     pose_evaluator = build_pose_evaluator(args)
@@ -334,8 +364,22 @@ def main(args):
         else:
             eval_epoch = None
 
-        pose_evaluate(model, matcher, pose_evaluator, data_loader_val, args.eval_set, args.bbox_mode,
-                      args.rotation_representation, device, args.output_dir, eval_epoch)
+        results = pose_evaluate(model, matcher, pose_evaluator, data_loader_val, args.eval_set, args.bbox_mode,
+                                args.rotation_representation, device, args.output_dir, eval_epoch)
+        if args.sparse_encoder:
+            # The metrics of the dense encoder are the reference for the sparse encoder
+            model_without_ddp.transformer.sparse_encoder_margin = args.sparse_encoder_margin
+            sparse_results = pose_evaluate(model, matcher, pose_evaluator, data_loader_val, args.eval_set,
+                                           args.bbox_mode, args.rotation_representation, device,
+                                           args.output_dir + "/sparse_encoder", eval_epoch)
+            model_without_ddp.transformer.sparse_encoder_margin = None
+            print_comparison(results, sparse_results, labels=("Dense", "Sparse"))
+        if args.quantize:
+            quantize_model(model_without_ddp, data_loader_train, args.quantize_calibration_images)
+            int8_results = pose_evaluate(model_without_ddp, matcher, pose_evaluator, data_loader_val, args.eval_set,
+                                         args.bbox_mode, args.rotation_representation, torch.device('cpu'),
+                                         args.output_dir + "/int8", eval_epoch)
+            print_comparison(results, int8_results)
         return
 
     # Evaluate the model for the BOP challenge
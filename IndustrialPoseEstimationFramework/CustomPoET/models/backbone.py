@@ -18,6 +18,8 @@ import torch
 from torch import nn
 from typing import List
 from util.misc import NestedTensor
+from util.latency import measure
+from util.shape_cache import cached
 
 from .position_encoding import build_position_encoding
 from .backbone_maskrcnn import build_maskrcnn
@@ -28,24 +30,37 @@ class Joiner(nn.Sequential):
         super().__init__(backbone, position_embedding)
         self.strides = backbone.strides
         self.num_channels = backbone.num_channels
+        # Latency monitor timing the position encoding, see util.latency.attach
+        self.latency = None
+        # Cache of the position encodings, see util.shape_cache
+        self.shape_cache = None
+        if not backbone.train_backbone:
+            backbone.eval()
 
-    def forward(self, tensor_list: NestedTensor):
+    def train(self, mode=True):
+        # A frozen object detector always stays in evaluation mode
+        super().train(mode)
+        if not self[0].train_backbone:
+            self[0].eval()
+        return self
+
+    def forward(self, tensor_list: NestedTensor, detect=True):
+        # If detect is False, the object detector only returns the feature maps and no predictions
         # TODO: Dirty, fix it
         # TODO: Currently the Object detector backbone has to be pretrained. Extend code to make object detectors
         #  trainable.
         if self[0].train_backbone:
             raise NotImplementedError
-        else:
-            self[0].eval()
-            predictions, xs = self[0](tensor_list)
+        predictions, xs = self[0](tensor_list, detect=detect)
         out: List[NestedTensor] = []
         pos = []
         for name, x in sorted(xs.items()):
             out.append(x)
 
         # position encoding
-        for x in out:
-            pos.append(self[1](x).to(x.tensors.dtype))
+        with measure(self.latency, 'position_encoding'):
+            for lvl, x in enumerate(out):
+                pos.append(cached(self.shape_cache, ('pos', lvl), lambda: self[1](x).to(x.tensors.dtype)))
 
         return out, pos, predictions
 
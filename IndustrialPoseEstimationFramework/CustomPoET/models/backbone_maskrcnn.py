@@ -56,10 +56,27 @@ class MaskRCNNBackbone(MaskRCNN):
         if dataset == 'lmo':
             self.obj_id_map = {1: 1, 5: 2, 6: 3, 8: 4, 9: 5, 10: 6, 11: 7, 12: 8}
 
-    def forward(self, tensor_list: NestedTensor):
+    def forward(self, tensor_list: NestedTensor, detect=True):
+        # If detect is False, the RPN and ROI heads are skipped and only the feature maps are returned
         image_sizes = [img.shape[-2:] for img in tensor_list.tensors]
         # xs = self.backbone.body(tensor_list.tensors)
         features = self.backbone(tensor_list.tensors)
+        if detect:
+            predictions = self.predict_objects(tensor_list, features, image_sizes)
+        else:
+            predictions = [None] * len(tensor_list.tensors)
+
+        # Prepare the feature map
+        out: Dict[str, NestedTensor] = {}
+        for name in self.return_layers:
+            x = features[name]
+            m = tensor_list.mask
+            assert m is not None
+            mask = F.interpolate(m[None].float(), size=x.shape[-2:]).to(torch.bool)[0]
+            out[name] = NestedTensor(x, mask)
+        return predictions, out
+
+    def predict_objects(self, tensor_list, features, image_sizes):
         # predictions, _ = self.rpn(tensor_list.tensors, features)
 
         # Generate proposals using the RPN
@@ -114,16 +131,7 @@ class MaskRCNNBackbone(MaskRCNN):
             else:
                 img_predictions = torch.stack(img_predictions)
             predictions.append(img_predictions)
-
-        # Prepare the feature map
-        out: Dict[str, NestedTensor] = {}
-        for name in self.return_layers:
-            x = features[name]
-            m = tensor_list.mask
-            assert m is not None
-            mask = F.interpolate(m[None].float(), size=x.shape[-2:]).to(torch.bool)[0]
-            out[name] = NestedTensor(x, mask)
-        return predictions, out
+        return predictions
 
 
 def build_maskrcnn(args):
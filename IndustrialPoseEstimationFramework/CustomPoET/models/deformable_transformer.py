@@ -21,33 +21,66 @@ from torch import nn, Tensor
 from torch.nn.init import xavier_uniform_, constant_, uniform_, normal_
 
 from util.misc import inverse_sigmoid
-from deformable_attention import MSDeformAttn
+from util.latency import StageTimer
+from util.shape_cache import cached
+from .ms_deform_attn import MSDeformAttn as MSDeformAttnPyTorch
+
+try:
+    from deformable_attention import MSDeformAttn as MSDeformAttnCUDA
+except ImportError:
+    MSDeformAttnCUDA = None
+
+MSDEFORM_ATTN_MODULES = tuple(m for m in [MSDeformAttnPyTorch, MSDeformAttnCUDA] if m is not None)
+
+
+def build_ms_deform_attn(backend, d_model, n_levels, n_heads, n_points):
+    """
+    Multi-scale deformable attention of the given backend: 'cuda' uses the compiled extension, 'pytorch' the plain
+    PyTorch implementation. Both have the same parameters, hence the same checkpoints can be loaded.
+    """
+    if backend == 'cuda':
+        if MSDeformAttnCUDA is None:
+            raise ImportError("The 'cuda' deformable attention backend requires the compiled deformable_attention "
+                              "package. Use the 'pytorch' backend instead.")
+        return MSDeformAttnCUDA(d_model, n_levels, n_heads, n_points)
+    elif backend == 'pytorch':
+        return MSDeformAttnPyTorch(d_model, n_levels, n_heads, n_points)
+    else:
+        raise NotImplementedError('Deformable attention backend {} is not supported.'.format(backend))
 
 
 class DeformableTransformer(nn.Module):
     def __init__(self, d_model=256, nhead=8,
                  num_encoder_layers=6, num_decoder_layers=6, dim_feedforward=1024, dropout=0.1,
                  activation="relu", return_intermediate_dec=False,
-                 num_feature_levels=4, dec_n_points=4,  enc_n_points=4):
+                 num_feature_levels=4, dec_n_points=4,  enc_n_points=4, msda_backend='pytorch',
+                 sparse_encoder_margin=None):
         super().__init__()
 
         self.d_model = d_model
         self.nhead = nhead
+        # If set, the encoder only refines the tokens around the query boxes, see select_encoder_tokens
+        self.sparse_encoder_margin = sparse_encoder_margin
 
         encoder_layer = DeformableTransformerEncoderLayer(d_model, dim_feedforward,
                                                           dropout, activation,
-                                                          num_feature_levels, nhead, enc_n_points)
+                                                          num_feature_levels, nhead, enc_n_points, msda_backend)
         self.encoder = DeformableTransformerEncoder(encoder_layer, num_encoder_layers)
 
         decoder_layer = DeformableTransformerDecoderLayer(d_model, dim_feedforward,
                                                           dropout, activation,
-                                                          num_feature_levels, nhead, dec_n_points)
+                                                          num_feature_levels, nhead, dec_n_points, msda_backend)
         self.decoder = DeformableTransformerDecoder(decoder_layer, num_decoder_layers, return_intermediate_dec)
 
         self.level_embed = nn.Parameter(torch.Tensor(num_feature_levels, d_model))
 
         self.reference_points = nn.Linear(d_model, 2)
 
+        # Cache of the inputs derived from the input shape, see util.shape_cache
+        self.shape_cache = None
+        # Latency monitor timing the encoder and decoder, see util.latency.attach
+        self.latency = None
+
         self._reset_parameters()
 
     def _reset_parameters(self):
@@ -55,7 +88,7 @@ class DeformableTransformer(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
         for m in self.modules():
-            if isinstance(m, MSDeformAttn):
+            if isinstance(m, MSDEFORM_ATTN_MODULES):
                 m._reset_parameters()
         xavier_uniform_(self.reference_points.weight.data, gain=1.0)
         constant_(self.reference_points.bias.data, 0.)
@@ -108,6 +141,45 @@ class DeformableTransformer(nn.Module):
         output_memory = self.enc_output_norm(self.enc_output(output_memory))
         return output_memory, output_proposals
 
+    @staticmethod
+    def get_token_centers(spatial_shapes):
+        """
+        Normalized centers (x, y) of the flattened tokens of all levels and half of the token size on their level.
+        """
+        centers = []
+        half_sizes = []
+        for H_, W_ in spatial_shapes.tolist():
+            center_y, center_x = torch.meshgrid(
+                (torch.arange(H_, dtype=torch.float32, device=spatial_shapes.device) + 0.5) / H_,
+                (torch.arange(W_, dtype=torch.float32, device=spatial_shapes.device) + 0.5) / W_, indexing='ij')
+            centers.append(torch.stack((center_x.flatten(), center_y.flatten()), -1))
+            half_sizes.append(centers[-1].new_tensor([0.5 / W_, 0.5 / H_]).expand(H_ * W_, -1))
+        return torch.cat(centers), torch.cat(half_sizes)
+
+    def select_encoder_tokens(self, boxes, spatial_shapes):
+        """
+        Indices of size [batch_size, n_selected] of the tokens the sparse encoder refines: those whose center lies
+        within the boxes enlarged by sparse_encoder_margin times their size on every side and by half a token, such that
+        the token of the box center is selected on every level. The decoder samples around the box centers, hence the
+        remaining tokens hardly influence the result and keep the projected backbone features.
+
+        Batch elements with fewer selected tokens are filled up with their first one, which is refined multiple times
+        with the same result. Returns None if no token is selected in the whole batch.
+        """
+        centers, half_sizes = cached(self.shape_cache, 'encoder_token_centers',
+                                     lambda: self.get_token_centers(spatial_shapes))
+        extent = boxes[:, :, None, 2:] * (0.5 + self.sparse_encoder_margin) + half_sizes
+        selected = ((centers - boxes[:, :, None, :2]).abs() <= extent).all(-1) & (boxes[:, :, None, 2:] > 0).all(-1)
+        selected = selected.any(1)
+        n_selected = selected.sum(1)
+        n_max = int(n_selected.max())
+        if n_max == 0:
+            return None
+        # Selected tokens first, in their original order
+        query_idx = torch.sort(selected.to(torch.uint8), dim=1, descending=True, stable=True)[1][:, :n_max]
+        fill = torch.arange(n_max, device=boxes.device)[None, :] >= n_selected[:, None]
+        return torch.where(fill, query_idx[:, :1], query_idx)
+
     def get_valid_ratio(self, mask):
         _, H, W = mask.shape
         valid_H = torch.sum(~mask[:, :, 0], 1)
@@ -117,34 +189,61 @@ class DeformableTransformer(nn.Module):
         valid_ratio = torch.stack([valid_ratio_w, valid_ratio_h], -1)
         return valid_ratio
 
-    def forward(self, srcs, masks, pos_embeds, query_embed=None, reference_points=None):
-        assert query_embed is not None
-
-        # prepare input for encoder
-        src_flatten = []
+    def prepare_inputs(self, masks, pos_embeds):
+        """
+        Flattens the masks and position embeddings of all levels and determines the spatial shapes, level start indices
+        and valid ratios. All of them only depend on the input shape and padding mask.
+        """
         mask_flatten = []
         lvl_pos_embed_flatten = []
         spatial_shapes = []
-        for lvl, (src, mask, pos_embed) in enumerate(zip(srcs, masks, pos_embeds)):
-            bs, c, h, w = src.shape
+        for lvl, (mask, pos_embed) in enumerate(zip(masks, pos_embeds)):
+            bs, h, w = mask.shape
             spatial_shape = (h, w)
             spatial_shapes.append(spatial_shape)
-            src = src.flatten(2).transpose(1, 2)
             mask = mask.flatten(1)
             pos_embed = pos_embed.flatten(2).transpose(1, 2)
             lvl_pos_embed = pos_embed + self.level_embed[lvl].view(1, 1, -1)
             lvl_pos_embed_flatten.append(lvl_pos_embed)
-            src_flatten.append(src)
             mask_flatten.append(mask)
-        src_flatten = torch.cat(src_flatten, 1)
         mask_flatten = torch.cat(mask_flatten, 1)
         lvl_pos_embed_flatten = torch.cat(lvl_pos_embed_flatten, 1)
-        spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long, device=src_flatten.device)
+        spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long, device=mask_flatten.device)
         level_start_index = torch.cat((spatial_shapes.new_zeros((1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
         valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
+        return mask_flatten, lvl_pos_embed_flatten, spatial_shapes, level_start_index, valid_ratios
+
+    def forward(self, srcs, masks, pos_embeds, query_embed=None, reference_points=None, query_attn_mask=None,
+                boxes=None, early_exit=None):
+        """
+        query_attn_mask is an optional float mask of size [batch_size * nhead, n_queries, n_queries], which is added to
+        the attention logits of the self attention of the decoder.
+        boxes of size [batch_size, n_queries, 4] (cx, cy, w, h) are the query boxes, dummy boxes have a negative size.
+        They are required by the sparse encoder, which is only used in evaluation mode.
+        early_exit is an optional callable, which is called with the index and output of each decoder layer. The
+        decoding stops after the first layer it returns True for.
+        """
+        assert query_embed is not None
+
+        # prepare input for encoder
+        src_flatten = torch.cat([src.flatten(2).transpose(1, 2) for src in srcs], 1)
+        mask_flatten, lvl_pos_embed_flatten, spatial_shapes, level_start_index, valid_ratios = cached(
+            self.shape_cache, 'transformer_inputs', lambda: self.prepare_inputs(masks, pos_embeds))
 
         # encoder
-        memory = self.encoder(src_flatten, spatial_shapes, level_start_index, valid_ratios, lvl_pos_embed_flatten, mask_flatten)
+        timer = StageTimer(self.latency)
+        timer.start('encoder')
+        # The sparse encoder is an inference-time approximation, training always refines all tokens
+        if self.sparse_encoder_margin is not None and boxes is not None and not self.training:
+            query_idx = self.select_encoder_tokens(boxes, spatial_shapes)
+            if query_idx is None:
+                # No boxes at all, the memory consists of the projected backbone features
+                memory = src_flatten
+            else:
+                memory = self.encoder(src_flatten, spatial_shapes, level_start_index, valid_ratios,
+                                      lvl_pos_embed_flatten, mask_flatten, query_idx)
+        else:
+            memory = self.encoder(src_flatten, spatial_shapes, level_start_index, valid_ratios, lvl_pos_embed_flatten, mask_flatten)
 
         # prepare input for decoder
         bs, _, c = memory.shape
@@ -159,8 +258,11 @@ class DeformableTransformer(nn.Module):
         init_reference_out = reference_points
 
         # decoder
+        timer.start('decoder')
         hs, inter_references = self.decoder(tgt, reference_points, memory,
-                                            spatial_shapes, level_start_index, valid_ratios, query_embed, mask_flatten)
+                                            spatial_shapes, level_start_index, valid_ratios, query_embed, mask_flatten,
+                                            query_attn_mask, early_exit)
+        timer.stop()
 
         inter_references_out = inter_references
         return hs, init_reference_out, inter_references_out, None, None
@@ -170,11 +272,11 @@ class DeformableTransformerEncoderLayer(nn.Module):
     def __init__(self,
                  d_model=256, d_ffn=1024,
                  dropout=0.1, activation="relu",
-                 n_levels=4, n_heads=8, n_points=4):
+                 n_levels=4, n_heads=8, n_points=4, msda_backend='pytorch'):
         super().__init__()
 
         # self attention
-        self.self_attn = MSDeformAttn(d_model, n_levels, n_heads, n_points)
+        self.self_attn = build_ms_deform_attn(msda_backend, d_model, n_levels, n_heads, n_points)
         self.dropout1 = nn.Dropout(dropout)
         self.norm1 = nn.LayerNorm(d_model)
 
@@ -196,7 +298,17 @@ class DeformableTransformerEncoderLayer(nn.Module):
         src = self.norm2(src)
         return src
 
-    def forward(self, src, pos, reference_points, spatial_shapes, level_start_index, padding_mask=None):
+    def forward(self, src, pos, reference_points, spatial_shapes, level_start_index, padding_mask=None,
+                query_idx=None):
+        if query_idx is not None:
+            # Sparse encoder: only the tokens query_idx attend to the feature maps and are refined
+            query_idx = query_idx[:, :, None].expand(-1, -1, src.shape[-1])
+            query = src.gather(1, query_idx)
+            src2 = self.self_attn(query + pos.gather(1, query_idx), reference_points, src, spatial_shapes,
+                                  level_start_index, padding_mask)
+            query = self.norm1(query + self.dropout1(src2))
+            return src.scatter(1, query_idx, self.forward_ffn(query))
+
         # self attention
         src2 = self.self_attn(self.with_pos_embed(src, pos), reference_points, src, spatial_shapes, level_start_index, padding_mask)
         src = src + self.dropout1(src2)
@@ -213,6 +325,8 @@ class DeformableTransformerEncoder(nn.Module):
         super().__init__()
         self.layers = _get_clones(encoder_layer, num_layers)
         self.num_layers = num_layers
+        # Cache of the reference points, see util.shape_cache
+        self.shape_cache = None
 
     @staticmethod
     def get_reference_points(spatial_shapes, valid_ratios, device):
@@ -229,11 +343,16 @@ class DeformableTransformerEncoder(nn.Module):
         reference_points = reference_points[:, :, None] * valid_ratios[:, None]
         return reference_points
 
-    def forward(self, src, spatial_shapes, level_start_index, valid_ratios, pos=None, padding_mask=None):
+    def forward(self, src, spatial_shapes, level_start_index, valid_ratios, pos=None, padding_mask=None,
+                query_idx=None):
         output = src
-        reference_points = self.get_reference_points(spatial_shapes, valid_ratios, device=src.device)
+        reference_points = cached(self.shape_cache, 'encoder_reference_points',
+                                  lambda: self.get_reference_points(spatial_shapes, valid_ratios, device=src.device))
+        if query_idx is not None:
+            reference_points = reference_points.gather(
+                1, query_idx[:, :, None, None].expand(-1, -1, *reference_points.shape[2:]))
         for _, layer in enumerate(self.layers):
-            output = layer(output, pos, reference_points, spatial_shapes, level_start_index, padding_mask)
+            output = layer(output, pos, reference_points, spatial_shapes, level_start_index, padding_mask, query_idx)
 
         return output
 
@@ -241,11 +360,11 @@ class DeformableTransformerEncoder(nn.Module):
 class DeformableTransformerDecoderLayer(nn.Module):
     def __init__(self, d_model=256, d_ffn=1024,
                  dropout=0.1, activation="relu",
-                 n_levels=4, n_heads=8, n_points=4):
+                 n_levels=4, n_heads=8, n_points=4, msda_backend='pytorch'):
         super().__init__()
 
         # cross attention
-        self.cross_attn = MSDeformAttn(d_model, n_levels, n_heads, n_points)
+        self.cross_attn = build_ms_deform_attn(msda_backend, d_model, n_levels, n_heads, n_points)
         self.dropout1 = nn.Dropout(dropout)
         self.norm1 = nn.LayerNorm(d_model)
 
@@ -272,10 +391,12 @@ class DeformableTransformerDecoderLayer(nn.Module):
         tgt = self.norm3(tgt)
         return tgt
 
-    def forward(self, tgt, query_pos, reference_points, src, src_spatial_shapes, level_start_index, src_padding_mask=None):
+    def forward(self, tgt, query_pos, reference_points, src, src_spatial_shapes, level_start_index, src_padding_mask=None,
+                self_attn_mask=None):
         # self attention
         q = k = self.with_pos_embed(tgt, query_pos)
-        tgt2 = self.self_attn(q.transpose(0, 1), k.transpose(0, 1), tgt.transpose(0, 1))[0].transpose(0, 1)
+        tgt2 = self.self_attn(q.transpose(0, 1), k.transpose(0, 1), tgt.transpose(0, 1),
+                              attn_mask=self_attn_mask)[0].transpose(0, 1)
         tgt = tgt + self.dropout2(tgt2)
         tgt = self.norm2(tgt)
 
@@ -303,7 +424,7 @@ class DeformableTransformerDecoder(nn.Module):
         self.class_embed = None
 
     def forward(self, tgt, reference_points, src, src_spatial_shapes, src_level_start_index, src_valid_ratios,
-                query_pos=None, src_padding_mask=None):
+                query_pos=None, src_padding_mask=None, self_attn_mask=None, early_exit=None):
         output = tgt
 
         intermediate = []
@@ -315,7 +436,8 @@ class DeformableTransformerDecoder(nn.Module):
             else:
                 assert reference_points.shape[-1] == 2
                 reference_points_input = reference_points[:, :, None] * src_valid_ratios[:, None]
-            output = layer(output, query_pos, reference_points_input, src, src_spatial_shapes, src_level_start_index, src_padding_mask)
+            output = layer(output, query_pos, reference_points_input, src, src_spatial_shapes, src_level_start_index,
+                           src_padding_mask, self_attn_mask)
 
             # hack implementation for iterative bounding box refinement
             if self.bbox_embed is not None:
@@ -334,6 +456,9 @@ class DeformableTransformerDecoder(nn.Module):
                 intermediate.append(output)
                 intermediate_reference_points.append(reference_points)
 
+            if early_exit is not None and early_exit(lid, output):
+                break
+
         if self.return_intermediate:
             return torch.stack(intermediate), torch.stack(intermediate_reference_points)
 
@@ -356,6 +481,10 @@ def _get_activation_fn(activation):
 
 
 def build_deforamble_transformer(args):
+    # 'auto' uses the compiled CUDA extension if it is installed and the model runs on the GPU
+    msda_backend = args.msda_backend
+    if msda_backend == 'auto':
+        msda_backend = 'cuda' if MSDeformAttnCUDA is not None and args.device.startswith('cuda') else 'pytorch'
     return DeformableTransformer(
         d_model=args.hidden_dim,
         nhead=args.nheads,
@@ -367,6 +496,8 @@ def build_deforamble_transformer(args):
         return_intermediate_dec=True,
         num_feature_levels=args.num_feature_levels,
         dec_n_points=args.dec_n_points,
-        enc_n_points=args.enc_n_points)
+        enc_n_points=args.enc_n_points,
+        msda_backend=msda_backend,
+        sparse_encoder_margin=args.sparse_encoder_margin if args.sparse_encoder else None)
 
 
@@ -0,0 +1,188 @@
+# ------------------------------------------------------------------------
+# PoET: Pose Estimation Transformer for Single-View, Multi-Object 6D Pose Estimation
+# Copyright (c) 2022 Thomas Jantos (thomas.jantos@aau.at), University of Klagenfurt - Control of Networked Systems (CNS). All Rights Reserved.
+# Licensed under the BSD-2-Clause-License with no commercial use [see LICENSE for details]
+# ------------------------------------------------------------------------
+# Modified from Deformable DETR (https://github.com/fundamentalvision/Deformable-DETR)
+# Copyright (c) 2020 SenseTime. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 [see LICENSE_DEFORMABLE_DETR in the LICENSES folder for details]
+# ------------------------------------------------------------------------
+
+"""
+Multi-scale deformable attention in plain PyTorch, which does not require the compiled CUDA extension and hence also
+runs on the CPU. The module has the same parameters as the MSDeformAttn module of the extension, such that checkpoints
+can be loaded with either implementation.
+"""
+import math
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.nn.init import xavier_uniform_, constant_
+
+
+def ms_deform_attn_core_pytorch(value, value_spatial_shapes, sampling_locations, attention_weights, pack_levels=True):
+    """
+    Samples the values of all levels, heads and points with a single grid_sample call, unless there are fewer samples
+    than values or pack_levels is False.
+
+    The value maps of all levels are packed into one canvas, one level below the other and separated by a row of zeros.
+    Together with a column of zeros right of every level, bilinear samples close to the border of a level interpolate
+    with zeros, exactly as grid_sample with zero padding on the level itself. Samples that lie completely outside their
+    level get an attention weight of 0. The canvas is stored channels last, which makes both packing the values and
+    sampling them considerably faster on the CPU, as the head_dim values of a pixel are contiguous.
+
+    Parameters:
+        value: tensor of size [N, S, n_heads, head_dim], flattened value maps of all levels
+        value_spatial_shapes: tensor of size [n_levels, 2], height and width of each level
+        sampling_locations: tensor of size [N, Len_q, n_heads, n_levels, n_points, 2], normalized (x, y) locations
+        attention_weights: tensor of size [N, Len_q, n_heads, n_levels, n_points]
+    Returns a tensor of size [N, Len_q, n_heads * head_dim].
+    """
+    N_, S_, M_, D_ = value.shape
+    _, Lq_, _, L_, P_, _ = sampling_locations.shape
+    shapes = [(int(H_), int(W_)) for H_, W_ in value_spatial_shapes]
+    if not pack_levels or Lq_ * L_ * P_ < S_:
+        # Few samples, e.g. the cross attention of the decoder queries: packing the value maps would take longer than
+        # sampling them, hence every level is sampled directly
+        return ms_deform_attn_core_pytorch_levels(value, shapes, sampling_locations, attention_weights)
+
+    # Pack the levels into the canvas: level l starts at row offsets[l], followed by one row of zeros
+    offsets = [0]
+    for H_, _ in shapes[:-1]:
+        offsets.append(offsets[-1] + H_ + 1)
+    canvas_h = offsets[-1] + shapes[-1][0]
+    canvas_w = max(W_ for _, W_ in shapes) + 1
+    canvas = value.new_zeros(N_, M_, canvas_h, canvas_w, D_)
+    value_list = value.split([H_ * W_ for H_, W_ in shapes], dim=1)
+    for lid_, (H_, W_) in enumerate(shapes):
+        # N, H*W, M, D -> N, M, H, W, D
+        canvas[:, :, offsets[lid_]:offsets[lid_] + H_, :W_] = value_list[lid_].view(N_, H_, W_, M_, D_).permute(0, 3, 1, 2, 4)
+    # N*M, D, H, W view of the channels last canvas
+    canvas = canvas.view(N_ * M_, canvas_h, canvas_w, D_).permute(0, 3, 1, 2)
+
+    # Pixel coordinates (pixel centers at integers) of the sampling locations within their level
+    sizes = sampling_locations.new_tensor([[W_, H_] for H_, W_ in shapes])
+    pixels = sampling_locations * sizes[:, None, :] - 0.5
+    inside = ((pixels > -1) & (pixels < sizes[:, None, :])).all(-1)
+    # Shift to the canvas and normalize to [-1, 1] for grid_sample with align_corners=False
+    pixels[..., 1] += sampling_locations.new_tensor(offsets)[:, None]
+    canvas_size = sampling_locations.new_tensor([canvas_w, canvas_h])
+    grid = (2 * pixels + 1) / canvas_size - 1
+    # N, Len_q, M, L, P, 2 -> N*M, Len_q, L*P, 2
+    grid = grid.transpose(1, 2).reshape(N_ * M_, Lq_, L_ * P_, 2)
+
+    # N*M, D, Len_q, L*P
+    sampling_values = F.grid_sample(canvas, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+    # N, Len_q, M, L, P -> N*M, 1, Len_q, L*P
+    attention_weights = (attention_weights * inside).transpose(1, 2).reshape(N_ * M_, 1, Lq_, L_ * P_)
+    output = sampling_values.mul_(attention_weights).sum(-1).view(N_, M_ * D_, Lq_)
+    return output.transpose(1, 2).contiguous()
+
+
+def ms_deform_attn_core_pytorch_levels(value, shapes, sampling_locations, attention_weights):
+    """
+    Samples the values with one grid_sample call per level on views of the value maps, as in Deformable DETR.
+    """
+    N_, S_, M_, D_ = value.shape
+    _, Lq_, _, L_, P_, _ = sampling_locations.shape
+    value_list = value.split([H_ * W_ for H_, W_ in shapes], dim=1)
+    sampling_grids = 2 * sampling_locations - 1
+    sampling_value_list = []
+    for lid_, (H_, W_) in enumerate(shapes):
+        # N, H*W, M, D -> N*M, D, H, W
+        value_l_ = value_list[lid_].flatten(2).transpose(1, 2).reshape(N_ * M_, D_, H_, W_)
+        # N, Len_q, M, P, 2 -> N*M, Len_q, P, 2
+        sampling_grid_l_ = sampling_grids[:, :, :, lid_].transpose(1, 2).flatten(0, 1)
+        # N*M, D, Len_q, P
+        sampling_value_l_ = F.grid_sample(value_l_, sampling_grid_l_, mode='bilinear', padding_mode='zeros',
+                                          align_corners=False)
+        sampling_value_list.append(sampling_value_l_)
+    # N, Len_q, M, L, P -> N*M, 1, Len_q, L*P
+    attention_weights = attention_weights.transpose(1, 2).reshape(N_ * M_, 1, Lq_, L_ * P_)
+    output = (torch.stack(sampling_value_list, dim=-2).flatten(-2) * attention_weights).sum(-1).view(N_, M_ * D_, Lq_)
+    return output.transpose(1, 2).contiguous()
+
+
+class MSDeformAttn(nn.Module):
+    def __init__(self, d_model=256, n_levels=4, n_heads=8, n_points=4):
+        """
+        Multi-Scale Deformable Attention Module
+        :param d_model      hidden dimension
+        :param n_levels     number of feature levels
+        :param n_heads      number of attention heads
+        :param n_points     number of sampling points per attention head per feature level
+        """
+        super().__init__()
+        if d_model % n_heads != 0:
+            raise ValueError('d_model must be divisible by n_heads, but got {} and {}'.format(d_model, n_heads))
+
+        self.d_model = d_model
+        self.n_levels = n_levels
+        self.n_heads = n_heads
+        self.n_points = n_points
+        # Packing the levels is faster in PyTorch, but not in every runtime the module is exported to, see
+        # ms_deform_attn_core_pytorch
+        self.pack_levels = True
+
+        self.sampling_offsets = nn.Linear(d_model, n_heads * n_levels * n_points * 2)
+        self.attention_weights = nn.Linear(d_model, n_heads * n_levels * n_points)
+        self.value_proj = nn.Linear(d_model, d_model)
+        self.output_proj = nn.Linear(d_model, d_model)
+
+        self._reset_parameters()
+
+    def _reset_parameters(self):
+        constant_(self.sampling_offsets.weight.data, 0.)
+        thetas = torch.arange(self.n_heads, dtype=torch.float32) * (2.0 * math.pi / self.n_heads)
+        grid_init = torch.stack([thetas.cos(), thetas.sin()], -1)
+        grid_init = (grid_init / grid_init.abs().max(-1, keepdim=True)[0]).view(self.n_heads, 1, 1, 2).repeat(1, self.n_levels, self.n_points, 1)
+        for i in range(self.n_points):
+            grid_init[:, :, i, :] *= i + 1
+        with torch.no_grad():
+            self.sampling_offsets.bias = nn.Parameter(grid_init.view(-1))
+        constant_(self.attention_weights.weight.data, 0.)
+        constant_(self.attention_weights.bias.data, 0.)
+        xavier_uniform_(self.value_proj.weight.data)
+        constant_(self.value_proj.bias.data, 0.)
+        xavier_uniform_(self.output_proj.weight.data)
+        constant_(self.output_proj.bias.data, 0.)
+
+    def forward(self, query, reference_points, input_flatten, input_spatial_shapes, input_level_start_index, input_padding_mask=None):
+        """
+        :param query                       (N, Length_{query}, C)
+        :param reference_points            (N, Length_{query}, n_levels, 2), range in [0, 1], top-left (0,0), bottom-right (1, 1), including padding area
+                                        or (N, Length_{query}, n_levels, 4), add additional (w, h) to form reference boxes
+        :param input_flatten               (N, \\sum_{l=0}^{L-1} H_l \\cdot W_l, C)
+        :param input_spatial_shapes        (n_levels, 2), [(H_0, W_0), (H_1, W_1), ..., (H_{L-1}, W_{L-1})]
+        :param input_level_start_index     (n_levels, ), [0, H_0*W_0, H_0*W_0+H_1*W_1, H_0*W_0+H_1*W_1+H_2*W_2, ..., H_0*W_0+H_1*W_1+...+H_{L-1}*W_{L-1}]
+        :param input_padding_mask          (N, \\sum_{l=0}^{L-1} H_l \\cdot W_l), True for padding elements, False for non-padding elements
+
+        :return output                     (N, Length_{query}, C)
+        """
+        N, Len_q, _ = query.shape
+        N, Len_in, _ = input_flatten.shape
+        assert (input_spatial_shapes[:, 0] * input_spatial_shapes[:, 1]).sum() == Len_in
+
+        value = self.value_proj(input_flatten)
+        if input_padding_mask is not None:
+            value = value.masked_fill(input_padding_mask[..., None], float(0))
+        value = value.view(N, Len_in, self.n_heads, self.d_model // self.n_heads)
+        sampling_offsets = self.sampling_offsets(query).view(N, Len_q, self.n_heads, self.n_levels, self.n_points, 2)
+        attention_weights = self.attention_weights(query).view(N, Len_q, self.n_heads, self.n_levels * self.n_points)
+        attention_weights = F.softmax(attention_weights, -1).view(N, Len_q, self.n_heads, self.n_levels, self.n_points)
+        # N, Len_q, n_heads, n_levels, n_points, 2
+        if reference_points.shape[-1] == 2:
+            offset_normalizer = torch.stack([input_spatial_shapes[..., 1], input_spatial_shapes[..., 0]], -1)
+            sampling_locations = reference_points[:, :, None, :, None, :] \
+                                 + sampling_offsets / offset_normalizer[None, None, None, :, None, :]
+        elif reference_points.shape[-1] == 4:
+            sampling_locations = reference_points[:, :, None, :, None, :2] \
+                                 + sampling_offsets / self.n_points * reference_points[:, :, None, :, None, 2:] * 0.5
+        else:
+            raise ValueError(
+                'Last dim of reference_points must be 2 or 4, but get {} instead.'.format(reference_points.shape[-1]))
+        output = ms_deform_attn_core_pytorch(value, input_spatial_shapes, sampling_locations, attention_weights,
+                                             self.pack_levels)
+        output = self.output_proj(output)
+        return output
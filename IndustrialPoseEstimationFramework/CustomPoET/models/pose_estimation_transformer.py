@@ -11,12 +11,16 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 # ------------------------------------------------------------------------
 
+import math
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.nn.utils.rnn import pad_sequence
 
 from util import box_ops
 from util.misc import (NestedTensor, nested_tensor_from_tensor_list)
+from util.latency import StageTimer
+from util.shape_cache import ShapeCache, cached
 from .backbone import build_backbone
 from .matcher import build_matcher
 from .deformable_transformer import build_deforamble_transformer
@@ -28,13 +32,58 @@ def _get_clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for i in range(N)])
 
 
+def pad_query_boxes(query_boxes, n_queries):
+    """
+    Stacks the externally supplied boxes (cx, cy, w, h) and labels of all batch elements into tensors of size
+    [batch_size, n_queries, 4] and [batch_size, n_queries], filled up with dummy boxes [-1, -1, -1, -1] of class -1.
+    Dummy boxes will later be filtered out by the matcher and not used for cost calculation.
+    """
+    n_boxes_per_sample = [len(target["boxes"]) for target in query_boxes]
+    n_queries = max([n_queries] + n_boxes_per_sample)
+    pred_boxes = pad_sequence([target["boxes"] for target in query_boxes], batch_first=True, padding_value=-1)
+    pred_classes = pad_sequence([target["labels"] for target in query_boxes], batch_first=True, padding_value=-1)
+    pred_boxes = F.pad(pred_boxes, (0, 0, 0, n_queries - pred_boxes.shape[1]), value=-1)
+    pred_classes = F.pad(pred_classes, (0, n_queries - pred_classes.shape[1]), value=-1)
+    return pred_boxes, pred_classes, n_boxes_per_sample
+
+
+def pad_backbone_predictions(pred_objects, n_queries, image_size, device):
+    """
+    Converts the objects predicted by the backbone (x1, y1, x2, y2, score, class) of all batch elements into
+    normalized boxes (cx, cy, w, h) and classes of size [batch_size, n_queries, 4] and [batch_size, n_queries]. If
+    more objects than queries are predicted, the ones with the highest scores are kept. Filled up with dummy boxes
+    [-1, -1, -1, -1] of class -1.
+    """
+    # Case: Backbone has not predicted anything for image --> only dummy boxes
+    predictions = [p if p is not None else torch.zeros((0, 6), device=device) for p in pred_objects]
+    n_boxes_per_sample = [min(len(p), n_queries) for p in predictions]
+    # Padded predictions get a score of -1, such that they are sorted behind all predicted objects
+    predictions = pad_sequence(predictions, batch_first=True, padding_value=-1)
+    if predictions.shape[1] > n_queries:
+        # Case: backbone predicts more output objects than queries available --> take top n_queries.
+        # NMS returns the objects sorted by score, hence the stable sort keeps the order of the others.
+        _, indices = torch.sort(predictions[:, :, 4], dim=1, descending=True, stable=True)
+        indices = indices[:, :n_queries, None].expand(-1, -1, predictions.shape[-1])
+        predictions = predictions.gather(1, indices)
+    else:
+        predictions = F.pad(predictions, (0, 0, 0, n_queries - predictions.shape[1]), value=-1)
+
+    valid = PoET.valid_queries(n_boxes_per_sample, n_queries, device)
+    # TODO: Adapt to different image sizes as we assume constant image size across the batch
+    pred_boxes = box_ops.box_normalize_cxcywh(box_ops.box_xyxy_to_cxcywh(predictions[:, :, :4]), image_size)
+    pred_boxes = pred_boxes.masked_fill(~valid[:, :, None], -1)
+    # Predicted classes by backbone // class 0 is "background"
+    pred_classes = predictions[:, :, 5].type(torch.int64).masked_fill(~valid, -1)
+    return pred_boxes, pred_classes, n_boxes_per_sample
+
+
 class PoET(nn.Module):
     """
     Pose Estimation Transformer module that performs 6D, multi-object relative pose estimation.
     """
     def __init__(self, backbone, transformer, num_queries, num_feature_levels, n_classes, bbox_mode='gt',
                  ref_points_mode='bbox', query_embedding_mode='bbox', rotation_mode='6d', class_mode='agnostic',
-                 aux_loss=True, backbone_type="yolo"):
+                 aux_loss=True, backbone_type="yolo", early_exit=None):
         """
         Initalizing the model.
         Parameters:
@@ -51,6 +100,8 @@ class PoET(nn.Module):
             class_mode: determines whether PoET is trained class specific or agnostic
             aux_loss: True if auxiliary decoding losses (loss at each decoder layer) are to be used.
             backbone_type: object detector backbone type
+            early_exit: optional tuple (rotation threshold in degrees, translation threshold), which enables the early
+            exit of the decoder during inference, see EarlyExit.
         """
         super().__init__()
         self.transformer = transformer
@@ -66,6 +117,9 @@ class PoET(nn.Module):
         self.query_embedding_mode = query_embedding_mode
         self.rotation_mode = rotation_mode
         self.class_mode = class_mode
+        self.early_exit = early_exit
+        # Latency monitor timing the query construction, transformer and heads, see util.latency.attach
+        self.latency = None
 
         # Determine Translation and Rotation head output dimension
         self.t_dim = 3
@@ -139,7 +193,14 @@ class PoET(nn.Module):
         else:
             raise NotImplementedError('This query embedding mode is not implemented.')
 
-    def forward(self, samples: NestedTensor, targets=None):
+        # During inference, the tensors that only depend on the input shape and padding mask are computed once and
+        # reused as long as the input shape does not change. The cache is shared with the backbone and transformer.
+        self.shape_cache = ShapeCache()
+        for module in self.modules():
+            if hasattr(module, 'shape_cache'):
+                module.shape_cache = self.shape_cache
+
+    def forward(self, samples: NestedTensor, targets=None, query_boxes=None):
         """
         Function expects a NestedTensor, which consists of:
             - samples.tensor: batched images, of shape [batch_size x 3 x H x W]
@@ -155,6 +216,10 @@ class PoET(nn.Module):
             - relative_rotation: tensor of size [n_obj, 3, 3], contains the relative rotation for each object present
             in the image w.r.t. the camera.
 
+        Optionally, the query boxes can be supplied externally independent of the bbox mode, e.g. by a tracker. In
+        this case query_boxes is a list of length batch_size, where each element is a dict with the entries boxes and
+        labels as in targets. The object detector then only computes the feature maps and skips its detection heads.
+
 
         It returns a dict with the following elements:
             - pred_translation: tensor of size [batch_size, n_queries, 3], predicted relative translation for each
@@ -167,6 +232,8 @@ class PoET(nn.Module):
             object query
             - aux_outputs: Optional, only returned when auxiliary losses are activated. It is a list of dictionaries
             containing the output values for each decoder layer.
+        During inference, dummy queries are not decoded individually (see pack_queries) and the outputs of batch
+        elements without any box are 0.
 
         It returns a list "n_boxes_per_sample" of length [batch_size, 1], which contains the number of
         """
@@ -174,130 +241,103 @@ class PoET(nn.Module):
         if not isinstance(samples, NestedTensor):
             samples = nested_tensor_from_tensor_list(samples)
 
+        if self.training:
+            return self._forward(samples, targets, query_boxes)
+        with self.shape_cache.activate(samples.mask, samples.tensors.dtype):
+            return self._forward(samples, targets, query_boxes)
+
+    def _forward(self, samples, targets, query_boxes):
         # Store the image size in HxW
         image_sizes = [[sample.shape[-2], sample.shape[-1]] for sample in samples.tensors]
-        features, pos, pred_objects = self.backbone(samples)
-
-        # Extract the bounding boxes for each batch element
-        pred_boxes = []
-        pred_classes = []
-        query_embeds = []
-        n_boxes_per_sample = []
 
         # Depending on the bbox mode, we either use ground truth bounding boxes or backbone predicted bounding boxes for
-        # transformer query input embedding calculation.
-        if self.bbox_mode in ['gt', 'jitter'] and targets is not None:
-            for t, target in enumerate(targets):
-                # GT from COCO loaded as x1,y1,x2,y2, but by data loader transformed to cx, cy, w, h and normalized
-                if self.bbox_mode == 'gt':
-                    t_boxes = target["boxes"]
-                elif self.bbox_mode == 'jitter':
-                    t_boxes = target["jitter_boxes"]
-                n_boxes = len(t_boxes)
-                n_boxes_per_sample.append(n_boxes)
-
-                # Add classes
-                t_classes = target["labels"]
-
-                # For the current number of boxes determine the query embedding
-                query_embed = self.bbox_embedding(t_boxes)
-                # As the embedding will serve as the query and key for attention, duplicate it to be later splitted
-                query_embed = query_embed.repeat(1, 2)
-
-                # We always predict a fixed number of object poses per image set to the maximum number of objects
-                # present in a single image throughout the whole dataset. Check whether this upper limit is reached,
-                # otherwise fill up with dummy embeddings that are defined as cx,cy,w,h = [-1, -1, -1, -1]
-                # Dummy boxes will later be filtered out by the matcher and not used for cost calculation
-                if n_boxes < self.n_queries:
-                    dummy_boxes = torch.tensor([[-1, -1, -1, -1] for i in range(self.n_queries-n_boxes)],
-                                               dtype=torch.float32, device=t_boxes.device)
-
-                    dummy_embed = torch.tensor([[-10] for i in range(self.n_queries-n_boxes)],
-                                               dtype=torch.float32, device=t_boxes.device)
-                    dummy_embed = dummy_embed.repeat(1, self.hidden_dim*2)
-                    t_boxes = torch.vstack((t_boxes, dummy_boxes))
-                    query_embed = torch.cat([query_embed, dummy_embed], dim=0)
-                    dummy_classes = torch.tensor([-1 for i in range(self.n_queries-n_boxes)],
-                                               dtype=torch.int, device=t_boxes.device)
-                    t_classes = torch.cat((t_classes, dummy_classes))
-                pred_boxes.append(t_boxes)
-                query_embeds.append(query_embed)
-                pred_classes.append(t_classes)
+        # transformer query input embedding calculation, unless the query boxes are supplied externally.
+        if query_boxes is None and self.bbox_mode in ['gt', 'jitter'] and targets is not None:
+            # GT from COCO loaded as x1,y1,x2,y2, but by data loader transformed to cx, cy, w, h and normalized
+            box_key = "boxes" if self.bbox_mode == 'gt' else "jitter_boxes"
+            query_boxes = [{"boxes": target[box_key], "labels": target["labels"]} for target in targets]
+        features, pos, pred_objects = self.backbone(samples, detect=query_boxes is None)
+
+        timer = StageTimer(self.latency)
+        timer.start('queries')
+
+        # Pad the boxes of each batch element with dummy boxes to the fixed number of queries, either from the
+        # externally supplied query boxes or from the boxes predicted by the backbone
+        if query_boxes is not None:
+            pred_boxes, pred_classes, n_boxes_per_sample = self.pad_query_boxes(query_boxes)
         elif self.bbox_mode == 'backbone':
-            # Prepare the output predicted by the backbone
-            # Iterate over batch and prepare each image in batch
-            for bs, predictions in enumerate(pred_objects):
-                if predictions is None:
-                    # Case: Backbone has not predicted anything for image
-                    # Add only dummy boxes, but mark that nothing has been predicted
-                    n_boxes = 0
-                    n_boxes_per_sample.append(n_boxes)
-                    backbone_boxes = torch.tensor([[-1, -1, -1, -1] for i in range(self.n_queries - n_boxes)],
-                                                  dtype=torch.float32, device=features[0].decompose()[0].device)
-                    query_embed = torch.tensor([[-10] for i in range(self.n_queries - n_boxes)],
-                                               dtype=torch.float32, device=features[0].decompose()[0].device)
-                    query_embed = query_embed.repeat(1, self.hidden_dim * 2)
-                    backbone_classes = torch.tensor([-1 for i in range(self.n_queries - n_boxes)], dtype=torch.int64,
-                                                    device=features[0].decompose()[0].device)
-                else:
-                    # Case: Backbone predicted something
-                    backbone_boxes = predictions[:, :4]
-                    backbone_boxes = box_ops.box_xyxy_to_cxcywh(backbone_boxes)
-                    # TODO: Adapt to different image sizes as we assume constant image size across the batch
-                    backbone_boxes = box_ops.box_normalize_cxcywh(backbone_boxes, image_sizes[0])
-                    n_boxes = len(backbone_boxes)
-
-                    # Predicted classes by backbone // class 0 is "background"
-                    # Scores predicted by the backbone are needed for top-k selection
-                    backbone_scores = predictions[:, 4]
-                    backbone_classes = predictions[:, 5]
-                    backbone_classes = backbone_classes.type(torch.int64)
-
-                    # For the current number of boxes determine the query embedding
-                    query_embed = self.bbox_embedding(backbone_boxes)
-                    # As the embedding will serve as the query and key for attention, duplicate it to be later splitted
-                    query_embed = query_embed.repeat(1, 2)
-
-                    if n_boxes < self.n_queries:
-                        # Fill up with dummy boxes to match the query size and add dummy embeddings
-                        dummy_boxes = torch.tensor([[-1, -1, -1, -1] for i in range(self.n_queries - n_boxes)],
-                                                   dtype=torch.float32, device=backbone_boxes.device)
-                        dummy_embed = torch.tensor([[-10] for i in range(self.n_queries - n_boxes)],
-                                                   dtype=torch.float32, device=backbone_boxes.device)
-                        dummy_embed = dummy_embed.repeat(1, self.hidden_dim * 2)
-                        backbone_boxes = torch.cat([backbone_boxes, dummy_boxes], dim=0)
-                        query_embed = torch.cat([query_embed, dummy_embed], dim=0)
-                        dummy_classes = torch.tensor([-1 for i in range(self.n_queries - n_boxes)],
-                                                     dtype=torch.int64, device=backbone_boxes.device)
-                        backbone_classes = torch.cat([backbone_classes, dummy_classes], dim=0)
-                    elif n_boxes > self.n_queries:
-                        # Number of boxes will be limited to the number of queries
-                        n_boxes = self.n_queries
-                        # Case: backbone predicts more output objects than queries available --> take top n_queries
-                        # Sort scores to get the post top performing ones
-                        backbone_scores, indices = torch.sort(backbone_scores, dim=0, descending=True)
-                        backbone_classes = backbone_classes[indices]
-                        backbone_boxes = backbone_boxes[indices, :]
-                        query_embed = query_embed[indices, :]
-
-                        # Take the top n predictions
-                        backbone_scores = backbone_scores[:self.n_queries]
-                        backbone_classes = backbone_classes[:self.n_queries]
-                        backbone_boxes = backbone_boxes[:self.n_queries]
-                        query_embed = query_embed[:self.n_queries]
-                    n_boxes_per_sample.append(n_boxes)
-                pred_boxes.append(backbone_boxes)
-                pred_classes.append(backbone_classes)
-                query_embeds.append(query_embed)
+            pred_boxes, pred_classes, n_boxes_per_sample = self.pad_backbone_predictions(
+                pred_objects, image_sizes[0], features[0].tensors.device)
         else:
             raise NotImplementedError("PoET Bounding Box Mode not implemented!")
+        query_embeds = self.embed_query_boxes(pred_boxes, n_boxes_per_sample)
+
+        timer.start('transformer')
+        exit_layers = None
+        if self.training or self.query_embedding_mode != 'bbox' or self.ref_points_mode != 'bbox':
+            hs = self.decode(samples, features, pos, query_embeds, pred_boxes)
+            timer.start('heads')
+            outputs_rotation, outputs_translation = self.predict_poses(hs, pred_classes)
+        else:
+            # Padding-free decoding during inference: only the batch elements with boxes are passed to the transformer
+            # and only as many queries as necessary are decoded, see pack_queries
+            bs, n_queries = pred_classes.shape
+            decoded, n_slots, query_attn_mask = self.pack_queries(n_boxes_per_sample, n_queries, pred_boxes.device)
+            early_exit = None
+            if self.early_exit is not None and len(decoded) > 0:
+                valid = self.valid_queries([n_boxes_per_sample[b] for b in decoded], n_slots, pred_boxes.device)
+                early_exit = EarlyExit(self, pred_classes[decoded, :n_slots], valid, *self.early_exit)
+            if len(decoded) == bs:
+                hs = self.decode(samples, features, pos, query_embeds[:, :n_slots], pred_boxes[:, :n_slots],
+                                 query_attn_mask, early_exit)
+            elif len(decoded) > 0:
+                # The shape cache holds the inputs of the whole batch
+                with self.shape_cache.suspend():
+                    hs = self.decode(NestedTensor(samples.tensors[decoded], samples.mask[decoded]),
+                                     [NestedTensor(f.tensors[decoded], f.mask[decoded]) for f in features],
+                                     [p[decoded] for p in pos], query_embeds[decoded, :n_slots],
+                                     pred_boxes[decoded, :n_slots], query_attn_mask, early_exit)
+            timer.start('heads')
+            if early_exit is not None:
+                # The heads were already evaluated after every decoder layer
+                rotation, translation, exit_layer = early_exit.outputs()
+            elif len(decoded) > 0:
+                rotation, translation = self.predict_poses(hs, pred_classes[decoded, :n_slots])
+
+            # Outputs of batch elements without boxes are 0
+            n_layers = rotation.shape[0] if len(decoded) > 0 else self.transformer.decoder.num_layers
+            rot_shape = (3, 3) if self.rotation_mode == '6d' else (self.rot_dim,)
+            outputs_rotation = pred_boxes.new_zeros((n_layers, bs, n_queries) + rot_shape)
+            outputs_translation = pred_boxes.new_zeros((n_layers, bs, n_queries, self.t_dim))
+            if len(decoded) > 0:
+                outputs_rotation[:, decoded] = self.unpack_queries(rotation, n_queries)
+                outputs_translation[:, decoded] = self.unpack_queries(translation, n_queries)
+            if self.early_exit is not None:
+                # Number of decoder layers each batch element passed, 0 if it was not decoded at all
+                exit_layers = torch.zeros(bs, dtype=torch.long, device=pred_boxes.device)
+                if early_exit is not None:
+                    exit_layers[decoded] = exit_layer
+
+        out = {'pred_translation': outputs_translation[-1], 'pred_rotation': outputs_rotation[-1],
+               'pred_boxes': pred_boxes, 'pred_classes': pred_classes}
 
-        query_embeds = torch.stack(query_embeds)
-        pred_boxes = torch.stack(pred_boxes)
-        pred_classes = torch.stack(pred_classes)
+        if self.aux_loss:
+            out['aux_outputs'] = self._set_aux_loss(outputs_translation, outputs_rotation, pred_boxes, pred_classes)
+        if exit_layers is not None:
+            out['exit_layer'] = exit_layers
+        timer.stop()
+
+        return out, n_boxes_per_sample
 
+    def decode(self, samples, features, pos, query_embeds, pred_boxes, query_attn_mask=None, early_exit=None):
+        """
+        Projects the backbone feature maps, adds the additional feature levels and passes everything to the
+        transformer. Returns the decoder outputs of size [n_decoder_layers, batch_size, n_queries, hidden_dim], which
+        only contain the layers that were evaluated before the early exit.
+        """
         srcs = []
         masks = []
+        pos = list(pos)
         for lvl, feat in enumerate(features):
             # Iterate over each feature map of the backbone returned.
             # If num_feature_levels == 1 then the backbone will only return the last one. Otherwise each is returned.
@@ -313,9 +353,8 @@ class PoET(nn.Module):
                     src = self.input_proj[lvl](features[-1].tensors)
                 else:
                     src = self.input_proj[lvl](srcs[-1])
-                m = samples.mask
-                mask = F.interpolate(m[None].float(), size=src.shape[-2:]).to(torch.bool)[0]
-                pos_l = self.backbone[1](NestedTensor(src, mask)).to(src.dtype)
+                mask, pos_l = cached(self.shape_cache, ('extra_level', lvl),
+                                     lambda: self.extra_level_mask_and_pos(samples.mask, src))
                 srcs.append(src)
                 masks.append(mask)
                 pos.append(pos_l)
@@ -329,41 +368,109 @@ class PoET(nn.Module):
             query_embeds = self.query_embed.weight
 
         # Pass everything to the transformer
-        hs, init_reference, _, _, _ = self.transformer(srcs, masks, pos, query_embeds, reference_points)
+        hs, init_reference, _, _, _ = self.transformer(srcs, masks, pos, query_embeds, reference_points,
+                                                       query_attn_mask, pred_boxes, early_exit)
+        return hs
 
+    def predict_poses(self, hs, pred_classes):
+        """
+        Calculates the intermediate and final rotations and translations from the decoder outputs hs.
+        """
         outputs_translation = []
         outputs_rotation = []
-        bs, _ = pred_classes.shape
-        output_idx = torch.where(pred_classes > 0, pred_classes, 0).view(-1)
-
         # Iterate over the decoder outputs to calculate the intermediate and final outputs (translation and rotation)
         for lvl in range(hs.shape[0]):
-            output_rotation = self.rotation_head[lvl](hs[lvl])
-            output_translation = self.translation_head[lvl](hs[lvl])
-            if self.class_mode == 'specific':
-                # Select the correct output according to the predicted class in the class-specific mode
-                output_rotation = output_rotation.view(bs * self.n_queries, self.n_classes, -1)
-                output_rotation = torch.cat([query[output_idx[i], :] for i, query in enumerate(output_rotation)]).view(bs, self.n_queries, -1)
+            output_rotation, output_translation = self.predict_pose(lvl, hs[lvl], pred_classes)
+            outputs_rotation.append(output_rotation)
+            outputs_translation.append(output_translation)
 
-                output_translation = output_translation.view(bs * self.n_queries, self.n_classes, -1)
-                output_translation = torch.cat(
-                    [query[output_idx[i], :] for i, query in enumerate(output_translation)]).view(bs, self.n_queries, -1)
+        return torch.stack(outputs_rotation), torch.stack(outputs_translation)
 
-            output_rotation = self.process_rotation(output_rotation)
+    def predict_pose(self, lvl, hs, pred_classes):
+        """
+        Rotation and translation predicted by the heads of decoder layer lvl from its output hs.
+        """
+        bs, n_queries = pred_classes.shape
+        output_rotation = self.rotation_head[lvl](hs)
+        output_translation = self.translation_head[lvl](hs)
+        if self.class_mode == 'specific':
+            # Select the output of the predicted class for each query, dummy queries select the background class
+            output_idx = torch.where(pred_classes > 0, pred_classes, 0).long()
+            rotation_idx = output_idx[:, :, None, None].expand(-1, -1, 1, self.rot_dim)
+            translation_idx = output_idx[:, :, None, None].expand(-1, -1, 1, self.t_dim)
+            output_rotation = output_rotation.view(bs, n_queries, self.n_classes, -1).gather(2, rotation_idx)[:, :, 0]
+            output_translation = output_translation.view(bs, n_queries, self.n_classes, -1).gather(
+                2, translation_idx)[:, :, 0]
+
+        return self.process_rotation(output_rotation), output_translation
+
+    def pack_queries(self, n_boxes_per_sample, n_queries, device):
+        """
+        All dummy queries of a batch element are identical (same embedding and reference point), hence they stay
+        identical through all decoder layers and only affect the actual queries through the self attention, where m
+        identical keys weigh exactly as much as a single one with its attention logit increased by log(m). Instead of
+        all n_queries, only the first n_slots = min(max(n_boxes_per_sample) + 1, n_queries) queries are decoded and the
+        attention logits of the remaining dummy queries of each batch element are increased accordingly, which yields
+        the same outputs as decoding all queries. Batch elements without boxes are not decoded at all.
+
+        Returns the indices of the batch elements to decode, n_slots and the float self attention mask of size
+        [n_decoded * nhead, n_slots, n_slots] or None if it is not required.
+        """
+        decoded = [b for b, n in enumerate(n_boxes_per_sample) if n > 0]
+        if len(decoded) == 0:
+            return decoded, 0, None
+        n_boxes = torch.as_tensor([n_boxes_per_sample[b] for b in decoded], dtype=torch.float32, device=device)
+        n_slots = min(int(n_boxes.max()) + 1, n_queries)
+        if n_slots == n_queries:
+            return decoded, n_slots, None
+        # Every batch element has at least one dummy query among the slots
+        dummy = torch.arange(n_slots, device=device)[None, :] >= n_boxes[:, None]
+        bias = torch.log((n_queries - n_boxes) / (n_slots - n_boxes))[:, None] * dummy
+        query_attn_mask = bias[:, None, None, :].expand(-1, self.transformer.nhead, n_slots, -1)
+        return decoded, n_slots, query_attn_mask.reshape(-1, n_slots, n_slots)
+
+    @staticmethod
+    def unpack_queries(outputs, n_queries):
+        """
+        Restores the outputs of size [n_layers, batch_size, n_slots, ...] of packed queries to all n_queries. The
+        outputs of the last slot are the ones of a dummy query, unless all queries were decoded.
+        """
+        n_slots = outputs.shape[2]
+        if n_slots == n_queries:
+            return outputs
+        dummies = outputs[:, :, -1:].expand(-1, -1, n_queries - n_slots, *outputs.shape[3:])
+        return torch.cat([outputs, dummies], 2)
 
-            outputs_rotation.append(output_rotation)
-            outputs_translation.append(output_translation)
+    def pad_query_boxes(self, query_boxes):
+        return pad_query_boxes(query_boxes, self.n_queries)
 
-        outputs_rotation = torch.stack(outputs_rotation)
-        outputs_translation = torch.stack(outputs_translation)
+    def pad_backbone_predictions(self, pred_objects, image_size, device):
+        return pad_backbone_predictions(pred_objects, self.n_queries, image_size, device)
 
-        out = {'pred_translation': outputs_translation[-1], 'pred_rotation': outputs_rotation[-1],
-               'pred_boxes': pred_boxes, 'pred_classes': pred_classes}
+    def embed_query_boxes(self, pred_boxes, n_boxes_per_sample):
+        """
+        Query embeddings of size [batch_size, n_queries, 2 * hidden_dim] of the boxes. As the embedding will serve as
+        the query and key for attention, it is duplicated to be later splitted. Dummy boxes get the embedding -10.
+        """
+        query_embeds = self.bbox_embedding(pred_boxes).repeat(1, 1, 2)
+        valid = self.valid_queries(n_boxes_per_sample, pred_boxes.shape[1], pred_boxes.device)
+        return query_embeds.masked_fill(~valid[:, :, None], -10)
 
-        if self.aux_loss:
-            out['aux_outputs'] = self._set_aux_loss(outputs_translation, outputs_rotation, pred_boxes, pred_classes)
+    @staticmethod
+    def valid_queries(n_boxes_per_sample, n_queries, device):
+        """
+        Mask of size [batch_size, n_queries], which is True for the queries of actual boxes and False for dummy ones.
+        """
+        n_boxes = torch.as_tensor(n_boxes_per_sample, device=device)
+        return torch.arange(n_queries, device=device)[None, :] < n_boxes[:, None]
 
-        return out, n_boxes_per_sample
+    def extra_level_mask_and_pos(self, m, src):
+        """
+        Padding mask and position encoding of a feature level created from the last backbone feature map.
+        """
+        mask = F.interpolate(m[None].float(), size=src.shape[-2:]).to(torch.bool)[0]
+        pos_l = self.backbone[1](NestedTensor(src, mask)).to(src.dtype)
+        return mask, pos_l
 
     def _set_aux_loss(self, outputs_translation, outputs_quaternion, pred_boxes, pred_classes):
         return [{'pred_translation': t, 'pred_rotation': r, 'pred_boxes': pred_boxes, 'pred_classes': pred_classes}
@@ -403,6 +510,61 @@ class PoET(nn.Module):
         return rot_matrix
 
 
+class EarlyExit(object):
+    """
+    Early exit of the decoder during inference. The pose heads are evaluated after every decoder layer and a batch
+    element exits once the rotation (geodesic angle) of none of its queries changed by more than rotation_threshold
+    degrees and the translation by more than translation_threshold between two consecutive layers. It keeps the poses of
+    the layer it exited at. The decoding stops as soon as all batch elements exited.
+
+    Passed to the decoder, which calls it with the index and output of each layer and stops if it returns True.
+    """
+    def __init__(self, model, pred_classes, valid, rotation_threshold, translation_threshold):
+        self.model = model
+        self.pred_classes = pred_classes
+        self.valid = valid
+        self.rotation_threshold = math.radians(rotation_threshold)
+        self.translation_threshold = translation_threshold
+        self.rotations = []
+        self.translations = []
+        # Number of layers each batch element passed before it exited, 0 while it is still decoded
+        self.exit_layer = torch.zeros(len(pred_classes), dtype=torch.long, device=pred_classes.device)
+
+    def __call__(self, lvl, hs):
+        rotation, translation = self.model.predict_pose(lvl, hs, self.pred_classes)
+        self.rotations.append(rotation)
+        self.translations.append(translation)
+        if lvl > 0:
+            converged = (self.rotation_change(self.rotations[-2], rotation) <= self.rotation_threshold) \
+                & (torch.linalg.norm(translation - self.translations[-2], dim=-1) <= self.translation_threshold)
+            exits = (converged | ~self.valid).all(1) & (self.exit_layer == 0)
+            self.exit_layer[exits] = lvl + 1
+        return bool((self.exit_layer > 0).all())
+
+    @staticmethod
+    def rotation_change(previous, current):
+        """
+        Geodesic angle in radians between rotation matrices of size [..., 3, 3] or unit quaternions of size [..., 4].
+        """
+        if current.shape[-1] == 4:
+            return 2 * torch.acos(torch.clamp((previous * current).sum(-1).abs(), max=1))
+        trace = (previous * current).sum((-2, -1))
+        return torch.acos(torch.clamp(0.5 * (trace - 1), -1, 1))
+
+    def outputs(self):
+        """
+        Returns the rotations and translations of all evaluated layers, where the last one holds the poses of the layer
+        each batch element exited at, and the number of layers each batch element passed.
+        """
+        rotations = torch.stack(self.rotations)
+        translations = torch.stack(self.translations)
+        exit_layer = torch.where(self.exit_layer > 0, self.exit_layer, len(self.rotations))
+        batch_idx = torch.arange(len(exit_layer), device=exit_layer.device)
+        rotations[-1] = rotations[exit_layer - 1, batch_idx]
+        translations[-1] = translations[exit_layer - 1, batch_idx]
+        return rotations, translations, exit_layer
+
+
 class SetCriterion(nn.Module):
     """ This class computes the loss for PoET, which consists of translation and rotation for now.
     The process happens in two steps:
@@ -604,7 +766,8 @@ def build(args):
         rotation_mode=args.rotation_representation,
         class_mode=args.class_mode,
         aux_loss=args.aux_loss,
-        backbone_type=args.backbone
+        backbone_type=args.backbone,
+        early_exit=(args.early_exit_rotation, args.early_exit_translation) if args.early_exit else None
     )
 
     matcher = build_matcher(args)
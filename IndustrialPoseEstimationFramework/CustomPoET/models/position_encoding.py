@@ -69,13 +69,13 @@ class BoundingBoxEmbeddingSine(nn.Module):
         self.num_pos_feats = num_pos_feats
 
     def forward(self, bboxes: torch.Tensor):
-        # Assuming only the bboxes for a single image get passed
+        # Boxes of size [..., 4], e.g. the boxes of a single image or the padded boxes of a batch
         dim_t = torch.arange(self.num_pos_feats, dtype=torch.float32, device=bboxes.device)
         dim_t = 2 ** dim_t
-        x_enc = bboxes[:, 0, None] * dim_t
-        y_enc = bboxes[:, 1, None] * dim_t
-        w_enc = bboxes[:, 2, None] * dim_t
-        h_enc = bboxes[:, 3, None] * dim_t
+        x_enc = bboxes[..., 0, None] * dim_t
+        y_enc = bboxes[..., 1, None] * dim_t
+        w_enc = bboxes[..., 2, None] * dim_t
+        h_enc = bboxes[..., 3, None] * dim_t
         x_enc = torch.cat((x_enc.sin(), x_enc.cos()), dim=-1)
         y_enc = torch.cat((y_enc.sin(), y_enc.cos()), dim=-1)
         w_enc = torch.cat((w_enc.sin(), w_enc.cos()), dim=-1)
@@ -5,12 +5,14 @@ from collections import OrderedDict
 
 import torch
 import torch.nn.functional as F
-from torch import Tensor
+from torch import nn, Tensor
 from typing import Dict, Optional, List
 
 from .yolo.backbone_models.models import Darknet, load_darknet_weights
-from .yolo.yolo_utils.general import non_max_suppression
-from .yolo.yolo_utils.torch_utils import select_device
+from .yolo.yolo_utils.general import batched_non_max_suppression
+from .yolo.yolo_utils.torch_utils import select_device, fuse_conv_and_bn
+from util.latency import StageTimer
+from util.shape_cache import cached
 
 ONNX_EXPORT = False
 
@@ -41,13 +43,64 @@ class CNSYOLO(Darknet):
         self.iou_thres = args.backbone_iou_thresh
         self.agnostic_nms = args.backbone_agnostic_nms
 
+        # Latency monitor timing the backbone and NMS, see util.latency.attach
+        self.latency = None
+        # Cache of the downsampled padding masks, see util.shape_cache
+        self.shape_cache = None
+
+        # Detection heads: the YOLO layers and the convolutions predicting their input. Only needed for detecting
+        # objects, the feature maps passed to PoET are returned before them.
+        self.head_layers = set(self.yolo_layers) | {i - 1 for i in self.yolo_layers}
+
+        # Inference build, see prepare_inference: memory format of the layers and the traced layers for one image size
+        self.channels_last = False
+        self.traced_layers = None
+        self.traced_image_size = None
+
         # Freeze backbone if it should not be trained
         self.train_backbone = train_backbone
         if not train_backbone:
             for name, parameter in self.named_parameters():
                 parameter.requires_grad_(False)
 
-    def forward_backbone(self, x, verbose=False):
+    def forward(self, tensor_list, detect=True):
+        return self.forward_once(tensor_list, detect=detect)
+
+    def forward_backbone(self, x, verbose=False, detect=True):
+        """
+        Passes the images through YOLO. If detect is False, the detection heads and NMS are skipped and no objects are
+        predicted (None for each image), only the feature maps are returned.
+        """
+        timer = StageTimer(self.latency)
+        timer.start('backbone')
+        if self.training and detect:
+            # TODO: Write code when backbone is not frozen
+            # We want to return the same as the original yolo, but also the predicted outputs as we need them for further processing
+            raise NotImplementedError
+        bs = x.shape[0]
+        if self.traced_layers is not None and detect and not verbose and tuple(x.shape[-2:]) == self.traced_image_size:
+            x, *features = self.traced_layers(x)
+            intermediate = OrderedDict((str(i), f) for i, f in enumerate(features))
+        else:
+            x, intermediate = self.forward_layers(x, verbose=verbose, detect=detect)
+        if not detect:
+            pred = [None] * bs
+            timer.stop()
+        else:
+            # Determine prediction from yolo output layers: pred = [bbox (4), conf, class]
+            timer.start('nms')
+            pred = batched_non_max_suppression(x, self.conf_thres, self.iou_thres, classes=None,
+                                               agnostic=self.agnostic_nms)
+            timer.stop()
+        return pred, intermediate
+
+    def forward_layers(self, x, verbose=False, detect=True):
+        """
+        Passes the images through the YOLO layers. Returns the concatenated inference output of the YOLO layers of size
+        [batch_size, n_candidates, 5 + n_classes] before NMS (None if detect is False) and the feature maps.
+        """
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         yolo_out, out = [], []
         intermediate = OrderedDict()
         intermediate_i = 0
@@ -58,6 +111,9 @@ class CNSYOLO(Darknet):
         # Passing the image through the YOLO model layer by layer
         for i, module in enumerate(self.module_list):
             name = module.__class__.__name__
+            if not detect and i in self.head_layers:
+                out.append([])
+                continue
             if name in ['WeightedFeatureFusion', 'FeatureConcat', 'FeatureConcat2', 'FeatureConcat3',
                         'FeatureConcat_l']:  # sum, concat
                 if verbose:
@@ -79,21 +135,63 @@ class CNSYOLO(Darknet):
                 print('%g/%g %s -' % (i, len(self.module_list), name), list(x.shape), str_o)
                 str_o = ''
 
-        if self.training:
-            # TODO: Write code when backbone is not frozen
-            # We want to return the same as the original yolo, but also the predicted outputs as we need them for further processing
+        if not detect:
+            return None, intermediate
+        x, p = zip(*yolo_out)  # inference output, training output
+        return torch.cat(x, 1), intermediate  # cat yolo outputs
+
+    def fuse(self):
+        """
+        Folds the BatchNorm2d of every convolutional block into its Conv2d. In contrast to Darknet.fuse, the remaining
+        modules of a block keep their names.
+        """
+        for block in self.module_list:
+            if isinstance(block, nn.Sequential) and hasattr(block, 'Conv2d') and hasattr(block, 'BatchNorm2d'):
+                fused = fuse_conv_and_bn(block.Conv2d, block.BatchNorm2d)
+                fused.requires_grad_(block.Conv2d.weight.requires_grad)
+                block.Conv2d = fused
+                del block.BatchNorm2d
+
+    def prepare_inference(self, image_size, device, channels_last=True, jit=False):
+        """
+        Inference build of the frozen backbone for images of image_size (height, width): fuses Conv2d + BatchNorm2d,
+        converts the layers to the channels_last memory format, precomputes the grids and anchors of the YOLO layers
+        and freezes the parameters. If jit is set, the layers are additionally traced for image_size, frozen and
+        optimized for inference with TorchScript. Images of other sizes still pass through the eager layers.
+        """
+        if self.train_backbone:
             raise NotImplementedError
-        else:
-            x, p = zip(*yolo_out)  # inference output, training output
-            x = torch.cat(x, 1)  # cat yolo outputs
-            # Determine prediction from yolo output layers: pred = [bbox (4), conf, class]
-            pred = non_max_suppression(x, self.conf_thres, self.iou_thres, classes=None,
-                                       agnostic=self.agnostic_nms)
-        return pred, intermediate
+        self.eval()
+        self.requires_grad_(False)
+        self.fuse()
+        self.to(device)
+
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+            self.channels_last = True
+
+        height, width = image_size
+        for i in self.yolo_layers:
+            yolo_layer = self.module_list[i]
+            yolo_layer.create_grids((width // yolo_layer.stride, height // yolo_layer.stride), device)
 
-    def forward_once(self, tensor_list, augment=False, verbose=False):
+        if jit:
+            example = torch.zeros(1, 3, height, width, device=device)
+            try:
+                with torch.no_grad():
+                    traced = torch.jit.trace(TracedLayers(self), example, check_trace=False)
+                    traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+            except Exception as e:
+                print("Tracing the backbone failed, the eager layers are used instead: {}".format(e))
+            else:
+                # Not registered as submodule, as the traced graph holds its own copy of the weights
+                object.__setattr__(self, 'traced_layers', traced)
+                self.traced_image_size = (height, width)
+        return self
+
+    def forward_once(self, tensor_list, augment=False, verbose=False, detect=True):
         # Pass Image through YOLO
-        predictions, xs = self.forward_backbone(tensor_list.tensors)
+        predictions, xs = self.forward_backbone(tensor_list.tensors, detect=detect)
         # Adjust predicted classes by 1 as class 0 is "background / dummy" in PoET
         for i in range(len(predictions)):
             if predictions[i] is not None:
@@ -102,11 +200,26 @@ class CNSYOLO(Darknet):
         for name, x in xs.items():
             m = tensor_list.mask
             assert m is not None
-            mask = F.interpolate(m[None].float(), size=x.shape[-2:]).to(torch.bool)[0]
+            mask = cached(self.shape_cache, ('mask', name),
+                          lambda: F.interpolate(m[None].float(), size=x.shape[-2:]).to(torch.bool)[0])
             out[name] = NestedTensor(x, mask)
         return predictions, out
 
 
+class TracedLayers(nn.Module):
+    """
+    CNSYOLO.forward_layers with detection as a module with tensor outputs only: the candidates before NMS followed by
+    the feature maps.
+    """
+    def __init__(self, backbone):
+        super().__init__()
+        self.backbone = backbone
+
+    def forward(self, x):
+        candidates, intermediate = self.backbone.forward_layers(x)
+        return (candidates, *intermediate.values())
+
+
 class NestedTensor(object):
     def __init__(self, tensors, mask: Optional[Tensor]):
         self.tensors = tensors
@@ -4,7 +4,11 @@ import math
 import torch
 import torch.nn as nn
 
-from mish_cuda import MishCuda as Mish
+try:
+    from mish_cuda import MishCuda as Mish
+except ImportError:
+    # Plain PyTorch Mish if the CUDA extension is not installed, e.g. for inference on the CPU
+    from ..yolo_utils.activations import Mish
 
 
 def autopad(k, p=None):  # kernel, padding
@@ -14,7 +14,7 @@ from numpy import random
 from backbone_models.experimental import attempt_load
 from yolo_utils.datasets import LoadStreams, LoadImages
 from yolo_utils.general import (
-    check_img_size, non_max_suppression, apply_classifier, scale_coords, xyxy2xywh, plot_one_box, strip_optimizer)
+    check_img_size, batched_non_max_suppression, apply_classifier, scale_coords, xyxy2xywh, plot_one_box, strip_optimizer)
 
 from yolo_utils.torch_utils import select_device, load_classifier, time_synchronized
 
@@ -24,15 +24,16 @@ from yolo_utils.datasets import *
 from yolo_utils.general import *
 
 import socket
-import pickle
-import struct
+import sys
 
+# The frame protocol of the live inference servers is located in the project root
+sys.path.append(str(Path(__file__).resolve().parents[3]))
+import inference_tools.frame_protocol as protocol
 
 
-def send_image(sock, img):
-    data = pickle.dumps(img)
-    message_size = struct.pack("Q", len(data))
-    sock.sendall(message_size + data)
+
+def send_image(sock, img, config, frame_id):
+    protocol.send_frame(sock, img, frame_id, time.time(), config.codec, config.quality)
 
 
 
@@ -94,6 +95,7 @@ def detect(save_img=False):
 
     # Run inference
     t0 = time.time()
+    n_sent = 0
     img = torch.zeros((1, 3, imgsz, imgsz), device=device)  # init img
     # _ = model(img.half() if half else img) if device.type != 'cpu' else None  # run once
     for path, img, im0s, vid_cap in dataset:
@@ -108,7 +110,7 @@ def detect(save_img=False):
         pred = model(img, augment=opt.augment)[0]
 
         # Apply NMS
-        pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
+        pred = batched_non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
         t2 = time_synchronized()
 
         # Apply Classifier
@@ -175,7 +177,8 @@ def detect(save_img=False):
 
             # Stream results
             if send_img:
-                send_image(client_socket, im0)
+                send_image(client_socket, im0, stream_config, n_sent)
+                n_sent += 1
 
             # Save results (image with detections)
             if save_img:
@@ -241,6 +244,7 @@ if __name__ == '__main__':
         print("Waiting for a connection...")
         client_socket, addr = server_socket.accept()
         print("Connected to:", addr)
+        stream_config = protocol.accept_stream(client_socket)
 
         opt.source = '0'
     else:
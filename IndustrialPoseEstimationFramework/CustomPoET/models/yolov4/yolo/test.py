@@ -12,7 +12,7 @@ from tqdm import tqdm
 
 from yolo_utils.datasets import create_dataloader
 from yolo_utils.general import (
-    coco80_to_coco91_class, check_file, check_img_size, compute_loss, non_max_suppression,
+    coco80_to_coco91_class, check_file, check_img_size, compute_loss, batched_non_max_suppression,
     scale_coords, xyxy2xywh, clip_coords, plot_images, xywh2xyxy, box_iou, output_to_target, ap_per_class)
 from yolo_utils.torch_utils import select_device, time_synchronized
 
@@ -125,7 +125,7 @@ def test(data,
 
             # Run NMS
             t = time_synchronized()
-            output = non_max_suppression(inf_out, conf_thres=conf_thres, iou_thres=iou_thres, merge=merge)
+            output = batched_non_max_suppression(inf_out, conf_thres=conf_thres, iou_thres=iou_thres, merge=merge)
             t1 += time_synchronized() - t
 
         # Statistics per image
@@ -631,6 +631,82 @@ def non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, merge=False,
     return output
 
 
+def batched_non_max_suppression(prediction, conf_thres=0.1, iou_thres=0.6, merge=False, classes=None, agnostic=False,
+                                max_det=300):
+    """Performs Non-Maximum Suppression (NMS) on the inference results of the whole batch at once
+
+    The candidates of all images are filtered together and suppressed with a single torchvision batched_nms call, in
+    which the boxes are offset by image index and class (image index only if agnostic). The kept detections are split
+    back per image, sorted by descending confidence and capped at the max_det most confident ones.
+
+    Returns:
+         list of detections per image with shape: nx6 (x1, y1, x2, y2, conf, cls), None for images without detections
+    """
+    if prediction.dtype is torch.float16:
+        prediction = prediction.float()  # to FP32
+
+    bs = prediction.shape[0]
+    nc = prediction.shape[2] - 5  # number of classes
+    multi_label = nc > 1  # multiple labels per box
+    output = [None] * bs
+
+    # Candidates of all images, xi is the image index of each candidate
+    xi, ai = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)
+    x = prediction[xi, ai]
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:] > conf_thres).nonzero(as_tuple=True)
+        x = torch.cat((box[i], x[i, j + 5, None], j[:, None].float()), 1)
+        xi = xi[i]
+    else:  # best class only
+        conf, j = x[:, 5:].max(1, keepdim=True)
+        keep = conf.view(-1) > conf_thres
+        x = torch.cat((box, conf, j.float()), 1)[keep]
+        xi = xi[keep]
+
+    # Filter by class
+    if classes:
+        keep = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, xi = x[keep], xi[keep]
+
+    if not x.shape[0]:
+        return output
+
+    # NMS per image and class, i is sorted by descending confidence
+    groups = xi if agnostic else xi * nc + x[:, 5].long()
+    i = torchvision.ops.batched_nms(x[:, :4], x[:, 4], groups, iou_thres)
+
+    # Group the kept detections by image, the stable sort keeps them sorted by confidence within each image
+    i = i[torch.sort(xi[i], stable=True)[1]]
+    counts = torch.bincount(xi[i], minlength=bs)
+    first = torch.cumsum(counts, 0) - counts
+    rank = torch.arange(i.shape[0], device=i.device) - first[xi[i]]
+    i = i[rank < max_det]  # limit detections
+    counts = counts.clamp(max=max_det).tolist()
+
+    for b, (ib, n) in enumerate(zip(i.split(counts), counts)):
+        if not n:
+            continue
+        if merge:  # Merge NMS (boxes merged using weighted mean), per image as in non_max_suppression
+            xb = x[xi == b]
+            ib = ib - (xi < b).sum()  # index within the image
+            if 1 < xb.shape[0] < 3E3:
+                c = xb[:, 5:6] * (0 if agnostic else 4096)  # classes
+                boxes, scores = xb[:, :4] + c, xb[:, 4]  # boxes (offset by class), scores
+                iou = box_iou(boxes[ib], boxes) > iou_thres  # iou matrix
+                weights = iou * scores[None]  # box weights
+                xb[ib, :4] = torch.mm(weights, xb[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
+                ib = ib[iou.sum(1) > 1]  # require redundancy
+            output[b] = xb[ib]
+        else:
+            output[b] = x[ib]
+
+    return output
+
+
 def strip_optimizer(f='weights/best.pt', s=''):  # from yolo_utils.yolo_utils import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
     x = torch.load(f, map_location=torch.device('cpu'))
@@ -6,7 +6,11 @@ from .general import *
 import torch
 from torch import nn
 
-from mish_cuda import MishCuda as Mish
+try:
+    from mish_cuda import MishCuda as Mish
+except ImportError:
+    # Plain PyTorch Mish if the CUDA extension is not installed, e.g. for inference on the CPU
+    from .activations import Mish
 
 
 def make_divisible(v, divisor):
@@ -20,7 +20,9 @@ from pathlib import Path
 
 import yaml
 import numpy as np
-from inference_tools.inference_engine import inference, webcam_inference
+from inference_tools.inference_engine import inference, webcam_inference, multi_client_inference
+from inference_tools.artifact import apply_artifact_config, export_artifact
+from inference_tools.onnx_backend import export_onnx
 
 # import wandb
 
@@ -94,6 +96,22 @@ def get_args_parser():
                         help="Number of query slots")
     parser.add_argument('--dec_n_points', default=4, type=int)
     parser.add_argument('--enc_n_points', default=4, type=int)
+    parser.add_argument('--msda_backend', default='auto', type=str, choices=['auto', 'cuda', 'pytorch'],
+                        help="Implementation of the multi-scale deformable attention: 'cuda' requires the compiled "
+                             "deformable_attention extension, 'pytorch' runs on any device. 'auto' uses the extension "
+                             "if it is installed and the model runs on the GPU.")
+    parser.add_argument('--sparse_encoder', action='store_true',
+                        help="Only refine the encoder tokens around the query boxes, the remaining tokens keep the "
+                             "projected backbone features")
+    parser.add_argument('--sparse_encoder_margin', default=0.5, type=float,
+                        help="Margin around the query boxes of the sparse encoder relative to the box size")
+    parser.add_argument('--early_exit', action='store_true',
+                        help="Stop decoding during inference once the predicted poses converged between two "
+                             "consecutive decoder layers")
+    parser.add_argument('--early_exit_rotation', default=1.0, type=float,
+                        help="Maximum change of the rotation in degrees between two decoder layers for the early exit")
+    parser.add_argument('--early_exit_translation', default=0.005, type=float,
+                        help="Maximum change of the translation between two decoder layers for the early exit")
 
     # * Matcher
     parser.add_argument('--matcher_type', default='pose', choices=['pose'], type=str)
@@ -146,6 +164,10 @@ def get_args_parser():
                         help="Path to the directory containing the files for inference.")
     parser.add_argument('--inference_output', type=str,
                         help="Path to the directory where the inference results should be stored.")
+    parser.add_argument('--inference_batch_size', default=4, type=int,
+                        help="Number of images PoET processes at once in inference mode.")
+    parser.add_argument('--inference_writers', default=4, type=int,
+                        help="Number of background threads drawing and storing the annotated images in inference mode.")
 
     # * Misc
     parser.add_argument('--sgd', action='store_true')
@@ -178,6 +200,77 @@ def get_args_parser():
     parser.add_argument('--gpu', default=0, type=int, help='rank of the process')
 
     parser.add_argument('--webcam', default=False, type=int, help='rank of the process')
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Run the live inference server as a pipeline, in which receiving, decoding, the model "
+                             "forward pass, annotation and sending back run concurrently on different frames.")
+    parser.add_argument('--pipeline_queue_depth', default=2, type=int,
+                        help="Maximum number of frames queued between two pipeline stages. If a stage falls behind, "
+                             "the oldest queued frame is dropped.")
+    parser.add_argument('--latest_frame', action='store_true',
+                        help="Latest-frame-wins receive mode of the live inference server: frames keep being received "
+                             "in the background while a frame is processed and only the newest one is kept, such that "
+                             "the model always works on the freshest frame. Stale frames are dropped and counted.")
+    parser.add_argument('--tracking', action='store_true',
+                        help="Track the objects across the frames of the live inference. The object detector only runs "
+                             "every --tracking_interval frames or once a track is lost, in between the tracked boxes "
+                             "are used as queries and the poses are smoothed.")
+    parser.add_argument('--tracking_interval', default=10, type=int,
+                        help="Maximum number of frames between two runs of the object detector in the tracking mode.")
+    parser.add_argument('--tracking_min_confidence', default=0.5, type=float,
+                        help="The object detector runs again once the confidence of a track drops below this value.")
+    parser.add_argument('--tracking_smoothing', default=0.5, type=float,
+                        help="Weight of the tracked pose when it is blended with a new prediction. 0 disables the "
+                             "smoothing.")
+    parser.add_argument('--tracking_translation_tolerance', default=0.05, type=float,
+                        help="Translation change between two frames at which the confidence of a track decays by a "
+                             "factor of e.")
+    parser.add_argument('--multi_client', action='store_true',
+                        help="Serve several live clients concurrently with one shared model. Frames of all clients are "
+                             "batched dynamically and processed with one forward pass per batch.")
+    parser.add_argument('--server_batch_size', default=4, type=int,
+                        help="Maximum number of frames in a batch of the multi-client server.")
+    parser.add_argument('--server_batch_timeout', default=10, type=float,
+                        help="Maximum time in milliseconds the multi-client server waits for further frames to fill "
+                             "a batch after its first frame arrived.")
+    parser.add_argument('--latency_log_interval', default=0, type=float,
+                        help="Interval in seconds in which the rolling latency percentiles of the live inference stages "
+                             "and the frame rate are printed. 0 disables the log.")
+    parser.add_argument('--latency_port', default=0, type=int,
+                        help="Port of the HTTP endpoint serving the live inference latency metrics in the Prometheus "
+                             "text format. 0 disables the endpoint.")
+    parser.add_argument('--latency_host', default='127.0.0.1', type=str,
+                        help="Address the latency metrics endpoint is bound to.")
+    parser.add_argument('--latency_window', default=300, type=int,
+                        help="Number of most recent frames the latency percentiles and frame rate are computed over.")
+    parser.add_argument('--optimize_backbone', action='store_true',
+                        help="Inference build of the frozen YOLO backbone: fuse Conv2d + BatchNorm2d, use the "
+                             "channels_last memory format and precompute the YOLO grids for --backbone_image_size.")
+    parser.add_argument('--backbone_image_size', default=[480, 640], type=int, nargs=2,
+                        help="Height and width of the images the optimized backbone is built for.")
+    parser.add_argument('--backbone_jit', action='store_true',
+                        help="Additionally trace the optimized backbone for --backbone_image_size and apply "
+                             "torch.jit.freeze and torch.jit.optimize_for_inference.")
+    parser.add_argument('--export_artifact', default='', type=str,
+                        help="Package the model with the inference build of the backbone, its weights and the resolved "
+                             "config into this file and exit.")
+    parser.add_argument('--artifact', default='', type=str,
+                        help="Load the model from this packaged artifact in one step instead of building it from the "
+                             "cfg, the backbone weights and the checkpoint. The config file is not read.")
+    parser.add_argument('--export_onnx', default='', type=str,
+                        help="Export YOLO and PoET as ONNX graphs to this directory, verify them against the eager model "
+                             "and exit.")
+    parser.add_argument('--onnx_image_size', default=[480, 640], type=int, nargs=2,
+                        help="Height and width of the images the ONNX graphs are exported for.")
+    parser.add_argument('--onnx_opset', default=17, type=int, help="ONNX opset version of the export.")
+    parser.add_argument('--onnx_verify_frames', default=10, type=int,
+                        help="Number of random frames the exported graphs are verified on.")
+    parser.add_argument('--onnx', default='', type=str,
+                        help="Run the inference with ONNX Runtime on the CPU using the graphs exported to this "
+                             "directory instead of the eager model.")
+    parser.add_argument('--onnx_intra_op_threads', default=0, type=int,
+                        help="Number of threads ONNX Runtime uses within an operator. 0 uses the default.")
+    parser.add_argument('--onnx_inter_op_threads', default=0, type=int,
+                        help="Number of threads ONNX Runtime uses to run independent operators. 0 uses the default.")
 
     return parser
 
@@ -186,18 +279,32 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser('PoET training and evaluation script', parents=[get_args_parser()])
     args = parser.parse_args()
 
-    configs_path = '/opt/project/configs/poet_run_configs.yml'
-    with open(configs_path, 'r') as f:
-        configs = yaml.safe_load(f)
+    # The artifact already contains the model and the resolved config. Its settings are used unless they are given on
+    # the command line.
+    if args.artifact:
+        cli_parser = get_args_parser()
+        for action in cli_parser._actions:
+            action.default = argparse.SUPPRESS
+        apply_artifact_config(args, set(vars(cli_parser.parse_args())))
+    else:
+        configs_path = '/opt/project/configs/poet_run_configs.yml'
+        with open(configs_path, 'r') as f:
+            configs = yaml.safe_load(f)
 
-    for key, value in configs['inference_configs'].items():
-        if hasattr(args, key):
-            setattr(args, key, value)
+        for key, value in configs['inference_configs'].items():
+            if hasattr(args, key):
+                setattr(args, key, value)
     
     if args.output_dir:
         Path(args.output_dir).mkdir(parents=True, exist_ok=True)
 
-    if args.webcam == True:
+    if args.export_artifact:
+        export_artifact(args)
+    elif args.export_onnx:
+        export_onnx(args)
+    elif args.webcam == True and args.multi_client:
+        multi_client_inference(args)
+    elif args.webcam == True:
         webcam_inference(args)
     else:
         inference(args)
\ No newline at end of file
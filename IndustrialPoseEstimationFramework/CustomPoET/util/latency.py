@@ -0,0 +1,217 @@
+# ------------------------------------------------------------------------
+# PoET: Pose Estimation Transformer for Single-View, Multi-Object 6D Pose Estimation
+# Copyright (c) 2022 Thomas Jantos (thomas.jantos@aau.at), University of Klagenfurt - Control of Networked Systems (CNS). All Rights Reserved.
+# Licensed under the BSD-2-Clause-License with no commercial use [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Latency instrumentation for the live inference path.
+
+A LatencyMonitor collects the duration of every stage a frame passes through (e.g. recv, decode, backbone, nms,
+transformer, send) in ring buffers and reports rolling percentiles and the frame rate, either as periodic log line or
+in the Prometheus text format through a small HTTP endpoint.
+
+Modules of the model that have a `latency` attribute time their internal stages, once a monitor is attached to the
+model with attach(). If no monitor is attached, the instrumentation is a no-op.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+
+class LatencyMonitor(object):
+    """
+    Keeps the durations of the last window frames per stage and the completion times of the last window frames.
+    Thread-safe, such that the stages of a pipeline running in different threads can report to the same monitor.
+
+    On the GPU, kernels are executed asynchronously. If synchronize is set, the device is synchronized at the stage
+    boundaries, such that the time is attributed to the stage that actually spent it.
+    """
+    def __init__(self, window=300, synchronize=False):
+        self.window = window
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.durations = OrderedDict()
+        self.counts = {}
+        self.totals = {}
+        self.frame_times = deque(maxlen=window)
+        self.n_frames = 0
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            if stage not in self.durations:
+                self.durations[stage] = deque(maxlen=self.window)
+                self.counts[stage] = 0
+                self.totals[stage] = 0.0
+            self.durations[stage].append(seconds)
+            self.counts[stage] += 1
+            self.totals[stage] += seconds
+
+    @contextmanager
+    def measure(self, stage):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.record(stage, time.perf_counter() - start)
+
+    def frame_done(self, started=None):
+        """
+        Mark a frame as completed. If the time the frame was started (time.perf_counter()) is given, its end-to-end
+        latency is recorded as stage 'total'.
+        """
+        now = time.perf_counter()
+        if started is not None:
+            self.record('total', now - started)
+        with self.lock:
+            self.frame_times.append(now)
+            self.n_frames += 1
+
+    def fps(self):
+        with self.lock:
+            if len(self.frame_times) < 2:
+                return 0.0
+            return (len(self.frame_times) - 1) / (self.frame_times[-1] - self.frame_times[0])
+
+    def summary(self):
+        """
+        Returns a dict with the rolling p50, p95 and p99 in seconds, the number of measurements and their sum per stage.
+        """
+        with self.lock:
+            durations = [(stage, np.array(values)) for stage, values in self.durations.items() if values]
+            counts = dict(self.counts)
+            totals = dict(self.totals)
+        summary = OrderedDict()
+        for stage, values in durations:
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            summary[stage] = {'p50': p50, 'p95': p95, 'p99': p99, 'count': counts[stage], 'sum': totals[stage]}
+        return summary
+
+    def format_summary(self):
+        stages = ["{} {:.1f}/{:.1f}/{:.1f}".format(stage, s['p50'] * 1000, s['p95'] * 1000, s['p99'] * 1000)
+                  for stage, s in self.summary().items()]
+        return "FPS {:.1f} | p50/p95/p99 [ms]: {}".format(self.fps(), ", ".join(stages))
+
+    def prometheus_text(self):
+        lines = ["# HELP poet_stage_latency_seconds Latency of the live inference stages.",
+                 "# TYPE poet_stage_latency_seconds summary"]
+        for stage, s in self.summary().items():
+            for key, quantile in [('p50', '0.5'), ('p95', '0.95'), ('p99', '0.99')]:
+                lines.append('poet_stage_latency_seconds{{stage="{}",quantile="{}"}} {:.6f}'.format(
+                    stage, quantile, s[key]))
+            lines.append('poet_stage_latency_seconds_sum{{stage="{}"}} {:.6f}'.format(stage, s['sum']))
+            lines.append('poet_stage_latency_seconds_count{{stage="{}"}} {}'.format(stage, s['count']))
+        lines += ["# HELP poet_fps Rolling frame rate of the live inference.",
+                  "# TYPE poet_fps gauge",
+                  "poet_fps {:.3f}".format(self.fps()),
+                  "# HELP poet_frames_total Number of processed frames.",
+                  "# TYPE poet_frames_total counter",
+                  "poet_frames_total {}".format(self.n_frames)]
+        return "\n".join(lines) + "\n"
+
+    def serve_http(self, port, host='127.0.0.1'):
+        """
+        Expose the metrics in the Prometheus text format on http://host:port/metrics from a background thread.
+        """
+        monitor = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = monitor.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='latency-http', daemon=True).start()
+        print("Serving latency metrics on http://{}:{}/metrics".format(host, port))
+        return server
+
+    def start_logging(self, interval):
+        """
+        Print the summary every interval seconds from a background thread.
+        """
+        def log():
+            while True:
+                time.sleep(interval)
+                if self.durations:
+                    print(self.format_summary())
+
+        threading.Thread(target=log, name='latency-log', daemon=True).start()
+
+
+class StageTimer(object):
+    """
+    Times consecutive stages of a function without wrapping each of them in a with block: start() ends the running
+    stage and starts the next one, stop() ends the running stage. Does nothing if monitor is None.
+    """
+    def __init__(self, monitor):
+        self.monitor = monitor
+        self.stage = None
+        self.start_time = None
+
+    def start(self, stage):
+        if self.monitor is None:
+            return
+        if self.stage is not None:
+            self.stop()
+        elif self.monitor.synchronize:
+            torch.cuda.synchronize()
+        self.stage = stage
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        if self.monitor is None or self.stage is None:
+            return
+        if self.monitor.synchronize:
+            torch.cuda.synchronize()
+        self.monitor.record(self.stage, time.perf_counter() - self.start_time)
+        self.stage = None
+
+
+def measure(monitor, stage):
+    """
+    Context manager timing stage with the given monitor, or doing nothing if monitor is None.
+    """
+    if monitor is None:
+        return nullcontext()
+    return monitor.measure(stage)
+
+
+def attach(model, monitor):
+    """
+    Attach the monitor to all modules of the model that time their internal stages. Models that are no torch module,
+    e.g. the ONNX Runtime backend, time their stages themselves.
+    """
+    for module in model.modules() if isinstance(model, torch.nn.Module) else [model]:
+        if hasattr(module, 'latency'):
+            module.latency = monitor
+
+
+def build_latency_monitor(args, device):
+    """
+    Build the monitor for the live inference according to args.latency_log_interval and args.latency_port. Returns None
+    if both are disabled.
+    """
+    if args.latency_log_interval <= 0 and args.latency_port <= 0:
+        return None
+    monitor = LatencyMonitor(window=args.latency_window, synchronize=device.type == 'cuda')
+    if args.latency_log_interval > 0:
+        monitor.start_logging(args.latency_log_interval)
+    if args.latency_port > 0:
+        monitor.serve_http(args.latency_port, args.latency_host)
+    return monitor
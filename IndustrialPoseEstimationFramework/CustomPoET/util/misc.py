@@ -375,6 +375,11 @@ class NestedTensor(object):
         if self.mask is not None:
             self.mask.record_stream(*args, **kwargs)
 
+    def pin_memory(self):
+        # Called by the DataLoader if pin_memory is set
+        mask = self.mask.pin_memory() if self.mask is not None else None
+        return NestedTensor(self.tensors.pin_memory(), mask)
+
     def decompose(self):
         return self.tensors, self.mask
 
@@ -0,0 +1,99 @@
+# ------------------------------------------------------------------------
+# PoET: Pose Estimation Transformer for Single-View, Multi-Object 6D Pose Estimation
+# Copyright (c) 2022 Thomas Jantos (thomas.jantos@aau.at), University of Klagenfurt - Control of Networked Systems (CNS). All Rights Reserved.
+# Licensed under the BSD-2-Clause-License with no commercial use [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Post-training INT8 quantization of PoET for inference on the CPU.
+
+The linear layers of the transformer and the pose heads are quantized dynamically, i.e. their weights are stored in
+INT8 and their inputs are quantized on the fly. The convolutions of the Darknet backbone are quantized statically:
+each one is fused with its batch norm and the range of its input and output is calibrated on a few images of the
+dataset. Mish and the YOLO layers have no quantized kernels, so every convolution quantizes its input and dequantizes
+its output and the activations stay in floating point.
+"""
+import torch
+from torch import nn
+from torch.ao.quantization import QuantWrapper, convert, fuse_modules, get_default_qconfig, prepare, quantize_dynamic
+
+
+def prepare_backbone(backbone, engine):
+    """
+    Fuses the Conv2d + BatchNorm2d blocks of the Darknet backbone and inserts the observers for the calibration.
+    Returns the number of convolutions that will be quantized.
+    """
+    qconfig = get_default_qconfig(engine)
+    n_convs = 0
+    for block in backbone.module_list:
+        if not isinstance(block, nn.Sequential) or type(getattr(block, 'Conv2d', None)) is not nn.Conv2d:
+            continue
+        if hasattr(block, 'BatchNorm2d'):
+            fuse_modules(block, [['Conv2d', 'BatchNorm2d']], inplace=True)
+        block.Conv2d = QuantWrapper(block.Conv2d)
+        block.Conv2d.qconfig = qconfig
+        n_convs += 1
+    prepare(backbone, inplace=True)
+    return n_convs
+
+
+@torch.no_grad()
+def calibrate(model, data_loader, n_images):
+    """
+    Passes at least n_images images of the data loader through the model, such that the observers record the ranges
+    of the activations.
+    """
+    n_seen = 0
+    for samples, targets in data_loader:
+        samples = samples.to('cpu')
+        targets = [{k: v.to('cpu') for k, v in t.items()} for t in targets]
+        model(samples, targets)
+        n_seen += len(targets)
+        if n_seen >= n_images:
+            break
+    return n_seen
+
+
+def quantize_model(model, data_loader, n_calibration_images=16, engine=None):
+    """
+    Quantizes PoET in-place: static INT8 for the convolutions of the YOLOv4 backbone, calibrated on
+    n_calibration_images images of data_loader, and dynamic INT8 for all linear layers. The quantized model only runs
+    on the CPU, so the model is moved there.
+    """
+    if engine is not None:
+        torch.backends.quantized.engine = engine
+    engine = torch.backends.quantized.engine
+    model.cpu()
+    model.eval()
+
+    backbone = model.backbone[0]
+    if backbone.__class__.__name__ != 'CNSYOLO':
+        raise NotImplementedError("Static quantization is only implemented for the YOLOv4 backbone")
+    n_convs = prepare_backbone(backbone, engine)
+    n_images = calibrate(model, data_loader, n_calibration_images)
+    convert(backbone, inplace=True)
+    print("Quantized {} backbone convolutions to INT8 ({} engine), calibrated on {} images".format(n_convs, engine,
+                                                                                                   n_images))
+
+    n_linear = sum(1 for m in model.modules() if type(m) is nn.Linear)
+    quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    print("Quantized {} linear layers dynamically to INT8".format(n_linear))
+    return model
+
+
+def print_comparison(reference_results, results, labels=("FP32", "INT8")):
+    """
+    Prints the pose metrics returned by engine.pose_evaluate for a reference model, e.g. in FP32, and a variant of it,
+    e.g. quantized to INT8, next to each other. labels are the titles of the two columns.
+    """
+    print("{:<28}{:>12}{:>12}{:>12}".format("Metric", labels[0], labels[1], "Delta"))
+    for metric, name in [('add', 'ADD'), ('adi', 'ADD-S'), ('adds', 'ADD(-S)')]:
+        for key in ['0.02', '0.05', '0.10', 'auc']:
+            reference = reference_results[metric]["accuracy"][key]
+            value = results[metric]["accuracy"][key]
+            label = "{} {}".format(name, 'AUC' if key == 'auc' else '@ ' + key)
+            print("{:<28}{:>12.2f}{:>12.2f}{:>+12.2f}".format(label, reference, value, value - reference))
+    for metric, name in [('translation_error', 'Avg. translation error'), ('rotation_error', 'Avg. rotation error')]:
+        reference = reference_results[metric]["mean"][0]
+        value = results[metric]["mean"][0]
+        print("{:<28}{:>12.4f}{:>12.4f}{:>+12.4f}".format(name, reference, value, value - reference))
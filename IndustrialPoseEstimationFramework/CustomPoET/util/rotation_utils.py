@@ -191,6 +191,34 @@ def so3_rotation_angle(
             return torch.acos(phi_cos)
 
 
+def so3_relative_angle(R1: torch.Tensor, R2: torch.Tensor) -> torch.Tensor:
+    """
+    Calculates the geodesic distance (in radians) between two batches of rotation matrices, i.e. the angle of the
+    relative rotation `R1^T R2`, which equals `||logm(R1^T R2)||_F / sqrt(2)`.
+    Instead of `acos(0.5 * (Trace(R)-1))`, whose precision degrades near 0 and π, the angle is computed as
+    `atan2(sin, cos)` with the sine from the norm of the skew-symmetric part of the relative rotation and the cosine from
+    its trace, both clamped to their valid range. Matrices that are not exactly orthonormal, e.g. predicted rotations,
+    are not rejected but get the angle of the clamped values, such that a single invalid matrix does not abort the
+    evaluation of a whole batch.
+    Args:
+        R1: Batch of rotation matrices of shape `(minibatch, 3, 3)`.
+        R2: Batch of rotation matrices of shape `(minibatch, 3, 3)`.
+    Returns:
+        Corresponding rotation angles in [0, π] of shape `(minibatch,)`.
+    Raises:
+        ValueError if `R1` or `R2` is of incorrect shape.
+    """
+    if R1.shape != R2.shape or R1.ndim != 3 or R1.shape[1:] != (3, 3):
+        raise ValueError("Inputs have to be batches of 3x3 Tensors of the same size.")
+
+    R = torch.bmm(R1.transpose(1, 2), R2)
+    rot_trace = R[:, 0, 0] + R[:, 1, 1] + R[:, 2, 2]
+    phi_cos = ((rot_trace - 1.0) * 0.5).clamp(-1.0, 1.0)
+    skew = torch.stack((R[:, 2, 1] - R[:, 1, 2], R[:, 0, 2] - R[:, 2, 0], R[:, 1, 0] - R[:, 0, 1]), dim=1)
+    phi_sin = (0.5 * skew.norm(dim=1)).clamp(max=1.0)
+    return torch.atan2(phi_sin, phi_cos)
+
+
 def so3_exp_map(log_rot: torch.Tensor, eps: float = 0.0001) -> torch.Tensor:
     """
     Convert a batch of logarithmic representations of rotation matrices `log_rot`
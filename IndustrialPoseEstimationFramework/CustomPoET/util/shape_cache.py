@@ -0,0 +1,80 @@
+# ------------------------------------------------------------------------
+# PoET: Pose Estimation Transformer for Single-View, Multi-Object 6D Pose Estimation
+# Copyright (c) 2022 Thomas Jantos (thomas.jantos@aau.at), University of Klagenfurt - Control of Networked Systems (CNS). All Rights Reserved.
+# Licensed under the BSD-2-Clause-License with no commercial use [see LICENSE for details]
+# ------------------------------------------------------------------------
+
+"""
+Inference-time cache of the tensors PoET derives from the shape and padding mask of the input batch only, i.e. the
+downsampled padding masks, the positional encodings, the flattened masks, spatial shapes, level start indices and
+valid ratios passed to the transformer and the reference points of the encoder. For a camera stream with a fixed frame
+size, they are identical for every frame and are computed only once.
+
+Modules that use the cache have a `shape_cache` attribute, which PoET sets to its own cache. Outside of an active
+cache, e.g. during training, everything is computed as usual.
+"""
+from contextlib import contextmanager
+
+import torch
+
+
+class ShapeCache(object):
+    """
+    The entries are valid for inputs of one batch size, height, width, device and dtype with one padding mask. They are
+    discarded automatically as soon as an input with a different key or mask activates the cache.
+    """
+    def __init__(self):
+        self.key = None
+        self.mask = None
+        self.values = {}
+        self.active = False
+
+    @contextmanager
+    def activate(self, mask, dtype):
+        key = (tuple(mask.shape), mask.device, dtype)
+        if key != self.key or not torch.equal(mask, self.mask):
+            self.key = key
+            self.mask = mask.clone()
+            self.values = {}
+        self.active = True
+        try:
+            yield
+        finally:
+            self.active = False
+
+    @contextmanager
+    def suspend(self):
+        """
+        Temporarily computes everything as usual, e.g. for a subset of the batch the cache was activated for.
+        """
+        active = self.active
+        self.active = False
+        try:
+            yield
+        finally:
+            self.active = active
+
+    def clear(self):
+        self.key = None
+        self.mask = None
+        self.values = {}
+
+    def get(self, name, compute):
+        """
+        Returns the cached entry name, which is computed by compute() if it is not cached yet. The returned tensors
+        are shared between calls and must not be modified in-place.
+        """
+        if not self.active:
+            return compute()
+        if name not in self.values:
+            self.values[name] = compute()
+        return self.values[name]
+
+
+def cached(cache, name, compute):
+    """
+    cache.get(name, compute) or compute() if cache is None.
+    """
+    if cache is None:
+        return compute()
+    return cache.get(name, compute)
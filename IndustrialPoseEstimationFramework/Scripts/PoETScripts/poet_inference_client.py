@@ -1,55 +1,124 @@
+import argparse
 import socket
 import cv2
-import pickle
-import struct
 import os
+import sys
+import threading
+import time
+from collections import OrderedDict
 
 SCRIPT_DIR = os.path.dirname(__file__)
 
-def client():
+sys.path.append(f'{SCRIPT_DIR}/../../CustomPoET')
+import inference_tools.frame_protocol as protocol
+from inference_tools.rendering import draw_poses
+
+
+class SentFrames:
+    # Frames sent to the server, kept to render the pose results received for them. Only the most recent frames are
+    # kept, as the server may drop frames.
+    def __init__(self, maxlen=30):
+        self.frames = OrderedDict()
+        self.maxlen = maxlen
+        self.lock = threading.Lock()
+
+    def add(self, frame_id, frame):
+        with self.lock:
+            self.frames[frame_id] = frame
+            if len(self.frames) > self.maxlen:
+                self.frames.popitem(last=False)
+
+    def pop(self, frame_id):
+        # Returns the frame and discards all older frames, as the results arrive in order
+        with self.lock:
+            while self.frames:
+                sent_id, frame = self.frames.popitem(last=False)
+                if sent_id == frame_id:
+                    return frame
+                if sent_id > frame_id:
+                    self.frames[sent_id] = frame
+                    self.frames.move_to_end(sent_id, last=False)
+                    break
+            return None
+
+
+def center_crop(frame, width, height):
+    # Same crop the server applies before the frame is passed to PoET
+    frame_height, frame_width, _ = frame.shape
+    start_x = max(0, frame_width // 2 - width // 2)
+    start_y = max(0, frame_height // 2 - height // 2)
+    return frame[start_y:start_y + height, start_x:start_x + width].copy()
+
+
+def send_frames(client_socket, cap, stop_event, config, sent_frames=None):
+    # Capture and send frames independently of the received results, such that the server can process several
+    # frames concurrently
+    try:
+        frame_id = 0
+        while cap.isOpened() and not stop_event.is_set():
+            ret, frame = cap.read()
+            if not ret:
+                break
+
+            if sent_frames is not None:
+                sent_frames.add(frame_id, frame)
+            protocol.send_frame(client_socket, frame, frame_id, time.time(), config.codec, config.quality)
+            frame_id += 1
+
+        # Signal the server that no more frames will be sent
+        client_socket.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+def client(args):
 
     if not os.path.exists(f'{SCRIPT_DIR}/../../CustomPoET/InferenceOutput'):
         os.mkdir(f'{SCRIPT_DIR}/../../CustomPoET/InferenceOutput')
     video_path = f'{SCRIPT_DIR}/../../CustomPoET/InferenceOutput/webcam_video_inference.mp4'
 
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect(('localhost', 9999))
+    client_socket.connect((args.host, args.port))
 
-    cap = cv2.VideoCapture(0)
+    # Request the codec of the returned images and whether the server should respond with images or poses only
+    requested = protocol.StreamConfig(protocol.CODECS[args.codec], protocol.RESPONSES[args.response], args.quality)
+    config = protocol.request_stream(client_socket, requested)
 
-    count = 0
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        # Send frame to server
-        data = pickle.dumps(frame)
-        message_size = struct.pack("Q", len(data))
-        client_socket.sendall(message_size + data)
+    cap = cv2.VideoCapture(0)
 
-        # Receive processed frame from server
-        data = b""
-        payload_size = struct.calcsize("Q")
+    # In pose mode, the frames are kept to render the received poses on them
+    sent_frames = SentFrames() if config.response == protocol.RESPONSE_POSES and args.render else None
 
-        while len(data) < payload_size:
-            packet = client_socket.recv(4096)
-            if not packet:
-                break
-            data += packet
+    stop_event = threading.Event()
+    sender = threading.Thread(target=send_frames, args=(client_socket, cap, stop_event, config, sent_frames),
+                              daemon=True)
+    sender.start()
 
-        if len(data) < payload_size:
+    count = 0
+    receiver = protocol.FrameReceiver(client_socket, n_buffers=1)
+    while True:
+        # Receive the response to a processed frame from the server
+        message = receiver.receive()
+        if message is None:
             break
-
-        packed_msg_size = data[:payload_size]
-        data = data[payload_size:]
-        msg_size = struct.unpack("Q", packed_msg_size)[0]
-
-        while len(data) < msg_size:
-            data += client_socket.recv(4096)
-
-        frame_data = data[:msg_size]
-        frame = pickle.loads(frame_data)
+        header, payload = message
+
+        if header.msg_type == protocol.MSG_POSES:
+            result = protocol.decode_poses(payload)
+            print(f"Frame {header.frame_id}: {len(result.poses)} objects, "
+                  f"latency {(time.time() - header.timestamp) * 1000:.1f} ms "
+                  f"(server {(result.sent - result.received) * 1000:.1f} ms, "
+                  f"model {(result.inferred - result.received) * 1000:.1f} ms)")
+            for pose in result.poses:
+                print(f"  class {pose['cls']}, t {pose['translation']}")
+
+            frame = sent_frames.pop(header.frame_id) if sent_frames is not None else None
+            if frame is None:
+                continue
+            frame = center_crop(frame, header.width, header.height)
+            draw_poses(frame, result.poses['box'], result.poses['rotation'])
+        else:
+            frame = protocol.decode_image(header, payload)
 
         cv2.imwrite(f'{SCRIPT_DIR}/../../CustomPoET/InferenceOutput/{count}.png', frame)
         count += 1
@@ -58,6 +127,12 @@ def client():
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
 
+    stop_event.set()
+    try:
+        client_socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sender.join()
     cap.release()
     client_socket.close()
     cv2.destroyAllWindows()
@@ -76,4 +151,14 @@ def client():
     print(f'Video saved in {video_path}')
 
 if __name__ == "__main__":
-    client()
+    parser = argparse.ArgumentParser('PoET live inference client')
+    parser.add_argument('--host', default='localhost', type=str, help="Address of the PoET inference server")
+    parser.add_argument('--port', default=9999, type=int, help="Port of the PoET inference server")
+    parser.add_argument('--codec', default='jpeg', choices=list(protocol.CODECS),
+                        help="Codec of the frames sent to and received from the server")
+    parser.add_argument('--quality', default=90, type=int, help="JPEG quality of the frames")
+    parser.add_argument('--response', default='image', choices=list(protocol.RESPONSES),
+                        help="Receive the annotated frames or only the estimated poses from the server")
+    parser.add_argument('--render', action='store_true',
+                        help="In pose mode, render the received poses on the captured frames")
+    client(parser.parse_args())
@@ -2,34 +2,28 @@
 
 import socket
 import cv2
-import pickle
-import struct
+import os
+import sys
+
+SCRIPT_DIR = os.path.dirname(__file__)
+
+sys.path.append(f'{SCRIPT_DIR}/../../CustomPoET')
+import inference_tools.frame_protocol as protocol
 
 def receive_images():
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client_socket.connect(('localhost', 9999))  # Connect to the server running in Docker
 
-    data = b""
-    payload_size = struct.calcsize("Q")
+    # Request JPEG compressed frames
+    protocol.request_stream(client_socket, protocol.DEFAULT_CONFIG)
 
+    receiver = protocol.FrameReceiver(client_socket, n_buffers=1)
     while True:
-        while len(data) < payload_size:
-            packet = client_socket.recv(4096)  # Receive 4096 bytes at a time
-            if not packet:
-                break
-            data += packet
-
-        packed_msg_size = data[:payload_size]
-        data = data[payload_size:]
-        msg_size = struct.unpack("Q", packed_msg_size)[0]
-
-        while len(data) < msg_size:
-            data += client_socket.recv(4096)
-
-        frame_data = data[:msg_size]
-        data = data[msg_size:]
+        message = receiver.receive()
+        if message is None:
+            break
 
-        frame = pickle.loads(frame_data)
+        frame = protocol.decode_image(*message)
         cv2.imshow('Frame', frame)
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
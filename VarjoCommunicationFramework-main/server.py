@@ -1,44 +1,210 @@
+import argparse
 import socket
 import struct
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
 import cv2
 import numpy as np
 from pathlib import Path
 
-def receive_and_save_image(client_socket, save_path):
+
+class DropOldestQueue:
+    # Bounded queue that never blocks the producer: if it is full, the oldest frame is discarded and passed to on_drop
+    def __init__(self, maxsize, on_drop=None):
+        self.maxsize = maxsize
+        self.on_drop = on_drop
+        self.items = deque()
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, item):
+        dropped = None
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                dropped = self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.cond.notify()
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+
+    def get(self):
+        # Returns None once the queue is closed and empty
+        with self.cond:
+            while not self.items and not self.closed:
+                self.cond.wait()
+            if self.items:
+                return self.items.popleft()
+            return None
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class StageTimes:
+    # Durations of the last `window` frames per stage (ring buffers), reported as rolling percentiles and frame rate
+    def __init__(self, window=300):
+        self.window = window
+        self.durations = {}
+        self.frame_times = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.durations.setdefault(stage, deque(maxlen=self.window)).append(duration)
+
+    def frame_done(self):
+        with self.lock:
+            self.frame_times.append(time.perf_counter())
+
+    def summary(self):
+        with self.lock:
+            durations = {stage: np.array(values) for stage, values in self.durations.items()}
+            frame_times = list(self.frame_times)
+        fps = (len(frame_times) - 1) / (frame_times[-1] - frame_times[0]) if len(frame_times) > 1 else 0.0
+        stages = [f"{stage} " + "/".join(f"{p * 1000:.1f}" for p in np.percentile(values, [50, 95, 99]))
+                  for stage, values in durations.items()]
+        return f"FPS {fps:.1f} | p50/p95/p99 [ms]: " + ", ".join(stages)
+
+    def start_logging(self, interval):
+        def log():
+            while True:
+                time.sleep(interval)
+                if self.durations:
+                    print(self.summary())
+        threading.Thread(target=log, daemon=True).start()
+
+
+class ReceiveBuffers:
+    # Preallocated buffers the image data is received into, which avoids allocating and copying every frame. The
+    # buffers are taken from a free list and the image data stays valid until it is handed back with release(), no
+    # matter how many frames were received in the meantime. If no buffer is free, a new one is allocated, hence every
+    # frame has to be released once it was decoded or dropped. Buffers grow to the largest frame received so far.
+    def __init__(self):
+        self.size = bytearray(8)
+        self.free = []
+        self.lock = threading.Lock()
+
+    def next(self, size):
+        with self.lock:
+            buffer = self.free.pop() if self.free else bytearray()
+        if len(buffer) < size:
+            buffer = bytearray(size)
+        return memoryview(buffer)[:size]
+
+    def release(self, data):
+        with self.lock:
+            self.free.append(data.obj)
+
+
+class LatestFrame:
+    # Keeps only the newest received frame for the latest-frame-wins mode. Frames that were not taken before a newer
+    # one arrived are discarded and counted in dropped. Three buffers are rotated: one is written by the reader, one
+    # contains the newest frame and one is held by the consumer until it calls get() again.
+    def __init__(self):
+        self.size = bytearray(8)
+        self.free = [bytearray() for _ in range(3)]
+        self.writing = None
+        self.latest = None
+        self.held = None
+        self.received = 0
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def next(self, size):
+        with self.cond:
+            buffer = self.free.pop()
+        if len(buffer) < size:
+            buffer = bytearray(size)
+        self.writing = memoryview(buffer)[:size]
+        return self.writing
+
+    def publish(self):
+        with self.cond:
+            if self.latest is not None:
+                self.free.append(self.latest.obj)
+                self.dropped += 1
+            self.latest = self.writing
+            self.writing = None
+            self.received += 1
+            self.cond.notify()
+
+    def get(self):
+        # Returns the newest frame not returned before, or None once closed. Releases the previously returned frame
+        with self.cond:
+            if self.held is not None:
+                self.free.append(self.held.obj)
+                self.held = None
+            while self.latest is None and not self.closed:
+                self.cond.wait()
+            if self.latest is None:
+                return None
+            self.held, self.latest = self.latest, None
+            return self.held
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+def recv_into(client_socket, view):
+    # Fill the memoryview with received data, returns False if the connection was closed before
+    while len(view) > 0:
+        n = client_socket.recv_into(view)
+        if n == 0:
+            return False
+        view = view[n:]
+    return True
+
+
+def receive_image_data(client_socket, buffers):
     # Receive the size of the incoming image data
     print("Receiving image size...")
-    packed_msg_size = client_socket.recv(8)  # 8 bytes for the size (uint64_t)
-    if not packed_msg_size:
+    if not recv_into(client_socket, memoryview(buffers.size)):  # 8 bytes for the size (uint64_t)
         print("No data received for image size.")
-        return False
+        return None
 
-    msg_size = struct.unpack("Q", packed_msg_size)[0]
+    msg_size = struct.unpack("Q", buffers.size)[0]
 
     # Acknowledge receipt of image size
     client_socket.sendall(b'SZE')
 
     # Receive the actual image data
     print("Receiving image data...")
-    data = b""
-    while len(data) < msg_size:
-        packet = client_socket.recv(4096)
-        if not packet:
-            print("No more data received during image data reception.")
-            return False
-        data += packet
+    data = buffers.next(msg_size)
+    if not recv_into(client_socket, data):
+        print("No more data received during image data reception.")
+        return None
 
     print("Image data received successfully.")
 
     # Acknowledge receipt of the full image
     client_socket.sendall(b'IMG')
+    return data
+
 
-    # Decode the image data (PNG format) using OpenCV
+def decode_image(data):
+    # Decode the image data (PNG format) using OpenCV, directly from the receive buffer
     nparr = np.frombuffer(data, np.uint8)
     frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
 
     if frame is None:
         print("Failed to decode the image.")
-        return False
+        return None
 
     # Get the dimensions of the frame
     height, width, _ = frame.shape
@@ -49,15 +215,73 @@ def receive_and_save_image(client_socket, save_path):
         start_y = max(0, height // 2 - 240)
         frame = frame[start_y:start_y + 480, start_x:start_x + 640]
 
+    return cv2.cvtColor(frame, cv2.COLOR_RGBA2BGR)
+
+
+def save_image(frame, save_path):
     # Save the image to the specified path
     save_path = Path(save_path)
     save_path.parent.mkdir(parents=True, exist_ok=True)
-    frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2BGR)
     cv2.imwrite(str(save_path), frame)
     print(f"Image saved to {save_path}")
+
+
+def receive_and_save_image(client_socket, save_path, buffers, times):
+    with times.measure('recv'):
+        data = receive_image_data(client_socket, buffers)
+    if data is None:
+        return False
+
+    with times.measure('decode'):
+        frame = decode_image(data)
+    buffers.release(data)
+    if frame is None:
+        return False
+
+    with times.measure('save'):
+        save_image(frame, save_path)
+    times.frame_done()
     return True
 
-def webcam_inference():
+
+def decode_worker(in_queue, out_queue, buffers, times):
+    while True:
+        item = in_queue.get()
+        if item is None:
+            break
+        count, data = item
+        with times.measure('decode'):
+            frame = decode_image(data)
+        buffers.release(data)
+        if frame is not None:
+            out_queue.put((count, frame))
+    out_queue.close()
+
+
+def save_worker(in_queue, times):
+    while True:
+        item = in_queue.get()
+        if item is None:
+            break
+        count, frame = item
+        with times.measure('save'):
+            save_image(frame, f'tmp/{count}.png')
+        times.frame_done()
+
+
+def latest_frame_reader(client_socket, latest, times):
+    # Receive frames continuously, independent of how fast they are processed
+    while True:
+        with times.measure('recv'):
+            data = receive_image_data(client_socket, latest)
+        if data is None:
+            print("Failed to receive image")
+            break
+        latest.publish()
+    latest.close()
+
+
+def webcam_inference(queue_depth=0, log_interval=0, latest_frame=False):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.bind(('0.0.0.0', 9999))
     server_socket.listen(1)
@@ -65,15 +289,88 @@ def webcam_inference():
     client_socket, addr = server_socket.accept()
     print("Connected to:", addr)
 
+    times = StageTimes()
+    if log_interval > 0:
+        times.start_logging(log_interval)
+
+    if latest_frame:
+        # Latest-frame-wins: a background thread keeps receiving, while this thread decodes and saves the newest frame
+        latest = LatestFrame()
+        reader = threading.Thread(target=latest_frame_reader, args=(client_socket, latest, times), daemon=True)
+        reader.start()
+        count = 0
+        while True:
+            data = latest.get()
+            if data is None:
+                break
+            with times.measure('decode'):
+                frame = decode_image(data)
+            if frame is not None:
+                with times.measure('save'):
+                    save_image(frame, f'tmp/{count}.png')
+                times.frame_done()
+            count += 1
+        reader.join()
+        print(f"Dropped stale frames: {latest.dropped}/{latest.received}")
+        print(times.summary())
+        return
+
+    if queue_depth <= 0:
+        # Lock-step: receive, decode and save one frame before receiving the next one
+        buffers = ReceiveBuffers()
+        count = 0
+        while True:
+            image_path = f'tmp/{count}.png'
+
+            if not receive_and_save_image(client_socket, image_path, buffers, times):
+                print("Failed to receive image")
+                break
+
+            count += 1
+        print(times.summary())
+        return
+
+    # Pipelined: the socket is read in this thread, while decoding and saving run concurrently in worker threads on
+    # previously received frames. The image data of a frame is in use until it is decoded or dropped from the decode
+    # queue. Frames keep being received while a frame is decoded, hence the buffers are released explicitly instead of
+    # being reused in a ring.
+    buffers = ReceiveBuffers()
+    decode_queue = DropOldestQueue(queue_depth, on_drop=lambda item: buffers.release(item[1]))
+    save_queue = DropOldestQueue(queue_depth)
+    workers = [threading.Thread(target=decode_worker, args=(decode_queue, save_queue, buffers, times), daemon=True),
+               threading.Thread(target=save_worker, args=(save_queue, times), daemon=True)]
+    for worker in workers:
+        worker.start()
+
     count = 0
     while True:
-        image_path = f'tmp/{count}.png'
-
-        if not receive_and_save_image(client_socket, image_path):
+        with times.measure('recv'):
+            data = receive_image_data(client_socket, buffers)
+        if data is None:
             print("Failed to receive image")
             break
-
+        decode_queue.put((count, data))
         count += 1
 
+    decode_queue.close()
+    for worker in workers:
+        worker.join()
+    print(f"Dropped frames: decode {decode_queue.dropped}, save {save_queue.dropped}")
+    print(times.summary())
+
+
 if __name__ == '__main__':
-    webcam_inference()
+    parser = argparse.ArgumentParser('Varjo frame server')
+    parser.add_argument('--queue_depth', default=0, type=int,
+                        help="Number of frames queued between the receive, decode and save stages. If > 0, the stages "
+                             "run concurrently and the oldest queued frame is dropped if a stage falls behind. "
+                             "0 processes the frames lock-step.")
+    parser.add_argument('--log_interval', default=0, type=float,
+                        help="Interval in seconds in which the rolling p50/p95/p99 latency of the recv, decode and "
+                             "save stages and the frame rate are printed. 0 only prints them at the end.")
+    parser.add_argument('--latest_frame', action='store_true',
+                        help="Latest-frame-wins mode: frames are received continuously in a background thread and "
+                             "only the newest one is decoded and saved, older ones are dropped. Overrides "
+                             "--queue_depth.")
+    args = parser.parse_args()
+    webcam_inference(args.queue_depth, args.log_interval, args.latest_frame)